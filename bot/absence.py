@@ -1,50 +1,191 @@
 import asyncio
+import heapq
 import logging
-from datetime import datetime, timezone
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
 
-from .context import CONFIG, bot, user_states, absent_notified
-from .notify import resolve_sender_label, get_admin_effective_flags
+from . import context, metrics
+from .context import cluster, user_states, state_store
+from .delivery import delivery
+from .digest import format_location, pack_blocks
+from .models import Event, EventKind, TelegramAdmin, TelegramGlobal
+from .state_table import UserStateView
+from .notify import render_event, resolve_sender_label
 
 
-async def absence_watcher():
-    global absent_notified
-    while True:
-        try:
-            await asyncio.sleep(60)
-            if not user_states:
+AdminGroup = Tuple[int, List[Tuple[TelegramAdmin, TelegramGlobal]]]
+# (user_id, минут без локации, последняя точка — если админ просит её с алертом)
+Overdue = Tuple[int, int, Optional[Tuple[float, float]]]
+
+
+def render_absence_summary(items: List[Overdue]) -> List[str]:
+    header = f"⏰ Нет локации от {len(items)} пользователей:"
+    blocks = []
+    for user_id, minutes, location in items:
+        line = f"• {resolve_sender_label(user_id, None)} — {minutes} мин"
+        if location is not None:
+            line = f"{line}\n  {format_location(location)}"
+        blocks.append(line)
+    return pack_blocks(header, blocks, "\n")
+
+
+class AbsenceScheduler:
+    def __init__(self):
+        # (дедлайн, user_id, время локации, от которого считали, индекс порога)
+        self._heap: List[Tuple[float, int, float, int]] = []
+        self._scheduled: Set[int] = set()
+        self._wakeup = asyncio.Event()
+        self._groups: List[AdminGroup] = []
+        self.summaries = 0
+        # последняя ревизия общего хранилища, дочитанная ведущим инстансом
+        self._rev = 0
+        self.rebuild_groups()
+
+    def rebuild_groups(self):
+        groups = {}
+        for adm, eff in context.CONFIG.routing.admins:
+            if eff.notify_absent_enabled:
+                groups.setdefault(eff.notify_absent_minutes, []).append((adm, eff))
+        self._groups = sorted(groups.items(), key=lambda g: g[0])
+
+    def reset(self):
+        self.rebuild_groups()
+        self._heap = []
+        self._scheduled = set()
+        for user_id, state in list(user_states.items()):
+            self.touch(user_id, state.last_time)
+        self._wakeup.set()
+
+    def __len__(self) -> int:
+        return len(self._scheduled)
+
+    def touch(self, user_id: int, last_time: datetime):
+        if not self._groups or user_id in self._scheduled:
+            return
+        self._push(user_id, last_time.timestamp(), 0)
+
+    def _push(self, user_id: int, base_ts: float, k: int):
+        deadline = base_ts + self._groups[k][0] * 60
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, user_id, base_ts, k))
+        self._scheduled.add(user_id)
+
+    def _next_timeout(self):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - time.time())
+
+    @metrics.timed(metrics.absence_cycle_seconds)
+    def fire_due(self, now: float):
+        # проход только собирает просроченных по админам и ставит отправку в очередь delivery,
+        # поэтому его длительность не зависит от задержек Telegram
+        heap = self._heap
+        overdue: Dict[int, List[Overdue]] = {}
+        while heap and heap[0][0] <= now:
+            _, user_id, base_ts, k = heapq.heappop(heap)
+            self._scheduled.discard(user_id)
+
+            state = user_states.get(user_id)
+            if state is None or k >= len(self._groups):
+                continue
+
+            last_ts = state.last_time.timestamp()
+            if last_ts != base_ts:
+                # пока запись лежала в куче, пришла новая локация — переносим без лишних push
+                self._push(user_id, last_ts, 0)
+                continue
+
+            self._collect(user_id, state, now, self._groups[k][1], overdue)
+            if k + 1 < len(self._groups):
+                self._push(user_id, base_ts, k + 1)
+
+        for admin_id, items in overdue.items():
+            self._send(admin_id, items)
+
+    def _collect(self, user_id: int, state: UserStateView, now: float, admins, overdue: Dict[int, List[Overdue]]):
+        minutes = int((now - state.last_time.timestamp()) / 60.0)
+        metrics.events_total.inc(EventKind.ABSENT.value)
+
+        notified = state.notified_admins
+        for adm, eff in admins:
+            if adm.id in notified:
                 continue
 
-            now = datetime.now(timezone.utc)
-            for user_id, state in list(user_states.items()):
-                delta_min = (now - state.last_time).total_seconds() / 60.0
-
-                for adm in CONFIG.telegram.admins:
-                    eff = get_admin_effective_flags(adm)
-                    if not eff.notify_absent_enabled:
-                        continue
-                    if delta_min < eff.notify_absent_minutes:
-                        continue
-
-                    key = (user_id, adm.id)
-                    if key in absent_notified:
-                        continue
-
-                    label = resolve_sender_label(user_id, None)
-                    text = f"⏰ Нет локации от {label} уже {int(delta_min)} минут"
-                    try:
-                        await bot.send_message(adm.id, text)
-                        if eff.send_current_location_with_alert:
-                            await bot.send_location(
-                                adm.id,
-                                latitude=state.last_lat,
-                                longitude=state.last_lng,
-                            )
-                    except Exception as e:
-                        logging.warning("Не удалось отправить absent-сообщение админу %s: %s", adm.id, e)
-
-                    absent_notified.add(key)
+            location = (state.last_lat, state.last_lng) if eff.send_current_location_with_alert else None
+            overdue.setdefault(adm.id, []).append((user_id, minutes, location))
+
+            notified.add(adm.id)
+            state_store.add_notified(user_id, adm.id)
+
+    def _send(self, admin_id: int, items: List[Overdue]):
+        if len(items) == 1:
+            # один пропавший — обычное уведомление с отдельной точкой на карте
+            user_id, minutes, location = items[0]
+            delivery.send_message(admin_id, render_event(Event(EventKind.ABSENT, user_id, absent_minutes=minutes)))
+            if location is not None:
+                delivery.send_location(admin_id, *location)
+            return
+
+        # массовая пропажа (например, отказ соты) — одна сводка вместо сообщения на каждого
+        for text in render_absence_summary(items):
+            delivery.send_message(admin_id, text)
+            self.summaries += 1
+
+    async def sync_from_cluster(self):
+        while True:
+            rows, self._rev = await cluster.users_since(self._rev)
+            for user_id, state in rows:
+                local = user_states.get(user_id)
+                # свои пользователи в памяти свежее, чем в хранилище (запись идёт с задержкой)
+                if local is None or local.last_ts < state.last_time.timestamp():
+                    user_states[user_id] = state
+                    self.touch(user_id, state.last_time)
+            if not rows:
+                return
+
+    async def lead(self):
+        # в кластере дедлайны проверяет только держатель аренды; ему нужны все пользователи,
+        # поэтому он держит их зеркало и дочитывает изменения других инстансов
+        await cluster.wait_leader()
+        self._rev = 0
+        await self.sync_from_cluster()
+        self.reset()
+        scan = asyncio.create_task(self.run())
+        try:
+            while not await cluster.wait_follower(cluster.interval):
+                await self.sync_from_cluster()
+        finally:
+            scan.cancel()
+
+    async def run(self):
+        for user_id, state in list(user_states.items()):
+            self.touch(user_id, state.last_time)
+
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_timeout())
+            except asyncio.TimeoutError:
+                pass
+            self.fire_due(time.time())
+
+
+absence_scheduler = AbsenceScheduler()
+metrics.gauge_fn("bot_absence_scheduled", "Пользователей в очереди дедлайнов absence", lambda: len(absence_scheduler))
+metrics.counter_fn("bot_absence_summaries_total", "Сводок о пропавших пользователях", lambda: absence_scheduler.summaries)
 
+
+async def absence_watcher():
+    while True:
+        try:
+            if cluster is None:
+                await absence_scheduler.run()
+            else:
+                await absence_scheduler.lead()
         except asyncio.CancelledError:
             break
         except Exception as e:
-            logging.exception("Ошибка в absence_watcher: %s", e)
\ No newline at end of file
+            logging.exception("Ошибка в absence_watcher: %s", e)
+            await asyncio.sleep(1)
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import List, Optional, Set, Tuple
+
+from .context import GEO_BATCH_WINDOW_MS, GEO_BATCH_MAX_SIZE
+from .geo import update_user_state, update_user_states_batch
+from .workers import GeoWorkerPool, geo_workers
+
+
+Pending = List[Tuple[int, float, float, asyncio.Future]]
+
+
+class GeoBatcher:
+    def __init__(self, window_ms: int, max_size: int, pool: Optional[GeoWorkerPool] = None):
+        self.window_s = window_ms / 1000.0
+        self.max_size = max(1, max_size)
+        self.pool = pool
+        self._pending: Pending = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._dispatching: Set[asyncio.Task] = set()
+
+    @property
+    def offloaded(self) -> bool:
+        return self.pool is not None and self.pool.enabled
+
+    @property
+    def enabled(self) -> bool:
+        # с воркерами пакетируем всегда: хотя бы обновления одной итерации цикла
+        return self.window_s > 0 or self.offloaded
+
+    async def submit(self, user_id: int, lat: float, lon: float) -> Tuple[Set[int], Set[int]]:
+        if not self.enabled:
+            return update_user_state(user_id, lat, lon)
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((user_id, lat, lon, fut))
+
+        if len(self._pending) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_s, self.flush)
+
+        return await fut
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        if self.offloaded:
+            task = asyncio.ensure_future(self._dispatch(pending))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+            return
+
+        try:
+            results = update_user_states_batch([(u, lat, lon) for u, lat, lon, _ in pending])
+        except Exception as e:
+            self._fail(pending, e)
+            return
+        self._resolve(pending, results)
+
+    async def _dispatch(self, pending: Pending):
+        try:
+            results = await self.pool.process([(u, lat, lon) for u, lat, lon, _ in pending])
+        except Exception as e:
+            self._fail(pending, e)
+            return
+        self._resolve(pending, results)
+
+    @staticmethod
+    def _resolve(pending: Pending, results: List[Tuple[Set[int], Set[int]]]):
+        for (*_, fut), result in zip(pending, results):
+            if not fut.done():
+                fut.set_result(result)
+
+    @staticmethod
+    def _fail(pending: Pending, e: Exception):
+        logging.exception("Ошибка пакетной обработки %d локаций: %s", len(pending), e)
+        for *_, fut in pending:
+            if not fut.done():
+                fut.set_exception(e)
+
+
+geo_batcher = GeoBatcher(GEO_BATCH_WINDOW_MS, GEO_BATCH_MAX_SIZE, geo_workers)
@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import atexit
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, Tuple
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+# режимы строят свои синтетические конфиги, стартовый нужен только для импорта context;
+# состояние держим в памяти, чтобы замер не писал в рабочие базы
+if "CONFIG_PATH" not in os.environ:
+    _fd, _path = tempfile.mkstemp(prefix="geoshare-bench-", suffix=".json")
+    with os.fdopen(_fd, "w", encoding="utf-8") as _f:
+        json.dump({"zones": [], "telegram": {}}, _f)
+    os.environ["CONFIG_PATH"] = _path
+    atexit.register(os.remove, _path)
+    os.environ["CONFIG_CACHE_PATH"] = ""
+os.environ["STATE_DB_PATH"] = ""
+os.environ["CLUSTER_DB_PATH"] = ""
+# отправка уходит в заглушку, лимиты Telegram только растянут замер
+os.environ.setdefault("DELIVERY_GLOBAL_RATE", "0")
+os.environ.setdefault("DELIVERY_CHAT_RATE", "0")
+
+from . import context, geo  # noqa: E402
+from .absence import absence_scheduler  # noqa: E402
+from .config_loader import parse_config  # noqa: E402
+from .delivery import delivery  # noqa: E402
+from .geo import _apply_user_zones, _evaluate_zones, haversine_m, record_user_position, update_user_state  # noqa: E402
+from .loadtest import StubBot  # noqa: E402
+from .models import Config, UserState  # noqa: E402
+from .state_table import UserStateTable  # noqa: E402
+from .replay import read_trace, synthetic_trace  # noqa: E402
+from .routing import effective_admin_flags  # noqa: E402
+from .spatial import EARTH_RADIUS_M  # noqa: E402
+
+
+# синтетический город: зоны и точки в одном прямоугольнике ~50×35 км
+AREA = (55.55, 37.35, 56.0, 37.9)
+
+
+def random_point(rnd: random.Random) -> Tuple[float, float]:
+    min_lat, min_lng, max_lat, max_lng = AREA
+    return rnd.uniform(min_lat, max_lat), rnd.uniform(min_lng, max_lng)
+
+
+def synthetic_config(zones: int, seed: int = 1, **telegram) -> Config:
+    rnd = random.Random(seed)
+    raw_zones = []
+    for zid in range(1, zones + 1):
+        lat, lng = random_point(rnd)
+        raw_zones.append({
+            "id": zid,
+            "type": "danger" if zid % 5 == 0 else "secure",
+            "center": {"lat": lat, "lng": lng},
+            "radius_m": rnd.uniform(50.0, 500.0),
+        })
+    return parse_config({"zones": raw_zones, "telegram": telegram})
+
+
+def measure(fn: Callable[[], object], seconds: float) -> Tuple[int, float]:
+    # повторяет fn, пока не наберётся seconds; возвращает число вызовов и затраченное время
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return calls, elapsed
+
+
+def bench_zones(args):
+    # точки в секунду: полный перебор зон через haversine_m (как до индекса) против ZoneIndex
+    rnd = random.Random(args.seed)
+    points = [random_point(rnd) for _ in range(args.points)]
+    for n in args.zones:
+        cfg = synthetic_config(n, args.seed)
+        context.CONFIG = cfg
+
+        def linear(lat, lon):
+            return {z.id for z in cfg.zones if haversine_m(lat, lon, z.center_lat, z.center_lng) <= z.radius_m}
+
+        def indexed(lat, lon):
+            return _evaluate_zones(cfg, lat, lon, set())[0]
+
+        for lat, lon in points[:20]:
+            if linear(lat, lon) != indexed(lat, lon):
+                raise AssertionError(f"индекс и перебор разошлись в точке {lat}, {lon}")
+
+        rates = {}
+        for name, check in (("linear", linear), ("index", indexed)):
+            it = itertools.cycle(points)
+            calls, elapsed = measure(lambda: check(*next(it)), args.seconds)
+            rates[name] = calls / elapsed
+        print(
+            f"zones={n} cell={cfg.zone_index.cell_deg:.4f}° "
+            f"linear={rates['linear']:.0f} pts/s index={rates['index']:.0f} pts/s "
+            f"speedup={rates['index'] / rates['linear']:.1f}x"
+        )
+
+
+def bench_absence(args):
+    # доля --overdue пользователей молчит больше порога, остальные свежие: постановка в кучу
+    # дедлайнов, один проход fire_due и для сравнения — полный перебор пользователи × админы,
+    # который раньше шёл каждую минуту
+    admins = [
+        {"id": 10**9 + i, "override": True, "notify_absent_enabled": True, "notify_absent_minutes": 10}
+        for i in range(args.admins)
+    ]
+    cfg = synthetic_config(0, args.seed, admins=admins)
+    context.CONFIG = cfg
+    absence_scheduler.rebuild_groups()
+    users = context.user_states
+    users.clear()
+    rnd = random.Random(args.seed)
+    now = time.time()
+    for user_id in range(1, args.users + 1):
+        lat, lon = random_point(rnd)
+        silent = 3600.0 if rnd.random() < args.overdue else 0.0
+        users.set_position(user_id, lat, lon, now - silent - rnd.uniform(0, 300), ())
+
+    started = time.perf_counter()
+    for user_id, state in users.items():
+        absence_scheduler.touch(user_id, state.last_time)
+    schedule = time.perf_counter() - started
+
+    # новые локации только меняют время у пользователя, куча переносит дедлайн при извлечении
+    started = time.perf_counter()
+    for user_id in range(1, args.users + 1, 10):
+        state = users[user_id]
+        if now - state.last_ts < 600:
+            state = users.set_position(user_id, state.last_lat, state.last_lng, now - rnd.uniform(0, 60), ())
+        absence_scheduler.touch(user_id, state.last_time)
+    reschedule = (time.perf_counter() - started) / len(range(1, args.users + 1, 10))
+
+    async def fire():
+        stub = StubBot()
+        delivery.bot = stub
+        started = time.perf_counter()
+        absence_scheduler.fire_due(now)
+        fired = time.perf_counter() - started
+        await delivery.drain()
+        return fired, len(stub.calls)
+
+    fired, sent = asyncio.run(fire())
+
+    sample = min(args.users, 10000)
+    global_cfg = cfg.telegram.global_cfg
+    started = time.perf_counter()
+    for user_id in range(1, sample + 1):
+        last_ts = users[user_id].last_ts
+        for adm in cfg.telegram.admins:
+            eff = effective_admin_flags(adm, global_cfg)
+            if eff.notify_absent_enabled and now - last_ts >= eff.notify_absent_minutes * 60:
+                pass
+    scan = (time.perf_counter() - started) * args.users / sample
+
+    print(f"users={args.users} admins={args.admins} overdue={args.overdue:.0%}")
+    print(f"  heap: schedule={schedule * 1000:.0f}ms reschedule={reschedule * 1e6:.2f}us/update fire_due={fired * 1000:.0f}ms")
+    print(f"  sent={sent} summaries={absence_scheduler.summaries}")
+    print(f"  full scan users×admins (по {sample} пользователям): {scan * 1000:.0f}ms на проход")
+
+
+def bench_trace(args):
+    # прогон GPS-трассы через проверку зон: полный пересчёт на каждой точке (как до кэша запаса)
+    # против update_user_state с кэшем; без гистерезиса и с ним — сколько переходов даёт дрожание
+    cfg = synthetic_config(args.zones[0], args.seed)
+    context.CONFIG = cfg
+    points = read_trace(args.trace) if args.trace else synthetic_trace(args.users, args.updates_per_user, 30.0, args.seed)
+    points = [(p.user_id, p.lat, p.lon) for p in points if p.kind != "end"]
+
+    def full(user_id, lat, lon):
+        state = context.user_states.get(user_id)
+        prev_zones = state.current_zone_ids if state else set()
+        new_zones, _ = _evaluate_zones(cfg, lat, lon, prev_zones)
+        return _apply_user_zones(cfg, user_id, lat, lon, new_zones)
+
+    print(f"zones={len(cfg.zones)} points={len(points)}")
+    for hysteresis in (0.0, args.hysteresis):
+        cfg.zone_global.hysteresis_m = hysteresis
+        results = {}
+        for name, update in (("full", full), ("incremental", update_user_state)):
+            best = math.inf
+            for _ in range(args.repeat):
+                context.user_states.clear()
+                transitions = 0
+                started = time.perf_counter()
+                for user_id, lat, lon in points:
+                    entered, exited = update(user_id, lat, lon)
+                    transitions += len(entered) + len(exited)
+                best = min(best, time.perf_counter() - started)
+            results[name] = transitions
+            print(
+                f"  hysteresis={hysteresis:g}m {name}: {len(points) / best:.0f} pts/s "
+                f"transitions={transitions}"
+            )
+        if results["full"] != results["incremental"]:
+            raise AssertionError(f"переходы разошлись: {results}")
+
+        # доля точек, где кэш запаса избавил от пересчёта, — отдельным прогоном вне замера
+        hits = 0
+        still_inside = geo._still_in_same_zones
+
+        def counted(*a):
+            nonlocal hits
+            hit = still_inside(*a)
+            hits += hit
+            return hit
+
+        context.user_states.clear()
+        geo._still_in_same_zones = counted
+        try:
+            for user_id, lat, lon in points:
+                update_user_state(user_id, lat, lon)
+        finally:
+            geo._still_in_same_zones = still_inside
+        print(f"  hysteresis={hysteresis:g}m cache hits={hits / len(points):.0%}")
+
+
+def bench_notified(args) -> int:
+    # обновление локации снимает отметки «нет локации» у пользователя; цена не должна зависеть
+    # от числа пользователей. Для сравнения — прежняя пересборка общего множества пар (user, admin)
+    cfg = synthetic_config(0, args.seed)
+    context.CONFIG = cfg
+    admins = list(range(10**9, 10**9 + 10))
+    rnd = random.Random(args.seed)
+    costs = []
+    for n in args.scale:
+        users = context.user_states
+        users.clear()
+        now = time.time()
+        for user_id in range(1, n + 1):
+            users.set_position(user_id, 55.75, 37.62, now, ()).notified_admins.update(admins)
+        order = [rnd.randint(1, n) for _ in range(args.updates)]
+
+        # каждое обновление снимает отметки, следом они ставятся заново, чтобы следующее снова было что снимать
+        cost = math.inf
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            for user_id in order:
+                record_user_position(user_id, 55.75, 37.62, now, ())
+                users[user_id].notified_admins.update(admins)
+            cost = min(cost, (time.perf_counter() - started) / len(order))
+        costs.append(cost)
+
+        pairs = {(user_id, admin_id) for user_id in range(1, n + 1) for admin_id in admins}
+        legacy_updates = order[:20]
+        started = time.perf_counter()
+        for user_id in legacy_updates:
+            pairs = {(u, a) for u, a in pairs if u != user_id}
+        legacy = (time.perf_counter() - started) / len(legacy_updates)
+        print(f"users={n} admins={len(admins)} per-user={cost * 1e6:.2f}us/update shared-set={legacy * 1e6:.0f}us/update")
+
+    growth = costs[-1] / costs[0]
+    print(f"growth {args.scale[0]}→{args.scale[-1]}: {growth:.2f}x")
+    if growth > args.max_growth:
+        print(f"РЕГРЕССИЯ: цена обновления выросла в {growth:.2f}x > {args.max_growth:g}x")
+        return 1
+    return 0
+
+
+def bench_memory(args):
+    # память на пользователя (tracemalloc): UserStateTable против словаря dataclass UserState,
+    # как хранилось раньше, и сколько выделяется на обновление позиции
+    rnd = random.Random(args.seed)
+    positions = [(*random_point(rnd), (rnd.randint(1, 1000), rnd.randint(1, 1000))) for _ in range(args.users)]
+    now = time.time()
+
+    def fill_table():
+        table = UserStateTable()
+        for user_id, (lat, lng, zones) in enumerate(positions, 1):
+            table.set_position(user_id, lat, lng, now, zones)
+        return table, lambda user_id, lat, lng, zones: table.set_position(user_id, lat, lng, now, zones)
+
+    def fill_dataclass():
+        states = {}
+
+        def put(user_id, lat, lng, zones):
+            states[user_id] = UserState(lat, lng, datetime.fromtimestamp(now, timezone.utc), set(zones))
+
+        for user_id, (lat, lng, zones) in enumerate(positions, 1):
+            put(user_id, lat, lng, zones)
+        return states, put
+
+    print(f"users={args.users}")
+    for name, fill in (("table", fill_table), ("dataclass", fill_dataclass)):
+        tracemalloc.start()
+        holder, put = fill()
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        for _ in range(args.updates):
+            user_id = rnd.randint(1, args.users)
+            lat, lng, zones = positions[user_id - 1]
+            put(user_id, lat, lng, zones)
+        churn = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        print(f"  {name}: {held / args.users:.0f} B/user total={held / 2**20:.1f} MiB update-peak={churn / 1024:.1f} KiB")
+        del holder, put
+
+
+def bench_prefilter(args):
+    # пары точка×зона в секунду: точный haversine_m против плоской оценки с откатом на haversine
+    # у границы; то же для векторного пути, если есть numpy
+    cfg = synthetic_config(args.zones[0], args.seed)
+    rnd = random.Random(args.seed)
+    pairs = []
+    for _ in range(args.points):
+        lat, lon = random_point(rnd)
+        pairs.append((lat, lon, math.cos(math.radians(lat)), rnd.choice(cfg.zones)))
+    for lat, lon, cos_lat, z in pairs:
+        inside = haversine_m(lat, lon, z.center_lat, z.center_lng) <= z.radius_m
+        if inside != (geo.zone_signed_distance(z, lat, lon, 0.0, cos_lat) <= 0.0):
+            raise AssertionError(f"оценка и haversine разошлись в точке {lat}, {lon}")
+
+    def exact():
+        for lat, lon, _, z in pairs:
+            haversine_m(lat, lon, z.center_lat, z.center_lng) <= z.radius_m
+
+    def prefiltered():
+        for lat, lon, cos_lat, z in pairs:
+            geo.zone_signed_distance(z, lat, lon, 0.0, cos_lat) <= 0.0
+
+    variants = [("haversine", exact), ("prefilter", prefiltered)]
+    if geo._load_numpy():
+        np = geo.np
+        plat = np.array([p[0] for p in pairs])
+        plng = np.array([p[1] for p in pairs])
+        pcos = np.array([p[2] for p in pairs])
+        zlat = np.array([p[3].center_lat for p in pairs])
+        zlng = np.array([p[3].center_lng for p in pairs])
+        zcos = np.array([p[3].cos_lat for p in pairs])
+        zrad = np.array([p[3].radius_m for p in pairs])
+
+        def exact_np():
+            a = np.sin(np.radians(zlat - plat) / 2) ** 2 \
+                + np.cos(np.radians(plat)) * np.cos(np.radians(zlat)) * np.sin(np.radians(zlng - plng) / 2) ** 2
+            return 2 * EARTH_RADIUS_M * np.arctan2(np.sqrt(a), np.sqrt(1 - a)) <= zrad
+
+        def prefiltered_np():
+            return geo._pair_distances_np(plat, plng, pcos, zlat, zlng, zcos, zrad, 0.0) <= zrad
+
+        if not (exact_np() == prefiltered_np()).all():
+            raise AssertionError("векторная оценка и haversine разошлись")
+        variants += [("numpy haversine", exact_np), ("numpy prefilter", prefiltered_np)]
+
+    print(f"zones={len(cfg.zones)} pairs={len(pairs)}")
+    for name, fn in variants:
+        calls, elapsed = measure(fn, args.seconds)
+        print(f"  {name}: {calls * len(pairs) / elapsed / 1e6:.2f}M pairs/s")
+
+
+_STARTUP_PROBE = """
+import sys, time
+started = time.perf_counter()
+if sys.argv[1] == "config":
+    from bot.config_loader import load_config
+    load_config(sys.argv[2], sys.argv[3])
+else:
+    import bot.main
+print(time.perf_counter() - started)
+"""
+
+
+def _probe(what: str, config_path: str, cache_path: str) -> float:
+    # каждый замер — в свежем интерпретаторе, иначе модули и конфиг уже будут в памяти
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        CONFIG_PATH=config_path,
+        CONFIG_CACHE_PATH=cache_path,
+        PYTHONPATH=os.pathsep.join(filter(None, (root, os.environ.get("PYTHONPATH")))),
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", _STARTUP_PROBE, what, config_path, cache_path],
+        env=env, check=True, capture_output=True, text=True,
+    )
+    return float(out.stdout.split()[-1])
+
+
+def bench_startup(args):
+    # время загрузки конфига и импорта bot.main (до запуска polling): без кэша, с записью
+    # кэша и с готовым кэшем
+    with tempfile.TemporaryDirectory(prefix="geoshare-startup-") as workdir:
+        for n in args.zones:
+            rnd = random.Random(args.seed)
+            zones = []
+            for zid in range(1, n + 1):
+                lat, lng = random_point(rnd)
+                zones.append({"id": zid, "center": {"lat": lat, "lng": lng}, "radius_m": rnd.uniform(50.0, 500.0)})
+            config_path = os.path.join(workdir, f"config-{n}.json")
+            cache_path = config_path + ".cache"
+            with open(config_path, "w", encoding="utf-8") as f:
+                json.dump({"zones": zones, "telegram": {}}, f)
+
+            parse = _probe("config", config_path, "")
+            cold = _probe("config", config_path, cache_path)
+            warm = min(_probe("config", config_path, cache_path) for _ in range(args.repeat))
+            main_parse = _probe("main", config_path, "")
+            main_warm = min(_probe("main", config_path, cache_path) for _ in range(args.repeat))
+            print(
+                f"zones={n} config: parse={parse * 1000:.0f}ms cache-write={cold * 1000:.0f}ms "
+                f"cache-hit={warm * 1000:.0f}ms; import bot.main: no-cache={main_parse * 1000:.0f}ms "
+                f"cache={main_warm * 1000:.0f}ms"
+            )
+
+
+MODES: Dict[str, Callable] = {
+    "absence": bench_absence,
+    "memory": bench_memory,
+    "notified": bench_notified,
+    "prefilter": bench_prefilter,
+    "startup": bench_startup,
+    "trace": bench_trace,
+    "zones": bench_zones,
+}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей бота без Telegram")
+    parser.add_argument("--mode", choices=sorted(MODES), required=True)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=1.0, help="время замера одного варианта, с")
+    parser.add_argument("--zones", type=int, nargs="+", default=[10, 1000, 100000], help="числа зон для --mode zones")
+    parser.add_argument("--points", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--admins", type=int, default=100)
+    parser.add_argument("--trace", help="JSONL-трасса в формате bot.replay для --mode trace (по умолчанию синтетическая)")
+    parser.add_argument("--updates-per-user", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3, help="прогонов трассы на вариант, берётся лучший")
+    parser.add_argument("--hysteresis", type=float, default=15.0, help="гистерезис для второго прогона --mode trace, м")
+    parser.add_argument("--scale", type=int, nargs="+", default=[1000, 50000], help="числа пользователей для --mode notified")
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--max-growth", type=float, default=2.0, help="допустимый рост цены обновления для --mode notified")
+    parser.add_argument("--overdue", type=float, default=0.01, help="доля пропавших пользователей для --mode absence")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    return MODES[args.mode](args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,556 @@
+import abc
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .models import LiveSession, UserState
+from .storage import LoadedState, SessionKey, StateBackend, encode_zones, make_state
+
+
+# (user_id, lat, lng, ts, зоны через запятую)
+UserRow = Tuple[int, float, float, float, str]
+RebalanceHook = Callable[[], Awaitable[Any]]
+
+ABSENCE_LEASE = "absence"
+# обновление, пересланное владельцу, второй раз не пересылается
+FORWARDED_HEADER = "X-Geoshare-Forwarded-By"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class ClusterStore(abc.ABC):
+    # Общее хранилище инстансов: участники, аренды и состояние пользователей.
+    # Методы синхронные и вызываются из потока, как и у SqliteBackend
+    @abc.abstractmethod
+    def heartbeat(self, instance_id: str, address: str, expires: float):
+        ...
+
+    @abc.abstractmethod
+    def leave(self, instance_id: str):
+        ...
+
+    @abc.abstractmethod
+    def members(self, now: float) -> Dict[str, str]:
+        ...
+
+    @abc.abstractmethod
+    def acquire_lease(self, name: str, holder: str, expires: float, now: float) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def release_lease(self, name: str, holder: str):
+        ...
+
+    @abc.abstractmethod
+    def write(
+        self,
+        users: List[UserRow],
+        cleared: List[int],
+        notified: List[Tuple[int, int]],
+        upserts: List[LiveSession],
+        deletes: List[SessionKey],
+    ):
+        ...
+
+    @abc.abstractmethod
+    def fetch_user(self, user_id: int) -> Optional[UserState]:
+        ...
+
+    @abc.abstractmethod
+    def users_since(self, rev: int, limit: int) -> Tuple[List[Tuple[int, UserState]], int]:
+        ...
+
+    @abc.abstractmethod
+    def sessions(self) -> List[LiveSession]:
+        ...
+
+    def close(self):
+        pass
+
+
+class MemoryClusterStore(ClusterStore):
+    # Заглушка для нескольких ClusterNode в одном процессе: проверка маршрутизации и аренды без SQLite
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._members: Dict[str, Tuple[str, float]] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._users: Dict[int, Tuple[int, UserRow]] = {}
+        self._notified: Dict[int, set] = {}
+        self._sessions: Dict[SessionKey, LiveSession] = {}
+        self._rev = 0
+
+    def heartbeat(self, instance_id: str, address: str, expires: float):
+        with self._lock:
+            self._members[instance_id] = (address, expires)
+
+    def leave(self, instance_id: str):
+        with self._lock:
+            self._members.pop(instance_id, None)
+
+    def members(self, now: float) -> Dict[str, str]:
+        with self._lock:
+            return {i: addr for i, (addr, expires) in self._members.items() if expires > now}
+
+    def acquire_lease(self, name: str, holder: str, expires: float, now: float) -> bool:
+        with self._lock:
+            current = self._leases.get(name)
+            if current is not None and current[0] != holder and current[1] > now:
+                return False
+            self._leases[name] = (holder, expires)
+            return True
+
+    def release_lease(self, name: str, holder: str):
+        with self._lock:
+            if self._leases.get(name, ("",))[0] == holder:
+                del self._leases[name]
+
+    def write(self, users, cleared, notified, upserts, deletes):
+        with self._lock:
+            for user_id in cleared:
+                self._notified.pop(user_id, None)
+            for row in users:
+                old = self._users.get(row[0])
+                if old is not None and row[3] > old[1][3]:
+                    self._notified.pop(row[0], None)
+                self._rev += 1
+                self._users[row[0]] = (self._rev, row)
+            for user_id, admin_id in notified:
+                self._notified.setdefault(user_id, set()).add(admin_id)
+            for key in deletes:
+                self._sessions.pop(key, None)
+            for s in upserts:
+                self._sessions[(s.chat_id, s.message_id)] = s
+
+    def _state(self, row: UserRow) -> UserState:
+        state = make_state(*row[1:])
+        state.notified_admins = set(self._notified.get(row[0], ()))
+        return state
+
+    def fetch_user(self, user_id: int) -> Optional[UserState]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            return self._state(entry[1]) if entry is not None else None
+
+    def users_since(self, rev: int, limit: int) -> Tuple[List[Tuple[int, UserState]], int]:
+        with self._lock:
+            newer = sorted((r, row) for r, row in self._users.values() if r > rev)[:limit]
+            if newer:
+                rev = newer[-1][0]
+            return [(row[0], self._state(row)) for _, row in newer], rev
+
+    def sessions(self) -> List[LiveSession]:
+        with self._lock:
+            return list(self._sessions.values())
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cluster_members (
+    instance_id TEXT PRIMARY KEY,
+    address TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_users (
+    rev INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL UNIQUE,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    ts REAL NOT NULL,
+    zones TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_notified (
+    user_id INTEGER NOT NULL,
+    admin_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, admin_id)
+);
+CREATE TABLE IF NOT EXISTS cluster_sessions (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    started REAL NOT NULL,
+    live_period INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+"""
+
+# REPLACE по UNIQUE(user_id) удаляет старую строку и выдаёт новый rev из AUTOINCREMENT,
+# поэтому ведущий дочитывает изменения по возрастанию rev
+_USER_UPSERT = "INSERT OR REPLACE INTO cluster_users (user_id, lat, lng, ts, zones) VALUES (?, ?, ?, ?, ?)"
+# новая точка пользователя снимает отметки «⏰ Нет локации», даже если владелец о них не знал
+_USER_MOVED = """
+DELETE FROM cluster_notified WHERE user_id = ?
+AND ? > COALESCE((SELECT ts FROM cluster_users WHERE user_id = ?), 0)
+"""
+_USERS_SINCE = "SELECT rev, user_id, lat, lng, ts, zones FROM cluster_users WHERE rev > ? ORDER BY rev LIMIT ?"
+
+
+class SqliteClusterStore(ClusterStore):
+    # Один файл SQLite (WAL) на все инстансы одной машины; сетевые ФС блокировки SQLite не держат
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def _tx(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        with self._lock:
+            # IMMEDIATE берёт блокировку записи сразу: аренда проверяется и продлевается атомарно
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result
+
+    def heartbeat(self, instance_id: str, address: str, expires: float):
+        self._tx(lambda c: c.execute(
+            "INSERT OR REPLACE INTO cluster_members VALUES (?, ?, ?)", (instance_id, address, expires),
+        ))
+
+    def leave(self, instance_id: str):
+        self._tx(lambda c: c.execute("DELETE FROM cluster_members WHERE instance_id = ?", (instance_id,)))
+
+    def members(self, now: float) -> Dict[str, str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT instance_id, address FROM cluster_members WHERE expires > ?", (now,),
+            ).fetchall()
+        return dict(rows)
+
+    def acquire_lease(self, name: str, holder: str, expires: float, now: float) -> bool:
+        def acquire(c: sqlite3.Connection) -> bool:
+            row = c.execute("SELECT holder, expires FROM cluster_leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                return False
+            c.execute("INSERT OR REPLACE INTO cluster_leases VALUES (?, ?, ?)", (name, holder, expires))
+            return True
+
+        return self._tx(acquire)
+
+    def release_lease(self, name: str, holder: str):
+        self._tx(lambda c: c.execute("DELETE FROM cluster_leases WHERE name = ? AND holder = ?", (name, holder)))
+
+    def write(self, users, cleared, notified, upserts, deletes):
+        def write(c: sqlite3.Connection):
+            c.executemany("DELETE FROM cluster_notified WHERE user_id = ?", [(u,) for u in cleared])
+            c.executemany(_USER_MOVED, [(row[0], row[3], row[0]) for row in users])
+            c.executemany(_USER_UPSERT, users)
+            c.executemany("INSERT OR IGNORE INTO cluster_notified VALUES (?, ?)", notified)
+            c.executemany("DELETE FROM cluster_sessions WHERE chat_id = ? AND message_id = ?", deletes)
+            c.executemany("INSERT OR REPLACE INTO cluster_sessions VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (s.chat_id, s.message_id, s.user_id, s.user_name, s.started, s.live_period, s.expires)
+                for s in upserts
+            ])
+
+        self._tx(write)
+
+    def _notified_for(self, user_ids: Iterable[int]) -> Dict[int, set]:
+        notified: Dict[int, set] = {}
+        ids = list(user_ids)
+        # лимит SQLite на число параметров в запросе
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            sql = f"SELECT user_id, admin_id FROM cluster_notified WHERE user_id IN ({','.join('?' * len(chunk))})"
+            for user_id, admin_id in self._conn.execute(sql, chunk):
+                notified.setdefault(user_id, set()).add(admin_id)
+        return notified
+
+    def fetch_user(self, user_id: int) -> Optional[UserState]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lat, lng, ts, zones FROM cluster_users WHERE user_id = ?", (user_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            state = make_state(*row)
+            state.notified_admins = self._notified_for([user_id]).get(user_id, set())
+        return state
+
+    def users_since(self, rev: int, limit: int) -> Tuple[List[Tuple[int, UserState]], int]:
+        with self._lock:
+            rows = self._conn.execute(_USERS_SINCE, (rev, limit)).fetchall()
+            notified = self._notified_for(r[1] for r in rows)
+        out = []
+        for r, user_id, lat, lng, ts, zones in rows:
+            state = make_state(lat, lng, ts, zones)
+            state.notified_admins = notified.get(user_id, set())
+            out.append((user_id, state))
+            rev = r
+        return out, rev
+
+    def sessions(self) -> List[LiveSession]:
+        with self._lock:
+            return [LiveSession(*row) for row in self._conn.execute("SELECT * FROM cluster_sessions")]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ClusterStateBackend(StateBackend):
+    # Состояние инстанса в общем хранилище. Запись копится по ключу и уходит пакетом, как в SqliteBackend;
+    # при старте ничего не читается — пользователи подгружаются при первом обновлении
+    def __init__(self, store: ClusterStore, *, flush_interval: float = 1.0):
+        self.store = store
+        self.flush_interval = flush_interval
+        self._flush_lock = asyncio.Lock()
+        # строка снимается сразу: слот в UserStateTable может достаться другому пользователю до сброса
+        self._dirty_users: Dict[int, UserRow] = {}
+        self._cleared_notified: set = set()
+        self._added_notified: Dict[int, set] = {}
+        self._dirty_sessions: Dict[SessionKey, Optional[LiveSession]] = {}
+
+    def load(self) -> LoadedState:
+        return {}, []
+
+    def put_user(self, user_id: int, state: UserState):
+        self._dirty_users[user_id] = (
+            user_id, state.last_lat, state.last_lng,
+            state.last_time.timestamp(), encode_zones(state.current_zone_ids),
+        )
+
+    def put_session(self, session: LiveSession):
+        self._dirty_sessions[(session.chat_id, session.message_id)] = session
+
+    def remove_session(self, chat_id: int, message_id: int):
+        self._dirty_sessions[(chat_id, message_id)] = None
+
+    def add_notified(self, user_id: int, admin_id: int):
+        self._added_notified.setdefault(user_id, set()).add(admin_id)
+
+    def clear_notified(self, user_id: int):
+        self._cleared_notified.add(user_id)
+        self._added_notified.pop(user_id, None)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not (self._dirty_users or self._cleared_notified or self._added_notified or self._dirty_sessions):
+                return
+            batch = (self._dirty_users, self._cleared_notified, self._added_notified, self._dirty_sessions)
+            self._dirty_users = {}
+            self._cleared_notified = set()
+            self._added_notified = {}
+            self._dirty_sessions = {}
+            dirty_users, cleared, added, dirty_sessions = batch
+            users = list(dirty_users.values())
+            notified = [(u, a) for u, admins in added.items() for a in admins]
+            upserts = [s for s in dirty_sessions.values() if s is not None]
+            deletes = [k for k, s in dirty_sessions.items() if s is None]
+            try:
+                await asyncio.to_thread(self.store.write, users, list(cleared), notified, upserts, deletes)
+            except BaseException:
+                self._restore_batch(batch)
+                raise
+
+    def _restore_batch(self, batch):
+        # запись не прошла: пакет возвращается под то, что успело накопиться, — более новое важнее
+        users, cleared, added, sessions = batch
+        users.update(self._dirty_users)
+        sessions.update(self._dirty_sessions)
+        for user_id in self._cleared_notified:
+            added.pop(user_id, None)
+        for user_id, admins in self._added_notified.items():
+            added.setdefault(user_id, set()).update(admins)
+        self._dirty_users = users
+        self._cleared_notified = cleared | self._cleared_notified
+        self._added_notified = added
+        self._dirty_sessions = sessions
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.exception("Ошибка записи состояния в общее хранилище: %s", e)
+
+    async def close(self):
+        await self.flush()
+
+
+def _score(prefix: bytes, user_id: int) -> bytes:
+    return hashlib.blake2b(prefix + str(user_id).encode(), digest_size=8).digest()
+
+
+class ClusterNode:
+    def __init__(
+        self,
+        store: ClusterStore,
+        instance_id: str,
+        address: str,
+        *,
+        lease_ttl: float = 10.0,
+        flush_interval: float = 1.0,
+    ):
+        self.store = store
+        self.instance_id = instance_id
+        self.address = address.rstrip("/")
+        self.lease_ttl = lease_ttl
+        self.state = ClusterStateBackend(store, flush_interval=flush_interval)
+        self._members: Dict[str, str] = {}
+        self._prefixes: List[Tuple[bytes, str]] = []
+        self._lease_until = 0.0
+        self._leader = asyncio.Event()
+        self._follower = asyncio.Event()
+        self._follower.set()
+        self._hooks: List[RebalanceHook] = []
+        self._http = None
+        self.forwarded = 0
+        self.forward_failures = 0
+
+    @property
+    def interval(self) -> float:
+        return self.lease_ttl / 3.0
+
+    @property
+    def members(self) -> Dict[str, str]:
+        return self._members
+
+    @property
+    def is_leader(self) -> bool:
+        # аренда истекла, а продлить не удалось (хранилище недоступно) — уже не ведущий
+        return self._leader.is_set() and time.time() < self._lease_until
+
+    def owner_of(self, user_id: int) -> str:
+        # rendezvous-хеширование: при уходе инстанса переезжают только его пользователи
+        if not self._prefixes:
+            return self.instance_id
+        return max(self._prefixes, key=lambda p: _score(p[0], user_id))[1]
+
+    def owns(self, user_id: int) -> bool:
+        return self.owner_of(user_id) == self.instance_id
+
+    def add_rebalance_hook(self, hook: RebalanceHook):
+        self._hooks.append(hook)
+
+    async def wait_leader(self):
+        await self._leader.wait()
+
+    async def wait_follower(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._follower.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _round(self, now: float) -> Tuple[Dict[str, str], bool]:
+        self.store.heartbeat(self.instance_id, self.address, now + self.lease_ttl)
+        members = self.store.members(now)
+        leader = self.store.acquire_lease(ABSENCE_LEASE, self.instance_id, now + self.lease_ttl, now)
+        return members, leader
+
+    async def tick(self):
+        now = time.time()
+        members, leader = await asyncio.to_thread(self._round, now)
+        changed = members != self._members
+        if changed:
+            logging.info("Состав кластера: %s", ", ".join(sorted(members)))
+            self._members = members
+            self._prefixes = [(f"{i}:".encode(), i) for i in sorted(members)]
+
+        lost = False
+        if leader:
+            self._lease_until = now + self.lease_ttl
+            if not self._leader.is_set():
+                logging.info("Инстанс %s стал ведущим (absence)", self.instance_id)
+                self._follower.clear()
+                self._leader.set()
+        elif self._leader.is_set():
+            logging.info("Инстанс %s больше не ведущий", self.instance_id)
+            self._leader.clear()
+            self._follower.set()
+            lost = True
+
+        if changed or lost:
+            for hook in self._hooks:
+                await hook()
+
+    async def run(self):
+        while True:
+            try:
+                await self.tick()
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.exception("Ошибка связи с хранилищем кластера: %s", e)
+                await asyncio.sleep(self.interval)
+
+    async def fetch_user(self, user_id: int) -> Optional[UserState]:
+        return await asyncio.to_thread(self.store.fetch_user, user_id)
+
+    async def users_since(self, rev: int, limit: int = 10000) -> Tuple[List[Tuple[int, UserState]], int]:
+        return await asyncio.to_thread(self.store.users_since, rev, limit)
+
+    async def sessions(self) -> List[LiveSession]:
+        return await asyncio.to_thread(self.store.sessions)
+
+    async def forward(self, instance_id: str, path: str, body: bytes, secret: Optional[str]) -> bool:
+        address = self._members.get(instance_id)
+        if address is None:
+            return False
+        if self._http is None:
+            from aiohttp import ClientSession, ClientTimeout
+
+            self._http = ClientSession(timeout=ClientTimeout(total=5))
+        headers = {"Content-Type": "application/json", FORWARDED_HEADER: self.instance_id}
+        if secret:
+            headers[SECRET_HEADER] = secret
+        try:
+            async with self._http.post(address + path, data=body, headers=headers) as resp:
+                await resp.read()
+                ok = resp.status == 200
+        except Exception as e:
+            logging.warning("Не удалось переслать обновление инстансу %s: %s", instance_id, e)
+            ok = False
+        if ok:
+            self.forwarded += 1
+        else:
+            self.forward_failures += 1
+        return ok
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+        try:
+            await asyncio.to_thread(self.store.release_lease, ABSENCE_LEASE, self.instance_id)
+            await asyncio.to_thread(self.store.leave, self.instance_id)
+        except Exception as e:
+            logging.warning("Не удалось выйти из кластера: %s", e)
+        self.store.close()
+
+
+def update_user_id(body: bytes) -> Optional[int]:
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(update, dict):
+        return None
+    msg = update.get("message") or update.get("edited_message")
+    if not isinstance(msg, dict):
+        return None
+    user_id = (msg.get("from") or {}).get("id")
+    return user_id if isinstance(user_id, int) else None
+
+
+def open_cluster(path: Optional[str], instance_id: str, address: str, **kwargs) -> Optional[ClusterNode]:
+    if not path:
+        return None
+    return ClusterNode(SqliteClusterStore(path), instance_id, address, **kwargs)
@@ -1,6 +1,13 @@
+import gc
+import hashlib
 import json
 import logging
-from typing import List, Dict
+import math
+import mmap
+import os
+import pickle
+import struct
+from typing import List, Dict, Optional, Tuple
 
 from .models import (
     Zone,
@@ -14,6 +21,18 @@ from .models import (
     TelegramConfig,
     Config,
 )
+from . import geometry as _geometry, models as _models, routing as _routing, spatial as _spatial
+from .geometry import SHAPES, build_geometry
+from .routing import build_routing_table
+from .spatial import ZoneIndex
+
+
+# Кэш разобранного конфига: заголовок (метка, версия формата, sha256 от JSON и исходников
+# классов, которые лежат в кэше) и pickle готового Config вместе с индексом и маршрутизацией.
+# Любая правка config.json или этих модулей меняет ключ, и кэш просто пересобирается
+CACHE_MAGIC = b"GEOCFGC1"
+CACHE_VERSION = 1
+_CACHE_HEADER = struct.Struct("<8sI32s")
 
 
 def load_json_config(path: str) -> dict:
@@ -21,6 +40,99 @@ def load_json_config(path: str) -> dict:
         return json.load(f)
 
 
+def _cache_key(raw: bytes) -> bytes:
+    h = hashlib.sha256(raw)
+    for module in (_models, _geometry, _spatial, _routing):
+        with open(module.__file__, "rb") as f:
+            h.update(f.read())
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    return h.digest()
+
+
+def _read_cache(cache_path: str, key: bytes) -> Optional[Config]:
+    try:
+        f = open(cache_path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size <= _CACHE_HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if _CACHE_HEADER.unpack_from(mm) != (CACHE_MAGIC, CACHE_VERSION, key):
+                return None
+            # сотни тысяч объектов подряд: сборщик мусора на это время только мешает
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with memoryview(mm) as view, view[_CACHE_HEADER.size:] as body:
+                    return pickle.loads(body)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+
+def _write_cache(cache_path: str, key: bytes, cfg: Config):
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, key))
+        pickle.dump(cfg, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache_path)
+
+
+def load_config(path: str, cache_path: Optional[str] = None) -> Config:
+    with open(path, "rb") as f:
+        raw = f.read()
+    if not cache_path:
+        return parse_config(json.loads(raw))
+
+    key = _cache_key(raw)
+    try:
+        cfg = _read_cache(cache_path, key)
+    except Exception as e:
+        logging.warning("Кэш конфига %s не прочитан, разбираем JSON: %s", cache_path, e)
+        cfg = None
+    if cfg is not None:
+        logging.info("Конфиг загружен из кэша %s", cache_path)
+        return cfg
+
+    cfg = parse_config(json.loads(raw))
+    try:
+        _write_cache(cache_path, key, cfg)
+    except Exception as e:
+        logging.warning("Не удалось записать кэш конфига %s: %s", cache_path, e)
+    return cfg
+
+
+def zone_group_key(zone: Zone) -> tuple:
+    if zone.name:
+        return (zone.type, "name", zone.name)
+    return (zone.type, "id", zone.id)
+
+
+def _parse_points(raw) -> Tuple[Tuple[float, float], ...]:
+    points = []
+    for p in raw or []:
+        if isinstance(p, dict):
+            points.append((float(p.get("lat")), float(p.get("lng"))))
+        else:
+            lat, lng = p
+            points.append((float(lat), float(lng)))
+    return tuple(points)
+
+
+def _shared_notifications(shared: Dict[tuple, ZoneNotifications], notif_cfg: dict) -> ZoneNotifications:
+    key = (
+        bool(notif_cfg.get("override", False)),
+        bool(notif_cfg.get("notify_on_enter", False)),
+        bool(notif_cfg.get("notify_on_exit", False)),
+    )
+    notifications = shared.get(key)
+    if notifications is None:
+        notifications = shared[key] = ZoneNotifications(*key)
+    return notifications
+
+
 def parse_config(data: dict) -> Config:
     g = data.get("global", {})
     g_secure = g.get("secure", {}) or {}
@@ -31,10 +143,13 @@ def parse_config(data: dict) -> Config:
         secure_notify_enter=bool(g_secure.get("notify_enter", True)),
         danger_notify_exit=bool(g_danger.get("notify_exit", True)),
         danger_notify_enter=bool(g_danger.get("notify_enter", True)),
+        hysteresis_m=max(0.0, float(g.get("hysteresis_m", 0.0) or 0.0)),
     )
 
     zones_list: List[Zone] = []
     zones_by_id: Dict[int, Zone] = {}
+    # настройки уведомлений зон только читаются, одинаковые можно держать одним объектом
+    shared_notifications: Dict[tuple, ZoneNotifications] = {}
 
     for z in data.get("zones", []) or []:
         try:
@@ -45,10 +160,22 @@ def parse_config(data: dict) -> Config:
             if ztype not in ("secure", "danger"):
                 ztype = "secure"
             zname = z.get("name")
-            center = z.get("center", {}) or {}
-            lat = float(center.get("lat"))
-            lng = float(center.get("lng"))
-            radius_m = float(z.get("radius_m"))
+            shape = z.get("shape") or "circle"
+            if shape not in SHAPES:
+                raise ValueError(f"неизвестная форма {shape!r}")
+            points: Tuple[Tuple[float, float], ...] = ()
+            width_m = 0.0
+            geometry = None
+            if shape == "circle":
+                center = z.get("center", {}) or {}
+                lat = float(center.get("lat"))
+                lng = float(center.get("lng"))
+                radius_m = float(z.get("radius_m"))
+            else:
+                points = _parse_points(z.get("points"))
+                width_m = float(z.get("width_m") or 0.0)
+                geometry = build_geometry(shape, points, width_m)
+                lat, lng, radius_m = geometry.ref_lat, geometry.ref_lng, geometry.radius_m
             notif_cfg = z.get("notifications", {}) or {}
             zn = Zone(
                 id=zid,
@@ -57,11 +184,12 @@ def parse_config(data: dict) -> Config:
                 center_lat=lat,
                 center_lng=lng,
                 radius_m=radius_m,
-                notifications=ZoneNotifications(
-                    override=bool(notif_cfg.get("override", False)),
-                    notify_on_enter=bool(notif_cfg.get("notify_on_enter", False)),
-                    notify_on_exit=bool(notif_cfg.get("notify_on_exit", False)),
-                ),
+                notifications=_shared_notifications(shared_notifications, notif_cfg),
+                shape=shape,
+                points=points,
+                width_m=width_m,
+                geometry=geometry,
+                cos_lat=math.cos(math.radians(lat)),
             )
         except Exception as e:
             logging.warning("Не удалось распарсить зону %r: %s", z, e)
@@ -78,6 +206,8 @@ def parse_config(data: dict) -> Config:
         notify_absent_enabled=bool(tg_global.get("notify_absent_enabled", False)),
         notify_absent_minutes=int(tg_global.get("notify_absent_minutes", 10)),
         send_current_location_with_alert=bool(tg_global.get("send_current_location_with_alert", False)),
+        digest_window_s=max(0.0, float(tg_global.get("digest_window_s") or 0.0)),
+        digest_danger_immediate=bool(tg_global.get("digest_danger_immediate", True)),
     )
 
     admins = []
@@ -102,6 +232,8 @@ def parse_config(data: dict) -> Config:
             notify_absent_enabled=bool(a.get("notify_absent_enabled", False)),
             notify_absent_minutes=int(a.get("notify_absent_minutes", 10)),
             send_current_location_with_alert=bool(a.get("send_current_location_with_alert", False)),
+            digest_window_s=max(0.0, float(a.get("digest_window_s") or 0.0)),
+            digest_danger_immediate=bool(a.get("digest_danger_immediate", True)),
             zones=zones_ids,
         ))
 
@@ -137,4 +269,7 @@ def parse_config(data: dict) -> Config:
         zones=zones_list,
         zones_by_id=zones_by_id,
         telegram=telegram_cfg,
+        zone_index=ZoneIndex(zones_list, zone_global.hysteresis_m),
+        zone_group_keys={z.id: zone_group_key(z) for z in zones_list},
+        routing=build_routing_table(telegram_cfg),
     )
\ No newline at end of file
@@ -1,11 +1,16 @@
 import os
 import logging
-from typing import Dict, Set, Tuple
+import socket
+import tempfile
+from typing import List, Optional
 
 from aiogram import Bot, Dispatcher
 
-from .models import Config, UserState
-from .config_loader import load_json_config, parse_config
+from .models import Config, LiveSession
+from .state_table import UserStateTable
+from .config_loader import load_config
+from .storage import StateBackend, open_state_backend
+from .cluster import ClusterNode, open_cluster
 
 
 logging.basicConfig(
@@ -14,16 +19,86 @@ logging.basicConfig(
 )
 
 CONFIG_PATH = os.getenv("CONFIG_PATH", "config.json")
-CONFIG: Config = parse_config(load_json_config(CONFIG_PATH))
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))
+# пустое значение отключает кэш разобранного конфига
+CONFIG_CACHE_PATH = os.getenv("CONFIG_CACHE_PATH", CONFIG_PATH + ".cache")
+CONFIG: Config = load_config(CONFIG_PATH, CONFIG_CACHE_PATH)
 logging.info("Конфиг загружен: %d зон, %d админов", len(CONFIG.zones), len(CONFIG.telegram.admins))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("Переменная окружения BOT_TOKEN не задана")
 
+GEO_BATCH_WINDOW_MS = int(os.getenv("GEO_BATCH_WINDOW_MS", "0"))
+GEO_BATCH_MAX_SIZE = int(os.getenv("GEO_BATCH_MAX_SIZE", "512"))
+GEO_WORKERS = int(os.getenv("GEO_WORKERS", "0"))
+MAILBOX_MAX_PENDING = int(os.getenv("MAILBOX_MAX_PENDING", "10000"))
+
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "64"))
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "30"))
+DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", "1"))
+DELIVERY_CHAT_BURST = float(os.getenv("DELIVERY_CHAT_BURST", "3"))
+DELIVERY_MAX_RETRIES = int(os.getenv("DELIVERY_MAX_RETRIES", "5"))
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
+
+# общий файл состояния для нескольких инстансов за балансировщиком webhook
+CLUSTER_DB_PATH = os.getenv("CLUSTER_DB_PATH") or None
+CLUSTER_INSTANCE_ID = os.getenv("CLUSTER_INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# адрес, по которому другие инстансы пересылают этому обновления его пользователей
+CLUSTER_ADVERTISE_URL = os.getenv("CLUSTER_ADVERTISE_URL") or f"http://{socket.gethostname()}:{WEBHOOK_PORT}"
+CLUSTER_LEASE_TTL = float(os.getenv("CLUSTER_LEASE_TTL", "10"))
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# собирать метрики без HTTP-эндпоинта (нужно bot.replay)
+METRICS_COLLECT = os.getenv("METRICS_COLLECT", "0") == "1"
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+STATE_CHECKPOINT_ROWS = int(os.getenv("STATE_CHECKPOINT_ROWS", "100000"))
+
+HISTORY_DIR = os.getenv("HISTORY_DIR") or None
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))
+HISTORY_MAX_BUFFERED = int(os.getenv("HISTORY_MAX_BUFFERED", "100000"))
+
+# /profile N для админов: cProfile цикла событий на N секунд; по умолчанию команда не регистрируется
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SLOW_CALLBACK_MS = float(os.getenv("PROFILE_SLOW_CALLBACK_MS", "100"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", tempfile.gettempdir())
+
+LIVE_SWEEP_INTERVAL = float(os.getenv("LIVE_SWEEP_INTERVAL", "5"))
+LIVE_IDLE_TIMEOUT = float(os.getenv("LIVE_IDLE_TIMEOUT", "86400"))
+
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
 
-active_live_locations: Set[int] = set()
-user_states: Dict[int, UserState] = {}
-absent_notified: Set[Tuple[int, int]] = set()
\ No newline at end of file
+user_states: UserStateTable = UserStateTable()
+
+cluster: Optional[ClusterNode] = open_cluster(
+    CLUSTER_DB_PATH,
+    CLUSTER_INSTANCE_ID,
+    CLUSTER_ADVERTISE_URL,
+    lease_ttl=CLUSTER_LEASE_TTL,
+    flush_interval=STATE_FLUSH_INTERVAL,
+)
+if cluster is not None:
+    if STATE_DB_PATH:
+        logging.warning("Задан CLUSTER_DB_PATH: STATE_DB_PATH не используется")
+    state_store: StateBackend = cluster.state
+else:
+    state_store = open_state_backend(
+        STATE_DB_PATH,
+        flush_interval=STATE_FLUSH_INTERVAL,
+        checkpoint_rows=STATE_CHECKPOINT_ROWS,
+    )
+_users, _sessions = state_store.load()
+user_states.update(_users)
+# восстановленные live-сессии забирает таблица в handlers
+restored_sessions: List[LiveSession] = _sessions
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from functools import partial
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.types import FSInputFile
+
+from . import metrics
+from .context import (
+    bot,
+    DELIVERY_CONCURRENCY,
+    DELIVERY_GLOBAL_RATE,
+    DELIVERY_CHAT_RATE,
+    DELIVERY_CHAT_BURST,
+    DELIVERY_MAX_RETRIES,
+)
+
+Job = Callable[[], Awaitable]
+
+
+def _job_method(job: Job) -> str:
+    return getattr(getattr(job, "func", job), "__name__", "call")
+
+
+class TokenBucket:
+    # rate <= 0 — без ограничения (остаётся только пауза из hold)
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def hold(self, seconds: float):
+        # после паузы ведро начинает с нуля, а не выдаёт накопленный за неё всплеск
+        until = time.monotonic() + seconds
+        if until > self.paused_until:
+            self.paused_until = self.updated = until
+            self.tokens = 0.0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.rate <= 0:
+                return
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Delivery:
+    def __init__(
+        self,
+        bot: Bot,
+        *,
+        concurrency: int,
+        global_rate: float,
+        chat_rate: float,
+        chat_burst: float,
+        max_retries: int,
+    ):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._sem = asyncio.Semaphore(max(1, concurrency))
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, Deque[Job]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+
+    def queue_depth(self, chat_id: int) -> int:
+        q = self._queues.get(chat_id)
+        return len(q) if q else 0
+
+    def queue_depths(self) -> Dict[int, int]:
+        return {chat_id: len(q) for chat_id, q in self._queues.items() if q}
+
+    def submit(self, chat_id: int, job: Job):
+        self._queues.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+
+    def send_message(self, chat_id: int, text: str):
+        self.submit(chat_id, partial(self.bot.send_message, chat_id, text))
+
+    def send_location(self, chat_id: int, lat: float, lon: float):
+        self.submit(chat_id, partial(self.bot.send_location, chat_id, latitude=lat, longitude=lon))
+
+    def send_document(self, chat_id: int, path: str):
+        self.submit(chat_id, partial(self.bot.send_document, chat_id, FSInputFile(path)))
+
+    async def drain(self, timeout: Optional[float] = None):
+        workers = list(self._workers.values())
+        if workers:
+            await asyncio.wait(workers, timeout=timeout)
+
+    async def _worker(self, chat_id: int):
+        q = self._queues[chat_id]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while q:
+                await self._run(chat_id, q[0], bucket)
+                q.popleft()
+        finally:
+            self._workers.pop(chat_id, None)
+            if not q:
+                self._queues.pop(chat_id, None)
+
+    async def _run(self, chat_id: int, job: Job, bucket: TokenBucket):
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                async with self._sem:
+                    started = time.perf_counter()
+                    await job()
+                    metrics.telegram_request_seconds.observe(time.perf_counter() - started, _job_method(job))
+                return
+            except TelegramRetryAfter as e:
+                metrics.telegram_errors_total.inc(type(e).__name__)
+                delay = float(e.retry_after)
+                # flood limit Telegram общий на бота: остальные чаты тоже ждут, а не ловят свой RetryAfter
+                self._global_bucket.hold(delay)
+                logging.warning("Flood limit для чата %s, повтор через %.0f с", chat_id, delay)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                metrics.telegram_errors_total.inc(type(e).__name__)
+                delay = min(30.0, 2.0 ** attempt)
+                logging.warning("Ошибка сети при отправке в чат %s: %s", chat_id, e)
+            except Exception as e:
+                metrics.telegram_errors_total.inc(type(e).__name__)
+                metrics.send_failures_total.inc(chat_id)
+                logging.warning("Не удалось отправить сообщение админу %s: %s", chat_id, e)
+                return
+
+            attempt += 1
+            if attempt > self.max_retries:
+                metrics.send_failures_total.inc(chat_id)
+                logging.warning("Сообщение в чат %s отброшено после %d попыток", chat_id, attempt)
+                return
+            await asyncio.sleep(delay)
+
+
+delivery = Delivery(
+    bot,
+    concurrency=DELIVERY_CONCURRENCY,
+    global_rate=DELIVERY_GLOBAL_RATE,
+    chat_rate=DELIVERY_CHAT_RATE,
+    chat_burst=DELIVERY_CHAT_BURST,
+    max_retries=DELIVERY_MAX_RETRIES,
+)
+metrics.gauge_fn("bot_delivery_queued", "Сообщений в очередях отправки", lambda: sum(delivery.queue_depths().values()))
@@ -0,0 +1,92 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from . import metrics
+from .delivery import delivery
+
+
+# предел Telegram на длину текста одного сообщения
+MAX_MESSAGE_LEN = 4096
+
+Entry = Tuple[str, Optional[Tuple[float, float]]]
+
+
+def pack_blocks(header: str, blocks: List[str], sep: str = "\n\n") -> List[str]:
+    # длинная сводка режется по границам событий, а не посреди текста
+    messages: List[str] = []
+    current = header
+    for block in blocks:
+        if len(current) + len(sep) + len(block) > MAX_MESSAGE_LEN:
+            messages.append(current)
+            current = block[:MAX_MESSAGE_LEN]
+        else:
+            current = f"{current}{sep}{block}"
+    messages.append(current)
+    return messages
+
+
+def format_location(location: Tuple[float, float]) -> str:
+    return f"📍 {location[0]:.6f}, {location[1]:.6f}"
+
+
+def render_digest(entries: List[Entry], window_s: float) -> List[str]:
+    header = f"🗂 Сводка за {window_s:g} с: событий {len(entries)}"
+    blocks = []
+    for text, location in entries:
+        if location is not None:
+            text = f"{text}\n{format_location(location)}"
+        blocks.append(text)
+    return pack_blocks(header, blocks)
+
+
+class DigestBuffer:
+    def __init__(self):
+        self._entries: Dict[int, List[Entry]] = {}
+        self._windows: Dict[int, float] = {}
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self.merged = 0
+        self.sent = 0
+
+    def pending(self) -> int:
+        return sum(len(e) for e in self._entries.values())
+
+    def add(self, chat_id: int, window_s: float, text: str, location: Optional[Tuple[float, float]] = None):
+        entries = self._entries.get(chat_id)
+        if entries is None:
+            # окно открывается первым событием и не продлевается следующими
+            entries = self._entries[chat_id] = []
+            self._windows[chat_id] = window_s
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(window_s, self.flush, chat_id)
+        entries.append((text, location))
+
+    def flush(self, chat_id: int):
+        timer = self._timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        window_s = self._windows.pop(chat_id, 0.0)
+        entries = self._entries.pop(chat_id, None)
+        if not entries:
+            return
+
+        if len(entries) == 1:
+            # одиночное событие уходит как обычное уведомление
+            text, location = entries[0]
+            delivery.send_message(chat_id, text)
+            if location is not None:
+                delivery.send_location(chat_id, *location)
+            return
+
+        for text in render_digest(entries, window_s):
+            delivery.send_message(chat_id, text)
+            self.sent += 1
+        self.merged += len(entries)
+
+    def flush_all(self):
+        for chat_id in list(self._entries):
+            self.flush(chat_id)
+
+
+digest = DigestBuffer()
+metrics.gauge_fn("bot_digest_pending", "Событий, ожидающих отправки в сводке", digest.pending)
+metrics.counter_fn("bot_digest_merged_total", "Событий, отправленных в составе сводок", lambda: digest.merged)
+metrics.counter_fn("bot_digest_messages_total", "Отправленных сообщений-сводок", lambda: digest.sent)
@@ -1,9 +1,46 @@
 import math
-from datetime import datetime, timezone
-from typing import Set, Tuple
-from .context import CONFIG, user_states, absent_notified
-from .models import UserState
+import time
+from typing import AbstractSet, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from .config_loader import zone_group_key
+from .geometry import MARGIN_SCALE
+from . import context, metrics
+from .context import user_states, state_store
+from .models import Config
 from .models import Zone
+from .spatial import METERS_PER_DEG_LAT
+
+# numpy нужен только пакетной проверке и подгружается при первом пакете, а не при старте бота
+np = None
+_numpy_missing = False
+
+# ограничение на размер матрицы точки×зоны в одном векторном проходе
+BATCH_MAX_CELLS = 1_000_000
+
+# Перед haversine_m расстояние оценивается плоской (equirectangular) проекцией с cos
+# средней широты. Ближе FAST_REACH_M и не выше FAST_MAX_LAT её относительная ошибка
+# меньше FAST_EPS (по замеру — до 3.5e-4), так что оценки с запасом FAST_EPS хватает,
+# чтобы решить «внутри/снаружи»; точный haversine_m остаётся для узкой полосы у границы,
+# далёких и приполярных точек
+FAST_REACH_M = 50_000.0
+FAST_EPS = 1e-3
+FAST_MAX_LAT = 80.0
+_FAST_REACH_M2 = FAST_REACH_M * FAST_REACH_M
+_FAST_MIN_COS = math.cos(math.radians(FAST_MAX_LAT))
+_HALF_M_PER_DEG = METERS_PER_DEG_LAT / 2.0
+
+metrics.gauge_fn("bot_tracked_users", "Пользователей с известной позицией", lambda: len(user_states))
+
+def _load_numpy() -> bool:
+    global np, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+        else:
+            np = numpy
+    return np is not None
+
 
 def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     r = 6371000.0
@@ -16,66 +53,355 @@ def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return r * c
 
 
+def approx_distance2_m(lat1: float, lon1: float, cos1: float, lat2: float, lon2: float, cos2: float) -> float:
+    # квадрат расстояния в плоской проекции; cos1/cos2 — косинусы широт точек
+    dlng = lon2 - lon1
+    if not -180.0 <= dlng <= 180.0:
+        dlng = (dlng + 180.0) % 360.0 - 180.0
+    dx = dlng * (cos1 + cos2) * _HALF_M_PER_DEG
+    dy = (lat2 - lat1) * METERS_PER_DEG_LAT
+    return dx * dx + dy * dy
+
+
+def zone_signed_distance(
+    zone: Zone,
+    lat: float,
+    lon: float,
+    slack: float = 0.0,
+    cos_lat: Optional[float] = None,
+) -> float:
+    # расстояние до границы зоны, м: < 0 внутри, > 0 снаружи. Если точка заведомо
+    # внутри или дальше slack снаружи, вместо точного значения может вернуться
+    # оценка, меньшая по модулю, — сторона границы при этом верная
+    geometry = zone.geometry
+    if geometry is not None:
+        return geometry.signed_distance(lat, lon, slack)
+
+    zone_cos = zone.cos_lat
+    if zone_cos >= _FAST_MIN_COS:
+        if cos_lat is None:
+            cos_lat = math.cos(math.radians(lat))
+        # то же, что approx_distance2_m, без лишнего вызова на самом горячем месте
+        dlng = lon - zone.center_lng
+        if not -180.0 <= dlng <= 180.0:
+            dlng = (dlng + 180.0) % 360.0 - 180.0
+        dx = dlng * (zone_cos + cos_lat) * _HALF_M_PER_DEG
+        dy = (lat - zone.center_lat) * METERS_PER_DEG_LAT
+        d2 = dx * dx + dy * dy
+        if d2 < _FAST_REACH_M2:
+            d = math.sqrt(d2)
+            lower = d * (1.0 - FAST_EPS) - zone.radius_m
+            if lower > slack:
+                return lower
+            upper = d * (1.0 + FAST_EPS) - zone.radius_m
+            if upper <= 0.0:
+                return upper
+    return haversine_m(lat, lon, zone.center_lat, zone.center_lng) - zone.radius_m
+
+
+def _zones_membership_python(
+    points: Sequence[Tuple[float, float]],
+    zones: Sequence[Zone],
+) -> List[Set[int]]:
+    result = []
+    for lat, lon in points:
+        inside = set()
+        cos_lat = math.cos(math.radians(lat))
+        for z in zones:
+            if zone_signed_distance(z, lat, lon, 0.0, cos_lat) <= 0.0:
+                inside.add(z.id)
+        result.append(inside)
+    return result
+
+
+def _zones_membership_numpy(
+    points: Sequence[Tuple[float, float]],
+    zones: Sequence[Zone],
+) -> List[Set[int]]:
+    shaped = [z for z in zones if z.geometry is not None]
+    if shaped:
+        circles = [z for z in zones if z.geometry is None]
+        result = _zones_membership_numpy(points, circles) if circles else [set() for _ in points]
+        for inside, extra in zip(result, _zones_membership_python(points, shaped)):
+            inside |= extra
+        return result
+
+    r = 6371000.0
+    ids = np.array([z.id for z in zones], dtype=np.int64)
+    zlat = np.radians(np.array([z.center_lat for z in zones], dtype=np.float64))
+    zlng = np.radians(np.array([z.center_lng for z in zones], dtype=np.float64))
+    zrad = np.array([z.radius_m for z in zones], dtype=np.float64)
+    cos_zlat = np.cos(zlat)
+
+    pts = np.radians(np.array(points, dtype=np.float64))
+    step = max(1, BATCH_MAX_CELLS // len(zones))
+    result: List[Set[int]] = []
+    for start in range(0, len(pts), step):
+        plat = pts[start:start + step, 0:1]
+        plng = pts[start:start + step, 1:2]
+        a = np.sin((zlat - plat) / 2) ** 2 \
+            + np.cos(plat) * cos_zlat * np.sin((zlng - plng) / 2) ** 2
+        dist = 2 * r * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        inside = dist <= zrad
+        for row in inside:
+            result.append(set(ids[row].tolist()))
+    return result
+
+
+def zones_membership_batch(
+    points: Sequence[Tuple[float, float]],
+    zones: Sequence[Zone],
+) -> List[Set[int]]:
+    if not points:
+        return []
+    if not zones:
+        return [set() for _ in points]
+    if not _load_numpy():
+        return _zones_membership_python(points, zones)
+    return _zones_membership_numpy(points, zones)
+
+
 def _zone_group_key(zone: Zone):
-    if zone.name:
-        return (zone.type, "name", zone.name)
-    return (zone.type, "id", zone.id)
+    return zone_group_key(zone)
+
+
+Anchor = Tuple[Tuple[int, int], float, float, float]
+
+
+def _evaluate_zones(cfg: Config, lat: float, lon: float, prev_zones: Set[int]) -> Tuple[Set[int], float]:
+    hysteresis = cfg.zone_global.hysteresis_m
+    new_zones: Set[int] = set()
+    margin = math.inf
+    candidates = cfg.zone_index.candidates(lat, lon)
+    cos_lat = math.cos(math.radians(lat)) if candidates else 1.0
+    for z in candidates:
+        sd = zone_signed_distance(z, lat, lon, hysteresis, cos_lat)
+        if sd <= (hysteresis if z.id in prev_zones else 0.0):
+            new_zones.add(z.id)
+            edge = hysteresis - sd
+        else:
+            edge = sd
+        if z.geometry is not None:
+            edge *= MARGIN_SCALE
+        margin = min(margin, edge)
+    return new_zones, margin
 
 
+def _still_in_same_zones(user_id: int, cell: Tuple[int, int], lat: float, lon: float) -> bool:
+    # ячейка индекса, точка последнего полного пересчёта, запас до ближайшей границы, м
+    cached = user_states.anchor(user_id)
+    if cached is None or cached[0] != cell:
+        return False
+    _, anchor_lat, anchor_lng, margin = cached
+    anchor_cos = math.cos(math.radians(anchor_lat))
+    if anchor_cos >= _FAST_MIN_COS and margin < FAST_REACH_M:
+        d2 = approx_distance2_m(anchor_lat, anchor_lng, anchor_cos, lat, lon, math.cos(math.radians(lat)))
+        if d2 * (1.0 + FAST_EPS) ** 2 < margin * margin:
+            return True
+        if d2 * (1.0 - FAST_EPS) ** 2 >= margin * margin:
+            return False
+    return haversine_m(anchor_lat, anchor_lng, lat, lon) < margin
+
+
+@metrics.timed(metrics.geo_update_seconds)
 def update_user_state(user_id: int, lat: float, lon: float) -> Tuple[Set[int], Set[int]]:
-    now = datetime.now(timezone.utc)
+    cfg = context.CONFIG
     prev_state = user_states.get(user_id)
     prev_zones = prev_state.current_zone_ids if prev_state else set()
 
-    new_zones: Set[int] = set()
-    for z in CONFIG.zones:
-        dist = haversine_m(lat, lon, z.center_lat, z.center_lng)
-        if dist <= z.radius_m:
-            new_zones.add(z.id)
+    cell = cfg.zone_index.cell_of(lat, lon)
+    if prev_state is not None and _still_in_same_zones(user_id, cell, lat, lon):
+        return _apply_user_zones(cfg, user_id, lat, lon, prev_zones)
+
+    new_zones, margin = _evaluate_zones(cfg, lat, lon, prev_zones)
+    return _apply_user_zones(cfg, user_id, lat, lon, new_zones, (cell, lat, lon, margin))
 
-    prev_groups = {}
-    for zid in prev_zones:
-        zone = CONFIG.zones_by_id.get(zid)
-        if not zone:
-            continue
-        key = _zone_group_key(zone)
-        prev_groups.setdefault(key, []).append(zid)
 
-    new_groups = {}
-    for zid in new_zones:
-        zone = CONFIG.zones_by_id.get(zid)
-        if not zone:
+def reconcile_user_zones(user_ids: Iterable[int]) -> List[int]:
+    cfg = context.CONFIG
+    changed: List[int] = []
+    for user_id in user_ids:
+        user_states.clear_anchor(user_id)
+        state = user_states.get(user_id)
+        if state is None:
+            continue
+        prev_zones = {zid for zid in state.current_zone_ids if zid in cfg.zones_by_id}
+        new_zones, _ = _evaluate_zones(cfg, state.last_lat, state.last_lng, prev_zones)
+        if new_zones == state.current_zone_ids:
             continue
-        key = _zone_group_key(zone)
-        new_groups.setdefault(key, []).append(zid)
+        user_states.set_zones(user_id, new_zones)
+        state_store.put_user(user_id, state)
+        changed.append(user_id)
+    return changed
+
+
+@metrics.timed(metrics.geo_batch_seconds)
+def update_user_states_batch(
+    updates: Sequence[Tuple[int, float, float]],
+) -> List[Tuple[Set[int], Set[int]]]:
+    if not _load_numpy():
+        return [update_user_state(user_id, lat, lon) for user_id, lat, lon in updates]
+
+    cfg = context.CONFIG
+    # повтор того же пользователя в пакете должен видеть результат предыдущего обновления
+    results: List[Tuple[Set[int], Set[int]]] = []
+    segment: List[Tuple[int, float, float]] = []
+    seen: Set[int] = set()
+    for upd in updates:
+        if upd[0] in seen:
+            results.extend(_update_segment(cfg, segment))
+            segment, seen = [], set()
+        segment.append(upd)
+        seen.add(upd[0])
+    results.extend(_update_segment(cfg, segment))
+    return results
+
+
+def _update_segment(
+    cfg: Config,
+    updates: Sequence[Tuple[int, float, float]],
+) -> List[Tuple[Set[int], Set[int]]]:
+    results: List = [None] * len(updates)
+    cells = [cfg.zone_index.cell_of(lat, lon) for _, lat, lon in updates]
+
+    pending: List[int] = []
+    for i, (user_id, lat, lon) in enumerate(updates):
+        prev_state = user_states.get(user_id)
+        if prev_state is not None and _still_in_same_zones(user_id, cells[i], lat, lon):
+            results[i] = _apply_user_zones(cfg, user_id, lat, lon, prev_state.current_zone_ids)
+        else:
+            pending.append(i)
+    if not pending:
+        return results
 
-    prev_group_keys = set(prev_groups.keys())
-    new_group_keys = set(new_groups.keys())
+    hysteresis = cfg.zone_global.hysteresis_m
+    memberships: List[Set[int]] = [set() for _ in updates]
+    margins: List[float] = [math.inf] * len(updates)
 
-    entered_groups = new_group_keys - prev_group_keys
-    exited_groups = prev_group_keys - new_group_keys
+    # круги считаются векторно парами (точка, зона), многоугольники и коридоры — по одному
+    point_idx: List[int] = []
+    zones: List[Zone] = []
+    was_inside: List[bool] = []
+    for i in pending:
+        user_id, lat, lon = updates[i]
+        prev_state = user_states.get(user_id)
+        prev_zones = prev_state.current_zone_ids if prev_state else ()
+        for z in cfg.zone_index.candidates(lat, lon):
+            if z.geometry is None:
+                point_idx.append(i)
+                zones.append(z)
+                was_inside.append(z.id in prev_zones)
+                continue
+            sd = z.geometry.signed_distance(lat, lon, hysteresis)
+            if sd <= (hysteresis if z.id in prev_zones else 0.0):
+                memberships[i].add(z.id)
+                edge = hysteresis - sd
+            else:
+                edge = sd
+            margins[i] = min(margins[i], edge * MARGIN_SCALE)
+    if zones:
+        pi = np.array(point_idx, dtype=np.int64)
+        pts = np.array([(lat, lon) for _, lat, lon in updates], dtype=np.float64)
+        plat = pts[pi, 0]
+        plng = pts[pi, 1]
+        pcos = np.cos(np.radians(pts[:, 0]))[pi]
+        zlat = np.array([z.center_lat for z in zones], dtype=np.float64)
+        zlng = np.array([z.center_lng for z in zones], dtype=np.float64)
+        zcos = np.array([z.cos_lat for z in zones], dtype=np.float64)
+        zrad = np.array([z.radius_m for z in zones], dtype=np.float64)
+        dist = _pair_distances_np(plat, plng, pcos, zlat, zlng, zcos, zrad, hysteresis)
+        inside = dist <= np.where(np.array(was_inside, dtype=bool), zrad + hysteresis, zrad)
+        edge = np.where(inside, zrad + hysteresis - dist, dist - zrad)
+
+        starts = np.flatnonzero(np.r_[True, pi[1:] != pi[:-1]])
+        for i, m in zip(pi[starts].tolist(), np.minimum.reduceat(edge, starts).tolist()):
+            margins[i] = min(margins[i], m)
+        for k in np.flatnonzero(inside).tolist():
+            memberships[point_idx[k]].add(zones[k].id)
+
+    for i in pending:
+        user_id, lat, lon = updates[i]
+        anchor = (cells[i], lat, lon, margins[i])
+        results[i] = _apply_user_zones(cfg, user_id, lat, lon, memberships[i], anchor)
+    return results
+
+
+def _pair_distances_np(plat, plng, pcos, zlat, zlng, zcos, zrad, slack: float):
+    # расстояния от точек до центров зон по парам (градусы на входе); там, где плоская
+    # оценка уже решает «внутри/снаружи», вместо точного значения стоит оценка
+    # с запасом в нужную сторону, haversine считается только для остальных пар
+    dlng = (plng - zlng + 180.0) % 360.0 - 180.0
+    dx = dlng * (pcos + zcos) * _HALF_M_PER_DEG
+    dy = (plat - zlat) * METERS_PER_DEG_LAT
+    approx = np.sqrt(dx * dx + dy * dy)
+    lower = approx * (1.0 - FAST_EPS)
+    upper = approx * (1.0 + FAST_EPS)
+    far = lower - zrad > slack
+    dist = np.where(far, lower, upper)
+    exact = (zcos < _FAST_MIN_COS) | (approx >= FAST_REACH_M) | (~far & (upper > zrad))
+    if exact.any():
+        r = 6371000.0
+        lat1 = np.radians(plat[exact])
+        lat2 = np.radians(zlat[exact])
+        a = np.sin((lat2 - lat1) / 2) ** 2 \
+            + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(zlng[exact] - plng[exact]) / 2) ** 2
+        dist[exact] = 2 * r * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return dist
+
+
+def _group_zone_ids(cfg: Config, zone_ids: AbstractSet[int]) -> Dict[tuple, int]:
+    keys = cfg.zone_group_keys
+    groups: Dict[tuple, int] = {}
+    for zid in zone_ids:
+        key = keys.get(zid)
+        if key is not None and (key not in groups or zid < groups[key]):
+            groups[key] = zid
+    return groups
+
+
+def _apply_user_zones(
+    cfg: Config,
+    user_id: int,
+    lat: float,
+    lon: float,
+    new_zones: AbstractSet[int],
+    anchor: Optional[Anchor] = None,
+) -> Tuple[Set[int], Set[int]]:
+    prev_state = user_states.get(user_id)
+    prev_zones = prev_state.current_zone_ids if prev_state else frozenset()
 
     entered_final: Set[int] = set()
     exited_final: Set[int] = set()
 
-    for key in entered_groups:
-        ids_for_group = new_groups.get(key)
-        if ids_for_group:
-            entered_final.add(ids_for_group[0])
+    if new_zones != prev_zones:
+        prev_groups = _group_zone_ids(cfg, prev_zones)
+        new_groups = _group_zone_ids(cfg, new_zones)
 
-    for key in exited_groups:
-        ids_for_group = prev_groups.get(key)
-        if ids_for_group:
-            exited_final.add(ids_for_group[0])
+        for key, zid in new_groups.items():
+            if key not in prev_groups:
+                entered_final.add(zid)
+        for key, zid in prev_groups.items():
+            if key not in new_groups:
+                exited_final.add(zid)
 
-    user_states[user_id] = UserState(
-        last_lat=lat,
-        last_lng=lon,
-        last_time=now,
-        current_zone_ids=new_zones,
-    )
+    record_user_position(user_id, lat, lon, time.time(), new_zones)
+    if anchor is not None:
+        user_states.set_anchor(user_id, *anchor)
 
-    global absent_notified
-    absent_notified = {pair for pair in absent_notified if pair[0] != user_id}
+    return entered_final, exited_final
+
+
+def record_user_position(
+    user_id: int,
+    lat: float,
+    lon: float,
+    ts: float,
+    zone_ids: Iterable[int],
+):
+    prev_state = user_states.get(user_id)
+    had_notified = prev_state is not None and prev_state.has_notified()
 
-    return entered_final, exited_final
\ No newline at end of file
+    state = user_states.set_position(user_id, lat, lon, ts, zone_ids)
+    state_store.put_user(user_id, state)
+    if had_notified:
+        state_store.clear_notified(user_id)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import math
+from dataclasses import dataclass
+from typing import Sequence, Tuple
+
+from .spatial import METERS_PER_DEG_LAT
+
+
+Point = Tuple[float, float]
+# начало отрезка, вектор отрезка и 1/|вектор|² в локальных метрах
+Edge = Tuple[float, float, float, float, float]
+
+SHAPES = ("circle", "polygon", "corridor")
+
+# плоская проекция вокруг центра зоны искажает расстояния на доли процента;
+# запас до границы для кэша в geo берём с поправкой, чтобы не проскочить границу
+MARGIN_SCALE = 0.99
+
+
+def _wrap_lng(dlng: float) -> float:
+    if -180.0 <= dlng <= 180.0:
+        return dlng
+    return (dlng + 180.0) % 360.0 - 180.0
+
+
+@dataclass(frozen=True)
+class ZoneGeometry:
+    kind: str
+    ref_lat: float
+    ref_lng: float
+    kx: float
+    edges: Tuple[Edge, ...]
+    half_width: float
+    # рамка вершин в локальных метрах (без ширины коридора) и в градусах (с шириной)
+    box: Tuple[float, float, float, float]
+    bbox: Tuple[float, float, float, float]
+    radius_m: float
+
+    def project(self, lat: float, lng: float) -> Point:
+        return _wrap_lng(lng - self.ref_lng) * self.kx, (lat - self.ref_lat) * METERS_PER_DEG_LAT
+
+    def signed_distance(self, lat: float, lng: float, slack: float = 0.0) -> float:
+        # < 0 — внутри; для точек дальше slack от рамки возвращается нижняя оценка
+        x, y = self.project(lat, lng)
+        x0, y0, x1, y1 = self.box
+        bx = x0 - x if x < x0 else (x - x1 if x > x1 else 0.0)
+        by = y0 - y if y < y0 else (y - y1 if y > y1 else 0.0)
+        if bx or by:
+            lower = math.sqrt(bx * bx + by * by) - self.half_width
+            if lower > slack:
+                return lower
+
+        best = math.inf
+        if self.kind == "corridor":
+            for ax, ay, dx, dy, inv in self.edges:
+                px = x - ax
+                py = y - ay
+                t = (px * dx + py * dy) * inv
+                if t < 0.0:
+                    t = 0.0
+                elif t > 1.0:
+                    t = 1.0
+                ex = px - t * dx
+                ey = py - t * dy
+                d2 = ex * ex + ey * ey
+                if d2 < best:
+                    best = d2
+            return math.sqrt(best) - self.half_width
+
+        inside = False
+        for ax, ay, dx, dy, inv in self.edges:
+            px = x - ax
+            py = y - ay
+            if (ay > y) != (ay + dy > y) and px < py * dx / dy:
+                inside = not inside
+            t = (px * dx + py * dy) * inv
+            if t < 0.0:
+                t = 0.0
+            elif t > 1.0:
+                t = 1.0
+            ex = px - t * dx
+            ey = py - t * dy
+            d2 = ex * ex + ey * ey
+            if d2 < best:
+                best = d2
+        d = math.sqrt(best)
+        return -d if inside else d
+
+    def contains(self, lat: float, lng: float) -> bool:
+        return self.signed_distance(lat, lng) <= 0.0
+
+
+def build_geometry(kind: str, points: Sequence[Point], width_m: float = 0.0) -> ZoneGeometry:
+    if kind == "polygon":
+        if len(points) > 3 and points[0] == points[-1]:
+            points = points[:-1]
+        if len(points) < 3:
+            raise ValueError("у многоугольника должно быть хотя бы 3 вершины")
+    elif kind == "corridor":
+        if len(points) < 2:
+            raise ValueError("у коридора должно быть хотя бы 2 точки")
+        if width_m <= 0:
+            raise ValueError("у коридора должна быть ширина width_m > 0")
+    else:
+        raise ValueError(f"неизвестная форма зоны {kind!r}")
+
+    lats = [p[0] for p in points]
+    ref_lat = (min(lats) + max(lats)) / 2.0
+    ref_lng = points[0][1]
+    lngs = [ref_lng + _wrap_lng(p[1] - ref_lng) for p in points]
+    ref_lng = (min(lngs) + max(lngs)) / 2.0
+    kx = METERS_PER_DEG_LAT * max(1e-6, math.cos(math.radians(ref_lat)))
+
+    xy = [((lng - ref_lng) * kx, (lat - ref_lat) * METERS_PER_DEG_LAT) for lat, lng in zip(lats, lngs)]
+    pairs = list(zip(xy, xy[1:] + xy[:1])) if kind == "polygon" else list(zip(xy, xy[1:]))
+    edges = []
+    for (ax, ay), (bx, by) in pairs:
+        dx, dy = bx - ax, by - ay
+        len2 = dx * dx + dy * dy
+        edges.append((ax, ay, dx, dy, 1.0 / len2 if len2 > 0 else 0.0))
+
+    half_width = width_m / 2.0 if kind == "corridor" else 0.0
+    xs = [p[0] for p in xy]
+    ys = [p[1] for p in xy]
+    dlat = half_width / METERS_PER_DEG_LAT
+    dlng = half_width / kx
+    radius = max(math.hypot(x, y) for x, y in xy) + half_width
+
+    return ZoneGeometry(
+        kind=kind,
+        ref_lat=ref_lat,
+        ref_lng=ref_lng,
+        kx=kx,
+        edges=tuple(edges),
+        half_width=half_width,
+        box=(min(xs), min(ys), max(xs), max(ys)),
+        bbox=(
+            max(-90.0, min(lats) - dlat),
+            min(lngs) - dlng,
+            min(90.0, max(lats) + dlat),
+            max(lngs) + dlng,
+        ),
+        radius_m=radius,
+    )
@@ -1,18 +1,39 @@
 import logging
-from typing import Optional
+from typing import List, Optional
 
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 
-from .context import dp, CONFIG, active_live_locations
-from .geo import update_user_state, user_states
+from . import context, metrics
+from .context import (
+    dp,
+    cluster,
+    restored_sessions,
+    MAILBOX_MAX_PENDING,
+    LIVE_SWEEP_INTERVAL,
+    LIVE_IDLE_TIMEOUT,
+    PROFILE_ENABLED,
+    PROFILE_MAX_SECONDS,
+    PROFILE_SLOW_CALLBACK_MS,
+    PROFILE_DIR,
+)
+from .geo import user_states
+from .batching import geo_batcher
+from .delivery import delivery
+from .absence import absence_scheduler
+from .history import history
+from .mailbox import UserMailbox
+from .models import Event, EventKind, LiveSession
 from .notify import (
     is_sender_allowed,
     send_event_to_admins,
-    describe_zone,
     get_effective_zone_notify,
 )
+from .profiling import Profiler
+from .sessions import LiveSessionTable
 
 
+@metrics.timed(metrics.update_seconds)
 async def handle_location_event(
     msg: Message,
     *,
@@ -31,15 +52,25 @@ async def handle_location_event(
     lat = msg.location.latitude
     lon = msg.location.longitude
 
-    entered, exited = update_user_state(user_id, lat, lon)
+    if cluster is not None and user_id not in user_states:
+        # пользователь мог переехать с другого инстанса — продолжаем с его состояния, а не с чистого листа
+        adopted = await cluster.fetch_user(user_id)
+        if adopted is not None and user_id not in user_states:
+            user_states[user_id] = adopted
+
+    entered, exited = await geo_batcher.submit(user_id, lat, lon)
+    cfg = context.CONFIG
     state = user_states.get(user_id)
     current_zone_ids = state.current_zone_ids if state else set()
+    if state:
+        absence_scheduler.touch(user_id, state.last_time)
+        history.record(user_id, lat, lon, kind, state.last_ts)
 
     secure_zone_for_msg = None
     danger_zone_for_msg = None
 
     for zid in current_zone_ids:
-        zone = CONFIG.zones_by_id.get(zid)
+        zone = cfg.zones_by_id.get(zid)
         if not zone:
             continue
         if zone.type == "secure" and secure_zone_for_msg is None:
@@ -47,74 +78,120 @@ async def handle_location_event(
         if zone.type == "danger" and danger_zone_for_msg is None:
             danger_zone_for_msg = zone
 
-    if kind == "start":
-        if secure_zone_for_msg and not danger_zone_for_msg:
-            text = f"▶️ Начал вещание из безопасной зоны {describe_zone(secure_zone_for_msg)}"
-        elif danger_zone_for_msg and not secure_zone_for_msg:
-            text = f"▶️ Начал вещание из опасной зоны {describe_zone(danger_zone_for_msg)}"
-        elif secure_zone_for_msg and danger_zone_for_msg:
-            text = "▶️ Начал вещание: одновременно в безопасной и опасной зоне"
-        else:
-            text = "▶️ Начал вещание вне заданных зон"
-
-        await send_event_to_admins(
-            text,
-            sender_id=user_id,
-            sender_name=full_name,
-            is_start_stop_absent=True,
-        )
+    events: List[Event] = []
 
+    if kind == "start":
+        events.append(Event(
+            EventKind.LOCATION_START,
+            user_id,
+            full_name,
+            secure_zone=secure_zone_for_msg,
+            danger_zone=danger_zone_for_msg,
+        ))
     elif kind == "end":
-        await send_event_to_admins(
-            "⏹ Окончание вещания live-location",
-            sender_id=user_id,
-            sender_name=full_name,
-            location=(lat, lon),
-            is_start_stop_absent=True,
-        )
+        events.append(Event(EventKind.LOCATION_STOP, user_id, full_name, location=(lat, lon)))
 
     for zid in entered:
-        zone = CONFIG.zones_by_id.get(zid)
+        zone = cfg.zones_by_id.get(zid)
         if not zone:
             continue
-
         notify_enter, _ = get_effective_zone_notify(zone)
-        if not notify_enter:
-            continue
-
-        if zone.type == "danger":
-            text = f"🔴 Вход в опасную зону {describe_zone(zone)}"
-        else:
-            text = f"✅ Возврат в безопасную зону {describe_zone(zone)}"
-
-        await send_event_to_admins(
-            text,
-            sender_id=user_id,
-            sender_name=full_name,
-            location=(lat, lon),
-            zone=zone,
-        )
+        if notify_enter:
+            events.append(Event(EventKind.ZONE_ENTER, user_id, full_name, zone=zone, location=(lat, lon)))
 
     for zid in exited:
-        zone = CONFIG.zones_by_id.get(zid)
+        zone = cfg.zones_by_id.get(zid)
         if not zone:
             continue
         _, notify_exit = get_effective_zone_notify(zone)
-        if not notify_exit:
-            continue
+        if notify_exit:
+            events.append(Event(EventKind.ZONE_EXIT, user_id, full_name, zone=zone, location=(lat, lon)))
+
+    for event in events:
+        await send_event_to_admins(event)
+
+
+location_mailbox = UserMailbox(handle_location_event, MAILBOX_MAX_PENDING)
+metrics.gauge_fn("bot_mailbox_pending", "Обновлений локаций в очереди", lambda: location_mailbox.pending)
+metrics.counter_fn("bot_mailbox_coalesced_total", "Правок live-локации, заменённых более свежими", lambda: location_mailbox.coalesced)
+metrics.counter_fn("bot_mailbox_dropped_total", "Правок live-локации, отброшенных по лимиту очереди", lambda: location_mailbox.dropped)
+
+
+async def on_live_expired(session: LiveSession):
+    # Telegram не присылает правку, когда live_period просто истёк, — событие конца шлём сами
+    logging.info(
+        "[LIVE LOCATION EXPIRED] user=%s chat=%s msg_id=%s",
+        session.user_id,
+        session.chat_id,
+        session.message_id,
+    )
+    location = None
+    state = user_states.get(session.user_id)
+    if state is not None:
+        location = (state.last_lat, state.last_lng)
+        history.record(session.user_id, state.last_lat, state.last_lng, "end")
+    await send_event_to_admins(Event(EventKind.LOCATION_STOP, session.user_id, session.user_name, location=location))
+
+
+live_sessions = LiveSessionTable(on_live_expired, tick_s=LIVE_SWEEP_INTERVAL, idle_s=LIVE_IDLE_TIMEOUT)
+live_sessions.restore(restored_sessions)
+metrics.gauge_fn("bot_live_sessions", "Активных трансляций live-локации", lambda: len(live_sessions))
+metrics.counter_fn("bot_live_sessions_expired_total", "Трансляций, снятых по истечении live_period", lambda: live_sessions.expired)
 
-        if zone.type == "danger":
-            text = f"⚠️ Выход из опасной зоны {describe_zone(zone)}"
-        else:
-            text = f"⚠️ Выход из безопасной зоны {describe_zone(zone)}"
-
-        await send_event_to_admins(
-            text,
-            sender_id=user_id,
-            sender_name=full_name,
-            location=(lat, lon),
-            zone=zone,
-        )
+
+async def rebalance_cluster():
+    # состав кластера изменился: отдаём чужих пользователей и забираем live-сессии своих
+    await cluster.state.flush()
+    if not cluster.is_leader:
+        # у ведущего в памяти зеркало всех пользователей для absence — его не трогаем
+        for user_id in [u for u in user_states.keys() if not cluster.owns(u)]:
+            del user_states[user_id]
+    dropped = live_sessions.forget(lambda s: cluster.owns(s.user_id))
+    owned = [s for s in await cluster.sessions() if cluster.owns(s.user_id)]
+    live_sessions.restore(owned)
+    logging.info(
+        "Перераспределение: пользователей в памяти %d, live-сессий отдано %d, своих %d",
+        len(user_states), dropped, len(owned),
+    )
+
+
+if cluster is not None:
+    cluster.add_rebalance_hook(rebalance_cluster)
+    metrics.gauge_fn("bot_cluster_members", "Живых инстансов в кластере", lambda: len(cluster.members))
+    metrics.gauge_fn("bot_cluster_leader", "1, если инстанс держит аренду absence", lambda: int(cluster.is_leader))
+    metrics.counter_fn("bot_cluster_forwarded_total", "Обновлений, пересланных инстансу-владельцу", lambda: cluster.forwarded)
+    metrics.counter_fn(
+        "bot_cluster_forward_failures_total", "Неудачных пересылок (обработаны локально)", lambda: cluster.forward_failures,
+    )
+
+
+profiler = Profiler(
+    max_seconds=PROFILE_MAX_SECONDS,
+    slow_callback_s=PROFILE_SLOW_CALLBACK_MS / 1000.0,
+    directory=PROFILE_DIR,
+)
+
+
+async def on_profile(msg: Message, command: CommandObject):
+    user_id = msg.from_user.id
+    if user_id not in context.CONFIG.routing.effective:
+        logging.info("/profile от %s проигнорирован: не админ", user_id)
+        return
+    if profiler.active:
+        delivery.send_message(msg.chat.id, "Профилирование уже идёт")
+        return
+    try:
+        seconds = float(command.args) if command.args else 30.0
+    except ValueError:
+        delivery.send_message(msg.chat.id, "Использование: /profile <секунд>")
+        return
+    seconds = profiler.start(msg.chat.id, seconds)
+    delivery.send_message(msg.chat.id, f"⏱ Профилирую {seconds:g} с, результат придёт сюда")
+
+
+# команда регистрируется до общего обработчика сообщений; выключенная — не стоит ничего
+if PROFILE_ENABLED:
+    dp.message.register(on_profile, Command("profile"))
 
 
 @dp.message()
@@ -126,7 +203,14 @@ async def on_message(msg: Message):
     loc = msg.location
 
     if loc.live_period:
-        active_live_locations.add(msg.message_id)
+        live_sessions.start(
+            msg.chat.id,
+            msg.message_id,
+            msg.from_user.id,
+            msg.from_user.full_name,
+            msg.date.timestamp(),
+            loc.live_period,
+        )
         logging.info(
             "[LIVE LOCATION START] user=%s msg_id=%s lat=%s lon=%s live_period=%s",
             msg.from_user.id,
@@ -135,7 +219,7 @@ async def on_message(msg: Message):
             loc.longitude,
             loc.live_period,
         )
-        await handle_location_event(msg, kind="start")
+        await location_mailbox.post(msg.from_user.id, msg, "start")
     else:
         logging.info(
             "[LOCATION] user=%s lat=%s lon=%s",
@@ -143,7 +227,7 @@ async def on_message(msg: Message):
             loc.latitude,
             loc.longitude,
         )
-        await handle_location_event(msg, kind="single")
+        await location_mailbox.post(msg.from_user.id, msg, "single")
 
 
 @dp.edited_message()
@@ -154,7 +238,7 @@ async def on_edited(msg: Message):
 
     loc = msg.location
 
-    if msg.message_id in active_live_locations and loc.live_period is None:
+    if loc.live_period is None and (msg.chat.id, msg.message_id) in live_sessions:
         logging.info(
             "[LIVE LOCATION END] user=%s msg_id=%s lat=%s lon=%s",
             msg.from_user.id,
@@ -162,11 +246,22 @@ async def on_edited(msg: Message):
             loc.latitude,
             loc.longitude,
         )
-        active_live_locations.discard(msg.message_id)
-        await handle_location_event(msg, kind="end")
+        live_sessions.end(msg.chat.id, msg.message_id)
+        await location_mailbox.post(msg.from_user.id, msg, "end")
         return
 
     if loc.live_period is not None:
+        if not live_sessions.touch(msg.chat.id, msg.message_id, loc.live_period):
+            # начало трансляции пропущено (рестарт без STATE_DB_PATH) — берём её под учёт,
+            # date правки совпадает с временем исходного сообщения
+            live_sessions.start(
+                msg.chat.id,
+                msg.message_id,
+                msg.from_user.id,
+                msg.from_user.full_name,
+                msg.date.timestamp(),
+                loc.live_period,
+            )
         logging.info(
             "[LIVE LOCATION UPDATE] user=%s msg_id=%s lat=%s lon=%s live_period=%s",
             msg.from_user.id,
@@ -175,7 +270,7 @@ async def on_edited(msg: Message):
             loc.longitude,
             loc.live_period,
         )
-        await handle_location_event(msg, kind="update")
+        await location_mailbox.post(msg.from_user.id, msg, "update")
         return
 
     logging.info("[EDITED NON-LIVE] %s: %r", msg.from_user.id, msg)
\ No newline at end of file
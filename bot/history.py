@@ -0,0 +1,281 @@
+import argparse
+import asyncio
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from . import metrics
+from .context import HISTORY_DIR, HISTORY_FLUSH_INTERVAL, HISTORY_MAX_BUFFERED
+
+# numpy нужен только выборке, поэтому импортируется при первом запросе
+np = None
+_DTYPE = None
+_numpy_missing = False
+
+
+# Партиция — один файл на сутки UTC: заголовок и записи фиксированной длины.
+# Запись: мс от начала суток, user_id, широта и долгота в 1e-7 градуса, тип точки.
+# Внутри партиции записи идут по неубыванию времени, поэтому окно ищется бинарным поиском
+MAGIC = b"GEOHIST1"
+RECORD = struct.Struct("<IqiiB")
+DAY_S = 86400
+DAY_MS = DAY_S * 1000
+KINDS = ("single", "start", "update", "end")
+# за сколько последних суток помнить время последней записи: поздние точки приходят у полуночи
+OPEN_DAYS = 2
+_KIND_CODES = {k: i for i, k in enumerate(KINDS)}
+
+
+def _load_numpy() -> bool:
+    global np, _DTYPE, _numpy_missing
+    if np is None and not _numpy_missing:
+        try:
+            import numpy
+        except ImportError:
+            _numpy_missing = True
+        else:
+            _DTYPE = numpy.dtype([("ms", "<u4"), ("user", "<i8"), ("lat", "<i4"), ("lon", "<i4"), ("kind", "u1")])
+            np = numpy
+    return np is not None
+
+
+class HistoryPoint(NamedTuple):
+    ts: float
+    user_id: int
+    lat: float
+    lon: float
+    kind: str
+
+
+def partition_name(day: int) -> str:
+    return datetime.fromtimestamp(day * DAY_S, timezone.utc).strftime("%Y-%m-%d") + ".bin"
+
+
+def _tail_ms(path: str) -> int:
+    try:
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            n = (size - len(MAGIC)) // RECORD.size
+            if n <= 0:
+                return 0
+            f.seek(len(MAGIC) + (n - 1) * RECORD.size)
+            return RECORD.unpack(f.read(RECORD.size))[0]
+    except FileNotFoundError:
+        return 0
+
+
+def _point(day: int, ms: int, user_id: int, lat: int, lon: int, kind: int) -> HistoryPoint:
+    return HistoryPoint(day * DAY_S + ms / 1000.0, user_id, lat / 1e7, lon / 1e7, KINDS[kind])
+
+
+def _scan_partition(path: str, day: int, user_id: int, lo_ms: int, hi_ms: int) -> List[HistoryPoint]:
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        # хвост может быть недописан фоновым писателем — берём только целые записи
+        n = (size - len(MAGIC)) // RECORD.size
+        if n <= 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path}: не файл истории")
+            if _load_numpy():
+                return _scan_numpy(mm, n, day, user_id, lo_ms, hi_ms)
+            return _scan_python(mm, n, day, user_id, lo_ms, hi_ms)
+
+
+def _scan_numpy(mm: mmap.mmap, n: int, day: int, user_id: int, lo_ms: int, hi_ms: int) -> List[HistoryPoint]:
+    records = np.frombuffer(mm, dtype=_DTYPE, count=n, offset=len(MAGIC))
+    ms = records["ms"]
+    lo = int(np.searchsorted(ms, lo_ms, "left"))
+    hi = int(np.searchsorted(ms, hi_ms, "right"))
+    window = records[lo:hi]
+    rows = window[window["user"] == user_id].tolist()
+    # отображение закрывается после выхода, ссылок на буфер оставлять нельзя
+    del records, ms, window
+    return [_point(day, *row) for row in rows]
+
+
+class _MsColumn:
+    def __init__(self, buf: memoryview):
+        self._buf = buf
+
+    def __len__(self) -> int:
+        return (len(self._buf) - len(MAGIC)) // RECORD.size
+
+    def __getitem__(self, i: int) -> int:
+        return RECORD.unpack_from(self._buf, len(MAGIC) + i * RECORD.size)[0]
+
+
+def _scan_python(mm: mmap.mmap, n: int, day: int, user_id: int, lo_ms: int, hi_ms: int) -> List[HistoryPoint]:
+    with memoryview(mm)[:len(MAGIC) + n * RECORD.size] as buf:
+        column = _MsColumn(buf)
+        lo = bisect_left(column, lo_ms)
+        hi = bisect_right(column, hi_ms)
+        start = len(MAGIC) + lo * RECORD.size
+        end = len(MAGIC) + hi * RECORD.size
+        return [
+            _point(day, *row)
+            for row in RECORD.iter_unpack(buf[start:end])
+            if row[1] == user_id
+        ]
+
+
+def query_partitions(directory: str, user_id: int, start: float, end: float) -> List[HistoryPoint]:
+    points: List[HistoryPoint] = []
+    if end < start:
+        return points
+    for day in range(int(start // DAY_S), int(end // DAY_S) + 1):
+        lo_ms = max(0, int((start - day * DAY_S) * 1000))
+        hi_ms = min(DAY_MS - 1, int((end - day * DAY_S) * 1000))
+        points.extend(_scan_partition(os.path.join(directory, partition_name(day)), day, user_id, lo_ms, hi_ms))
+    return points
+
+
+class HistoryWriter:
+    def __init__(self, directory: Optional[str], *, flush_interval: float = 1.0, max_buffered: int = 100_000):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self._buffers: Dict[int, bytearray] = {}
+        self._buffered = 0
+        self._last_ms: Dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @property
+    def buffered(self) -> int:
+        return self._buffered
+
+    def record(self, user_id: int, lat: float, lon: float, kind: str, ts: Optional[float] = None):
+        if not self.directory:
+            return
+        if self._buffered >= self.max_buffered:
+            # запись на диск не успевает: теряем точку, но не память
+            if not self.dropped:
+                logging.warning("Буфер истории переполнен (%d записей), точки отбрасываются", self.max_buffered)
+            self.dropped += 1
+            return
+
+        if ts is None:
+            ts = time.time()
+        day = int(ts // DAY_S)
+        ms = int((ts - day * DAY_S) * 1000)
+        last = self._last_ms.get(day)
+        if last is None:
+            last = self._last_ms[day] = self._partition_tail(day)
+            for old in [d for d in self._last_ms if d <= day - OPEN_DAYS]:
+                del self._last_ms[old]
+        if ms < last:
+            # часы ушли назад — держим порядок внутри партиции
+            ms = last
+        self._last_ms[day] = ms
+
+        buf = self._buffers.get(day)
+        if buf is None:
+            buf = self._buffers[day] = bytearray()
+        buf += RECORD.pack(ms, user_id, round(lat * 1e7), round(lon * 1e7), _KIND_CODES.get(kind, 0))
+        self._buffered += 1
+
+    def _partition_tail(self, day: int) -> int:
+        # продолжаем с последней записи суток: сначала несброшенный буфер, потом файл
+        buf = self._buffers.get(day)
+        if buf:
+            return RECORD.unpack_from(buf, len(buf) - RECORD.size)[0]
+        return _tail_ms(os.path.join(self.directory, partition_name(day)))
+
+    def _take_batch(self) -> List[Tuple[int, bytes]]:
+        batch = [(day, bytes(buf)) for day, buf in sorted(self._buffers.items())]
+        self._buffers = {}
+        self._buffered = 0
+        return batch
+
+    def _write(self, batch: List[Tuple[int, bytes]]):
+        for day, data in batch:
+            with open(os.path.join(self.directory, partition_name(day)), "ab") as f:
+                if f.tell() == 0:
+                    f.write(MAGIC)
+                f.write(data)
+            self.written += len(data) // RECORD.size
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch = self._take_batch()
+            if batch:
+                await asyncio.to_thread(self._write, batch)
+
+    async def run(self):
+        if not self.directory:
+            return
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.exception("Ошибка записи истории в %s: %s", self.directory, e)
+
+    async def close(self):
+        if self.directory:
+            await self.flush()
+
+    async def query(self, user_id: int, start: float, end: float) -> List[HistoryPoint]:
+        if not self.directory:
+            return []
+        # сначала дописываем буфер, чтобы в выборку попали и самые свежие точки
+        await self.flush()
+        return await asyncio.to_thread(query_partitions, self.directory, user_id, start, end)
+
+
+history = HistoryWriter(HISTORY_DIR, flush_interval=HISTORY_FLUSH_INTERVAL, max_buffered=HISTORY_MAX_BUFFERED)
+metrics.gauge_fn("bot_history_buffered", "Точек истории, ожидающих записи", lambda: history.buffered)
+metrics.counter_fn("bot_history_written_total", "Точек истории, записанных на диск", lambda: history.written)
+metrics.counter_fn("bot_history_dropped_total", "Точек истории, отброшенных при переполнении буфера", lambda: history.dropped)
+
+
+def _parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Выборка истории локаций пользователя за интервал")
+    parser.add_argument("--dir", default=HISTORY_DIR, help="каталог партиций (по умолчанию HISTORY_DIR)")
+    parser.add_argument("--user", type=int, required=True)
+    parser.add_argument("--from", dest="start", required=True, help="unix-время или ISO 8601 (UTC по умолчанию)")
+    parser.add_argument("--to", dest="end", default=None, help="по умолчанию — сейчас")
+    args = parser.parse_args()
+
+    if not args.dir:
+        parser.error("не задан каталог истории (--dir или HISTORY_DIR)")
+    end = _parse_time(args.end) if args.end else time.time()
+    for p in query_partitions(args.dir, args.user, _parse_time(args.start), end):
+        sys.stdout.write(json.dumps(p._asdict(), ensure_ascii=False) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+os.environ.setdefault("BOT_TOKEN", "0:loadtest")
+# заглушка бота не ограничена Telegram, лимиты отправки только исказят замер
+os.environ.setdefault("DELIVERY_GLOBAL_RATE", "1000000")
+os.environ.setdefault("DELIVERY_CHAT_RATE", "1000000")
+os.environ.setdefault("DELIVERY_CHAT_BURST", "1000000")
+
+from .context import bot, dp, cluster, state_store, CONFIG, WEBHOOK_PATH  # noqa: E402
+from .absence import absence_watcher  # noqa: E402
+from .batching import geo_batcher  # noqa: E402
+from .delivery import delivery  # noqa: E402
+from .digest import digest  # noqa: E402
+from .webhook import inflight, create_app  # noqa: E402
+from .workers import geo_workers  # noqa: E402
+from .handlers import location_mailbox  # noqa: E402
+
+
+def _stub_error(kind: str, method: str) -> Exception:
+    from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter
+
+    if kind == "network":
+        return TelegramNetworkError(method=None, message="stub: network error")
+    if kind == "retry-after":
+        return TelegramRetryAfter(method=None, message="stub: flood control", retry_after=1)
+    return TelegramForbiddenError(method=None, message=f"stub: {method} forbidden")
+
+
+class StubBot:
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, error_kind: str = "forbidden", seed: int = 1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_kind = error_kind
+        self.errors = 0
+        self._rnd = random.Random(seed)
+        self.calls: List[tuple] = []
+
+    async def _call(self, method: str):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self._rnd.random() < self.error_rate:
+            self.errors += 1
+            raise _stub_error(self.error_kind, method)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._call("send_message")
+        self.calls.append(("send_message", chat_id, text))
+
+    async def send_location(self, chat_id: int, latitude: float, longitude: float, **kwargs):
+        await self._call("send_location")
+        self.calls.append(("send_location", chat_id, latitude, longitude))
+
+    async def send_document(self, chat_id: int, document, **kwargs):
+        await self._call("send_document")
+        self.calls.append(("send_document", chat_id, getattr(document, "path", document)))
+
+
+def location_update(
+    update_id: int,
+    user_id: int,
+    message_id: int,
+    lat: float,
+    lon: float,
+    *,
+    live_period=None,
+    edited: bool = False,
+) -> Dict:
+    now = int(time.time())
+    msg = {
+        "message_id": message_id,
+        "date": now,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+        "location": {"latitude": lat, "longitude": lon},
+    }
+    if live_period is not None:
+        msg["location"]["live_period"] = live_period
+    if edited:
+        msg["edit_date"] = now
+    return {"update_id": update_id, "edited_message" if edited else "message": msg}
+
+
+def generate_updates(users: int, total: int, seed: int = 1) -> List[Dict]:
+    rnd = random.Random(seed)
+    centers = [(z.center_lat, z.center_lng) for z in CONFIG.zones] or [(55.75, 37.62)]
+    pos = {}
+    updates = []
+    for uid in range(1, users + 1):
+        lat, lon = rnd.choice(centers)
+        pos[uid] = [lat, lon]
+        updates.append(location_update(len(updates) + 1, uid, 1, lat, lon, live_period=3600))
+    while len(updates) < total:
+        uid = rnd.randint(1, users)
+        p = pos[uid]
+        p[0] += rnd.gauss(0, 0.0003)
+        p[1] += rnd.gauss(0, 0.0005)
+        updates.append(location_update(len(updates) + 1, uid, 1, p[0], p[1], live_period=3600, edited=True))
+    return updates
+
+
+async def _wait_handled(total: int):
+    while inflight.handled < total:
+        await asyncio.sleep(0.01)
+
+
+async def run_polling(updates: List[Dict], batch: int, rtt: float):
+    tasks = set()
+    for i in range(0, len(updates), batch):
+        await asyncio.sleep(rtt)
+        for upd in updates[i:i + batch]:
+            task = asyncio.create_task(dp.feed_raw_update(bot, upd))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    await _wait_handled(len(updates))
+
+
+async def run_geo(updates: List[Dict]):
+    points = []
+    for upd in updates:
+        msg = upd.get("message") or upd["edited_message"]
+        points.append((msg["from"]["id"], msg["location"]["latitude"], msg["location"]["longitude"]))
+    await asyncio.gather(*(geo_batcher.submit(u, lat, lon) for u, lat, lon in points))
+
+
+async def run_webhook(updates: List[Dict], concurrency: int, port: int) -> List[float]:
+    from aiohttp import ClientSession, web
+
+    app = create_app(dp, bot, secret_token=None)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+    sem = asyncio.Semaphore(concurrency)
+    http_latencies: List[float] = []
+
+    async with ClientSession() as session:
+        async def post(upd):
+            async with sem:
+                started = time.perf_counter()
+                async with session.post(url, json=upd) as resp:
+                    await resp.read()
+                http_latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*(post(u) for u in updates))
+    await _wait_handled(len(updates))
+    await runner.cleanup()
+    return sorted(http_latencies)
+
+
+async def serve_instance(port: int):
+    # один инстанс кластера для --mode cluster: webhook на своём порту и счётчик обработанных
+    from aiohttp import web
+
+    tasks = [asyncio.create_task(cluster.run()), asyncio.create_task(state_store.run())]
+    tasks.append(asyncio.create_task(absence_watcher()))
+
+    async def stats(_request):
+        return web.json_response({
+            "handled": inflight.handled,
+            "members": len(cluster.members),
+            "leader": cluster.is_leader,
+            "forwarded": cluster.forwarded,
+        })
+
+    app = create_app(dp, bot, secret_token=None)
+    app.router.add_get("/loadtest/stats", stats)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await stop.wait()
+    await runner.cleanup()
+    for task in tasks:
+        task.cancel()
+    await state_store.close()
+    await cluster.close()
+
+
+async def _cluster_stats(session, ports: List[int]) -> List[Dict]:
+    out = []
+    for port in ports:
+        try:
+            async with session.get(f"http://127.0.0.1:{port}/loadtest/stats") as resp:
+                out.append(await resp.json())
+        except OSError:
+            out.append({})
+    return out
+
+
+async def run_cluster(updates: List[Dict], instances: int, concurrency: int, port: int) -> List[Dict]:
+    from aiohttp import ClientSession
+
+    db = os.path.join(tempfile.mkdtemp(prefix="geoshare-cluster-"), "cluster.db")
+    ports = [port + i for i in range(instances)]
+    procs = []
+    for i, p in enumerate(ports):
+        env = dict(
+            os.environ,
+            CLUSTER_DB_PATH=db,
+            CLUSTER_INSTANCE_ID=f"lt{i}",
+            CLUSTER_ADVERTISE_URL=f"http://127.0.0.1:{p}",
+            CLUSTER_LEASE_TTL="3",
+        )
+        procs.append(subprocess.Popen([sys.executable, "-m", "bot.loadtest", "--serve", str(p)], env=env))
+
+    try:
+        async with ClientSession() as session:
+            # ждём, пока каждый инстанс увидит всех остальных, иначе маршрутизация ещё не сошлась
+            while not all(s.get("members") == instances for s in await _cluster_stats(session, ports)):
+                if any(proc.poll() is not None for proc in procs):
+                    raise RuntimeError("инстанс кластера завершился при старте")
+                await asyncio.sleep(0.5)
+
+            sem = asyncio.Semaphore(concurrency)
+            started = time.perf_counter()
+
+            async def post(i, upd):
+                # балансировщик без привязки к пользователю — по кругу
+                async with sem:
+                    url = f"http://127.0.0.1:{ports[i % instances]}{WEBHOOK_PATH}"
+                    async with session.post(url, json=upd) as resp:
+                        await resp.read()
+
+            await asyncio.gather(*(post(i, u) for i, u in enumerate(updates)))
+            while True:
+                stats = await _cluster_stats(session, ports)
+                if sum(s.get("handled", 0) for s in stats) >= len(updates):
+                    break
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - started
+    finally:
+        for proc in procs:
+            proc.send_signal(signal.SIGTERM)
+        for proc in procs:
+            proc.wait()
+
+    print(f"mode=cluster instances={instances} updates={len(updates)} time={elapsed:.2f}s rate={len(updates) / elapsed:.0f}/s")
+    for p, s in zip(ports, stats):
+        print(f"  :{p} handled={s['handled']} forwarded={s['forwarded']} leader={s['leader']}")
+    return stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработки обновлений")
+    parser.add_argument("--mode", choices=("polling", "webhook", "geo", "cluster"), default="webhook")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--poll-batch", type=int, default=100)
+    parser.add_argument("--poll-rtt-ms", type=float, default=50.0)
+    parser.add_argument("--send-latency-ms", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--workers", type=int, default=None, help="число geo-воркеров (по умолчанию GEO_WORKERS)")
+    parser.add_argument("--instances", type=int, default=2, help="число инстансов для --mode cluster")
+    parser.add_argument("--serve", type=int, metavar="PORT", help=argparse.SUPPRESS)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    if args.mode == "cluster" and args.serve is None:
+        await run_cluster(generate_updates(args.users, args.updates), args.instances, args.concurrency, args.port)
+        return
+    if args.workers is not None:
+        geo_workers.workers = args.workers
+    await geo_workers.start()
+
+    stub = StubBot(args.send_latency_ms / 1000.0)
+    delivery.bot = stub
+    dp.update.outer_middleware(inflight)
+    if args.serve is not None:
+        await serve_instance(args.serve)
+        return
+    updates = generate_updates(args.users, args.updates)
+
+    started = time.perf_counter()
+    http = []
+    if args.mode == "polling":
+        await run_polling(updates, args.poll_batch, args.poll_rtt_ms / 1000.0)
+    elif args.mode == "geo":
+        await run_geo(updates)
+    else:
+        http = await run_webhook(updates, args.concurrency, args.port)
+    elapsed = time.perf_counter() - started
+    digest.flush_all()
+    await delivery.drain()
+    geo_workers.close()
+
+    print(
+        f"mode={args.mode} workers={geo_workers.workers} updates={len(updates)} "
+        f"time={elapsed:.2f}s rate={len(updates) / elapsed:.0f}/s"
+    )
+    if args.mode != "geo":
+        print(f"handler p50={inflight.percentile(0.5) * 1000:.2f}ms p99={inflight.percentile(0.99) * 1000:.2f}ms")
+    if http:
+        print(f"http p99={http[int(0.99 * (len(http) - 1))] * 1000:.2f}ms")
+    print(f"sent={len(stub.calls)}")
+    if args.mode != "geo":
+        print("mailbox " + " ".join(f"{k}={v}" for k, v in location_mailbox.stats().items()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Tuple
+
+from aiogram.types import Message
+
+
+LocationHandler = Callable[..., Awaitable[Any]]
+Entry = Tuple[Message, str, asyncio.Future]
+
+# только промежуточные обновления live-локации можно заменить более свежими;
+# начало/конец трансляции и обычная локация обрабатываются всегда
+COALESCIBLE_KINDS = frozenset({"update"})
+
+
+class UserMailbox:
+    def __init__(self, handler: LocationHandler, max_pending: int):
+        self._handler = handler
+        self.max_pending = max_pending
+        self._queues: Dict[int, Deque[Entry]] = {}
+        self._pending = 0
+        self._space = asyncio.Event()
+        self._space.set()
+        self.processed = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_pending > 0
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": self._pending,
+            "users": len(self._queues),
+            "processed": self.processed,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+        }
+
+    async def post(self, user_id: int, msg: Message, kind: str) -> bool:
+        if not self.enabled:
+            await self._handler(msg, kind=kind)
+            return True
+
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(user_id)
+
+        if queue and queue[-1][1] in COALESCIBLE_KINDS:
+            # ещё не начатое обновление устарело: занимаем его место в очереди
+            _, _, stale = queue[-1]
+            queue[-1] = (msg, kind, fut)
+            self.coalesced += 1
+            if not stale.done():
+                stale.set_result(False)
+            return await fut
+
+        while self._pending >= self.max_pending:
+            if kind in COALESCIBLE_KINDS:
+                self.dropped += 1
+                return False
+            self._space.clear()
+            await self._space.wait()
+            queue = self._queues.get(user_id)
+
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            asyncio.create_task(self._drain(user_id, queue))
+        queue.append((msg, kind, fut))
+        self._pending += 1
+        return await fut
+
+    async def _drain(self, user_id: int, queue: Deque[Entry]):
+        try:
+            while queue:
+                msg, kind, fut = queue.popleft()
+                self._pending -= 1
+                if self._pending < self.max_pending:
+                    self._space.set()
+
+                try:
+                    await self._handler(msg, kind=kind)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                    else:
+                        logging.exception("Ошибка обработки локации user=%s: %s", user_id, e)
+                    continue
+
+                self.processed += 1
+                if not fut.done():
+                    fut.set_result(True)
+        finally:
+            del self._queues[user_id]
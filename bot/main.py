@@ -1,13 +1,54 @@
 import asyncio
+import logging
 
-from .context import bot, dp
+from .context import bot, dp, cluster, state_store, SHUTDOWN_TIMEOUT, WEBHOOK_URL
 from .absence import absence_watcher
-from . import handlers  # noqa: F401
+from .delivery import delivery
+from .digest import digest
+from .reload import config_watcher
+from .workers import geo_workers
+from .metrics import serve_metrics
+from .history import history
+from .handlers import live_sessions
 
 
 async def main():
+    if cluster is not None:
+        if not WEBHOOK_URL:
+            logging.warning("Кластерный режим рассчитан на webhook: при polling обновления получает один инстанс")
+        if geo_workers.workers:
+            # воркеры получают пользователей только при fork и не видят подхваченных из хранилища
+            logging.warning("В кластерном режиме GEO_WORKERS не используется")
+            geo_workers.workers = 0
+        asyncio.create_task(cluster.run())
+    await geo_workers.start()
+    metrics_runner = await serve_metrics()
     asyncio.create_task(absence_watcher())
-    await dp.start_polling(bot)
+    asyncio.create_task(state_store.run())
+    asyncio.create_task(history.run())
+    asyncio.create_task(live_sessions.run())
+    asyncio.create_task(config_watcher())
+    try:
+        if WEBHOOK_URL:
+            from .webhook import run_webhook
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        # при polling открытые окна сводок и очередь отправки иначе пропали бы при выходе;
+        # после webhook здесь уже пусто — он дожидается их сам в общем сроке с обработчиками
+        digest.flush_all()
+        await delivery.drain(SHUTDOWN_TIMEOUT)
+        if delivery.queue_depths():
+            logging.warning("Очередь отправки не опустела за %.0f с", SHUTDOWN_TIMEOUT)
+        await bot.session.close()
+        geo_workers.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await state_store.close()
+        await history.close()
+        if cluster is not None:
+            await cluster.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+import asyncio
+import functools
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .context import METRICS_HOST, METRICS_PORT, METRICS_COLLECT
+
+
+ENABLED = METRICS_PORT > 0 or METRICS_COLLECT
+
+# 1 мкс … 10 с по шкале 1-2.5-5: хватает и для проверки зон, и для запросов к Telegram
+DEFAULT_BUCKETS = tuple(float(f"{m}e{e}") for e in range(-6, 1) for m in (1, 2.5, 5)) + (10.0,)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+
+    def samples(self) -> List[str]:
+        return []
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values, amount: float = 1.0):
+        key = tuple(map(str, label_values)) if label_values else ()
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def values(self) -> Dict[LabelValues, float]:
+        return dict(self._values)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}"
+            for key, v in sorted(self._values.items())
+        ]
+
+
+class CallbackMetric(Metric):
+    # значение считается только при чтении /metrics, на горячем пути ничего не стоит
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float], kind: str):
+        super().__init__(name, help_text)
+        self.kind = kind
+        self._fn = fn
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(float(self._fn()))}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, *label_values):
+        key = tuple(map(str, label_values)) if label_values else ()
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * len(self.buckets)
+            self._sums[key] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, *label_values) -> int:
+        return sum(self._counts.get(tuple(map(str, label_values)), ()))
+
+    def quantile(self, q: float, *label_values) -> float:
+        # как histogram_quantile в Prometheus: линейно внутри найденного бакета
+        counts = self._counts.get(tuple(map(str, label_values)))
+        if not counts:
+            return 0.0
+        rank = q * sum(counts)
+        seen = 0
+        lower = 0.0
+        for bound, n in zip(self.buckets, counts):
+            if n and seen + n >= rank:
+                if bound == math.inf:
+                    return lower
+                return lower + (bound - lower) * (rank - seen) / n
+            seen += n
+            lower = bound
+        return lower
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, counts in sorted(self._counts.items()):
+            total = 0
+            for bound, n in zip(self.buckets, counts):
+                total += n
+                le = 'le="%s"' % _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {self._sums[key]!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {total}")
+        return lines
+
+
+class _Noop:
+    def inc(self, *label_values, amount: float = 1.0):
+        pass
+
+    def observe(self, value: float, *label_values):
+        pass
+
+    def values(self) -> Dict[LabelValues, float]:
+        return {}
+
+    def count(self, *label_values) -> int:
+        return 0
+
+    def quantile(self, q: float, *label_values) -> float:
+        return 0.0
+
+
+NOOP = _Noop()
+_registry: List[Metric] = []
+
+
+def counter(name: str, help_text: str, labels: Sequence[str] = ()):
+    if not ENABLED:
+        return NOOP
+    metric = Counter(name, help_text, labels)
+    _registry.append(metric)
+    return metric
+
+
+def histogram(name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+    if not ENABLED:
+        return NOOP
+    metric = Histogram(name, help_text, labels, buckets)
+    _registry.append(metric)
+    return metric
+
+
+def gauge_fn(name: str, help_text: str, fn: Callable[[], float]):
+    if ENABLED:
+        _registry.append(CallbackMetric(name, help_text, fn, "gauge"))
+
+
+def counter_fn(name: str, help_text: str, fn: Callable[[], float]):
+    if ENABLED:
+        _registry.append(CallbackMetric(name, help_text, fn, "counter"))
+
+
+def timed(metric):
+    # без метрик функция возвращается как есть — ни одного лишнего вызова
+    def decorate(fn):
+        if not ENABLED:
+            return fn
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started)
+        return wrapper
+
+    return decorate
+
+
+def render() -> str:
+    return "\n".join(m.render() for m in _registry) + "\n"
+
+
+update_seconds = histogram(
+    "bot_location_update_seconds", "Время обработки одного обновления локации (handle_location_event)",
+)
+geo_update_seconds = histogram(
+    "bot_geo_update_seconds", "Время update_user_state для одного обновления",
+)
+geo_batch_seconds = histogram(
+    "bot_geo_batch_seconds", "Время пакетной проверки зон (update_user_states_batch)",
+)
+fanout_seconds = histogram(
+    "bot_notify_fanout_seconds", "Время send_event_to_admins: рендер и постановка в очереди отправки",
+)
+absence_cycle_seconds = histogram(
+    "bot_absence_cycle_seconds", "Время одного прохода absence_watcher по наступившим дедлайнам",
+)
+telegram_request_seconds = histogram(
+    "bot_telegram_request_seconds", "Время запроса к Telegram API при отправке", ("method",),
+)
+events_total = counter("bot_events_total", "Событий для рассылки по типам", ("kind",))
+telegram_errors_total = counter("bot_telegram_errors_total", "Ошибки Telegram API при отправке", ("error",))
+send_failures_total = counter("bot_send_failures_total", "Неотправленные уведомления по админам", ("admin_id",))
+
+
+async def serve_metrics(host: str = METRICS_HOST, port: int = METRICS_PORT) -> Optional[object]:
+    if not ENABLED:
+        return None
+
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
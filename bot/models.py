@@ -1,6 +1,12 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, Set
+from enum import Enum
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from .geometry import ZoneGeometry
+    from .routing import RoutingTable
+    from .spatial import ZoneIndex
 
 
 @dataclass
@@ -19,6 +25,14 @@ class Zone:
     center_lng: float
     radius_m: float
     notifications: ZoneNotifications
+    # circle — круг center/radius_m; polygon и corridor задаются точками,
+    # а center/radius_m для них — описанная окружность, посчитанная при загрузке
+    shape: str = "circle"
+    points: Tuple[Tuple[float, float], ...] = ()
+    width_m: float = 0.0
+    geometry: Optional["ZoneGeometry"] = None
+    # cos широты центра для быстрой плоской оценки расстояния в geo; 0 — оценка не используется
+    cos_lat: float = 0.0
 
 
 @dataclass
@@ -27,6 +41,7 @@ class GlobalZoneConfig:
     secure_notify_enter: bool = True
     danger_notify_exit: bool = True
     danger_notify_enter: bool = True
+    hysteresis_m: float = 0.0
 
 
 @dataclass
@@ -36,6 +51,10 @@ class TelegramGlobal:
     notify_absent_enabled: bool = False
     notify_absent_minutes: int = 10
     send_current_location_with_alert: bool = False
+    # > 0 — события за это окно (с) уходят админу одной сводкой;
+    # вход в опасную зону при digest_danger_immediate отправляется сразу
+    digest_window_s: float = 0.0
+    digest_danger_immediate: bool = True
 
 
 @dataclass
@@ -48,6 +67,10 @@ class TelegramAdmin:
     notify_absent_enabled: bool = False
     notify_absent_minutes: int = 10
     send_current_location_with_alert: bool = False
+    # > 0 — события за это окно (с) уходят админу одной сводкой;
+    # вход в опасную зону при digest_danger_immediate отправляется сразу
+    digest_window_s: float = 0.0
+    digest_danger_immediate: bool = True
     zones: List[int] = field(default_factory=list)
 
 
@@ -83,6 +106,9 @@ class Config:
     zones: List[Zone]
     zones_by_id: Dict[int, Zone]
     telegram: TelegramConfig
+    zone_index: Optional["ZoneIndex"] = None
+    zone_group_keys: Dict[int, tuple] = field(default_factory=dict)
+    routing: Optional["RoutingTable"] = None
 
 
 @dataclass
@@ -90,4 +116,37 @@ class UserState:
     last_lat: float
     last_lng: float
     last_time: datetime
-    current_zone_ids: Set[int] = field(default_factory=set)
\ No newline at end of file
+    current_zone_ids: Set[int] = field(default_factory=set)
+    notified_admins: Set[int] = field(default_factory=set)
+
+
+@dataclass
+class LiveSession:
+    chat_id: int
+    message_id: int
+    user_id: int
+    user_name: Optional[str]
+    started: float
+    live_period: int
+    # момент, после которого трансляция считается закончившейся без явного сигнала
+    expires: float
+
+
+class EventKind(Enum):
+    LOCATION_START = "location_start"
+    LOCATION_STOP = "location_stop"
+    ZONE_ENTER = "zone_enter"
+    ZONE_EXIT = "zone_exit"
+    ABSENT = "absent"
+
+
+@dataclass
+class Event:
+    kind: EventKind
+    user_id: int
+    user_name: Optional[str] = None
+    zone: Optional[Zone] = None
+    location: Optional[Tuple[float, float]] = None
+    secure_zone: Optional[Zone] = None
+    danger_zone: Optional[Zone] = None
+    absent_minutes: int = 0
@@ -2,33 +2,22 @@ from typing import Optional, Tuple
 
 import logging
 
-from .context import CONFIG, bot
-from .models import Zone, TelegramAdmin, TelegramGlobal
+from . import context, metrics
+from .delivery import delivery
+from .digest import digest
+from .models import Event, EventKind, Zone, TelegramAdmin, TelegramGlobal
+from .routing import effective_admin_flags
 
 
 def is_sender_allowed(user_id: int) -> bool:
-    af = CONFIG.telegram.accept_from
-    if af.mode == "any":
-        return True
-    for u in af.users:
-        if u.id == user_id:
-            return True
-    return False
+    return context.CONFIG.routing.is_allowed(user_id)
 
 
 def resolve_sender_label(user_id: int, full_name: Optional[str]) -> str:
-    ss = CONFIG.telegram.show_sender
+    cfg = context.CONFIG
+    ss = cfg.telegram.show_sender
     parts = []
-    config_name: Optional[str] = None
-    for a in CONFIG.telegram.admins:
-        if a.id == user_id and a.name:
-            config_name = a.name
-            break
-    if config_name is None:
-        for u in CONFIG.telegram.accept_from.users:
-            if u.id == user_id and u.name:
-                config_name = u.name
-                break
+    config_name = cfg.routing.config_name(user_id)
     if ss.show_name:
         if config_name:
             parts.append(config_name)
@@ -48,7 +37,7 @@ def describe_zone(zone: Zone) -> str:
 
 
 def get_effective_zone_notify(zone: Zone) -> Tuple[bool, bool]:
-    zg = CONFIG.zone_global
+    zg = context.CONFIG.zone_global
     if zone.notifications.override:
         enter = zone.notifications.notify_on_enter
         exit_ = zone.notifications.notify_on_exit
@@ -63,16 +52,11 @@ def get_effective_zone_notify(zone: Zone) -> Tuple[bool, bool]:
 
 
 def get_admin_effective_flags(admin: TelegramAdmin) -> TelegramGlobal:
-    g = CONFIG.telegram.global_cfg
-    if not admin.override:
-        return g
-    return TelegramGlobal(
-        notify_location_start=admin.notify_location_start,
-        notify_location_stop=admin.notify_location_stop,
-        notify_absent_enabled=admin.notify_absent_enabled,
-        notify_absent_minutes=admin.notify_absent_minutes,
-        send_current_location_with_alert=admin.send_current_location_with_alert,
-    )
+    cfg = context.CONFIG
+    eff = cfg.routing.effective.get(admin.id)
+    if eff is not None:
+        return eff
+    return effective_admin_flags(admin, cfg.telegram.global_cfg)
 
 
 def admin_interested_in_zone(admin: TelegramAdmin, zone_id: int) -> bool:
@@ -81,49 +65,82 @@ def admin_interested_in_zone(admin: TelegramAdmin, zone_id: int) -> bool:
     return zone_id in admin.zones
 
 
-async def send_event_to_admins(
-    event_text: str,
-    sender_id: int,
-    sender_name: Optional[str],
-    *,
-    location: Optional[Tuple[float, float]] = None,
-    zone: Optional[Zone] = None,
-    is_start_stop_absent: bool = False,
-):
-    if not CONFIG.telegram.admins:
-        logging.info("Нет админов для отправки уведомления: %s", event_text)
+def render_event(event: Event) -> str:
+    label = resolve_sender_label(event.user_id, event.user_name)
+    kind = event.kind
+    zone = event.zone
+
+    if kind == EventKind.ABSENT:
+        return f"⏰ Нет локации от {label} уже {event.absent_minutes} минут"
+
+    if kind == EventKind.LOCATION_START:
+        secure, danger = event.secure_zone, event.danger_zone
+        if secure and not danger:
+            text = f"▶️ Начал вещание из безопасной зоны {describe_zone(secure)}"
+        elif danger and not secure:
+            text = f"▶️ Начал вещание из опасной зоны {describe_zone(danger)}"
+        elif secure and danger:
+            text = "▶️ Начал вещание: одновременно в безопасной и опасной зоне"
+        else:
+            text = "▶️ Начал вещание вне заданных зон"
+    elif kind == EventKind.LOCATION_STOP:
+        text = "⏹ Окончание вещания live-location"
+    elif kind == EventKind.ZONE_ENTER:
+        if zone.type == "danger":
+            text = f"🔴 Вход в опасную зону {describe_zone(zone)}"
+        else:
+            text = f"✅ Возврат в безопасную зону {describe_zone(zone)}"
+    else:
+        if zone.type == "danger":
+            text = f"⚠️ Выход из опасной зоны {describe_zone(zone)}"
+        else:
+            text = f"⚠️ Выход из безопасной зоны {describe_zone(zone)}"
+
+    return f"{text}\nОт: {label}"
+
+
+def is_critical_event(event: Event) -> bool:
+    return event.kind == EventKind.ZONE_ENTER and event.zone is not None and event.zone.type == "danger"
+
+
+def admin_accepts_event(eff: TelegramGlobal, kind: EventKind) -> bool:
+    if kind == EventKind.LOCATION_START:
+        return eff.notify_location_start
+    if kind == EventKind.LOCATION_STOP:
+        return eff.notify_location_stop
+    if kind == EventKind.ABSENT:
+        return eff.notify_absent_enabled
+    return True
+
+
+@metrics.timed(metrics.fanout_seconds)
+async def send_event_to_admins(event: Event):
+    metrics.events_total.inc(event.kind.value)
+    routing = context.CONFIG.routing
+    if not routing.admins:
+        logging.info("Нет админов для отправки уведомления: %s", event.kind.value)
         return
 
-    label = resolve_sender_label(sender_id, sender_name)
-    base_text = f"{event_text}\nОт: {label}"
+    if event.zone is not None and event.kind in (EventKind.ZONE_ENTER, EventKind.ZONE_EXIT):
+        routes = routing.admins_for_zone(event.zone.id)
+    else:
+        routes = routing.admins
 
-    for adm in CONFIG.telegram.admins:
-        if not is_start_stop_absent and zone is not None:
-            if not admin_interested_in_zone(adm, zone.id):
-                continue
+    text: Optional[str] = None
+    critical = is_critical_event(event)
+    for adm, eff in routes:
+        if not admin_accepts_event(eff, event.kind):
+            continue
 
-        eff = get_admin_effective_flags(adm)
+        if text is None:
+            text = render_event(event)
 
-        if "🔴 Вход в опасную зону" in event_text or "⚠️ Выход из опасной зоны" in event_text \
-                or "⚠️ Выход из безопасной зоны" in event_text:
-            allowed = True
-        else:
-            if "▶️ Начало вещания" in event_text:
-                allowed = eff.notify_location_start
-            elif "⏹ Окончание вещания" in event_text:
-                allowed = eff.notify_location_stop
-            elif "⏰ Нет локации" in event_text:
-                allowed = eff.notify_absent_enabled
-            else:
-                allowed = True
-
-        if not allowed:
+        location = event.location if eff.send_current_location_with_alert else None
+        if eff.digest_window_s > 0 and not (critical and eff.digest_danger_immediate):
+            digest.add(adm.id, eff.digest_window_s, text, location)
             continue
 
-        try:
-            await bot.send_message(adm.id, base_text)
-            if location is not None and eff.send_current_location_with_alert:
-                lat, lon = location
-                await bot.send_location(adm.id, latitude=lat, longitude=lon)
-        except Exception as e:
-            logging.warning("Не удалось отправить сообщение админу %s: %s", adm.id, e)
\ No newline at end of file
+        delivery.send_message(adm.id, text)
+        if location is not None:
+            lat, lon = location
+            delivery.send_location(adm.id, lat, lon)
@@ -0,0 +1,127 @@
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import time
+from typing import List, Optional, Tuple
+
+from .delivery import delivery
+from .digest import pack_blocks
+
+
+TOP_FUNCTIONS = 20
+TOP_SLOW_CALLBACKS = 10
+# (файл:строка(функция), вызовов, собственное время, время с вложенными)
+FunctionRow = Tuple[str, int, float, float]
+
+
+def _describe(handle: asyncio.Handle) -> str:
+    # шаг задачи понятнее по её корутине, чем по repr колбэка
+    owner = getattr(handle._callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro()
+        return f"задача {owner.get_name()} ({getattr(coro, '__qualname__', coro)})"
+    return repr(handle)
+
+
+def _short_path(path: str) -> str:
+    parts = path.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+
+def top_functions(stats: pstats.Stats, limit: int = TOP_FUNCTIONS) -> List[FunctionRow]:
+    rows = []
+    for (path, line, func), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        where = f"{func}" if path == "~" else f"{_short_path(path)}:{line}({func})"
+        rows.append((where, calls, tottime, cumtime))
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows[:limit]
+
+
+def render_profile(
+    seconds: float,
+    stats: pstats.Stats,
+    slow: List[str],
+    slow_callback_s: float,
+    path: Optional[str],
+) -> List[str]:
+    header = f"⏱ Профиль цикла событий за {seconds:g} с: вызовов {stats.total_calls}, CPU в цикле {stats.total_tt:.2f} с"
+    blocks = ["собств. мс | всего мс | вызовов | функция"]
+    for where, calls, tottime, cumtime in top_functions(stats):
+        blocks.append(f"{tottime * 1000:.1f} | {cumtime * 1000:.1f} | {calls} | {where}")
+
+    if slow:
+        blocks.append(f"\n🐢 Медленных колбэков (≥ {slow_callback_s * 1000:g} мс): {len(slow)}")
+        blocks.extend(m[:300] for m in slow[:TOP_SLOW_CALLBACKS])
+    else:
+        blocks.append(f"\n🐢 Колбэков дольше {slow_callback_s * 1000:g} мс не было")
+    if path:
+        blocks.append(f"\nПолный профиль: {path} (python -m pstats)")
+    return pack_blocks(header, blocks, "\n")
+
+
+class Profiler:
+    # Пока сессии нет, ничего не установлено: ни sys.setprofile, ни debug-режима цикла
+    def __init__(self, *, max_seconds: float, slow_callback_s: float, directory: str):
+        self.max_seconds = max_seconds
+        self.slow_callback_s = slow_callback_s
+        self.directory = directory
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, chat_id: int, seconds: float) -> float:
+        seconds = max(1.0, min(float(seconds), self.max_seconds))
+        self._task = asyncio.create_task(self._run(chat_id, seconds))
+        return seconds
+
+    async def profile(self, seconds: float) -> Tuple[cProfile.Profile, List[str]]:
+        # Медленные колбэки меряются подменой Handle._run только на время сессии. Debug-режим
+        # цикла умеет то же, но снимает стек на каждый call_soon и сам становится вершиной профиля
+        slow: List[str] = []
+        threshold = self.slow_callback_s
+        original = asyncio.Handle._run
+        clock = time.perf_counter
+
+        def timed_run(handle: asyncio.Handle):
+            started = clock()
+            original(handle)
+            took = clock() - started
+            if took >= threshold:
+                slow.append(f"{_describe(handle)}: {took * 1000:.0f} мс")
+
+        asyncio.Handle._run = timed_run
+        # cProfile видит только поток цикла событий: работа в asyncio.to_thread и geo-воркерах не попадёт
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            asyncio.Handle._run = original
+        for message in slow:
+            logging.warning("Медленный колбэк цикла событий: %s", message)
+        return profile, slow
+
+    async def _run(self, chat_id: int, seconds: float):
+        try:
+            logging.info("Профилирование на %g с по запросу %s", seconds, chat_id)
+            profile, slow = await self.profile(seconds)
+            stats = pstats.Stats(profile)
+
+            path = None
+            if self.directory:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+                stats.dump_stats(path)
+
+            for text in render_profile(seconds, stats, slow, self.slow_callback_s, path):
+                delivery.send_message(chat_id, text)
+            if path:
+                delivery.send_document(chat_id, path)
+        except Exception as e:
+            logging.exception("Ошибка профилирования: %s", e)
+            delivery.send_message(chat_id, f"Профилирование не удалось: {e}")
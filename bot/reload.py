@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Optional
+
+from . import context
+from .absence import absence_scheduler
+from .config_loader import load_config
+from .context import CONFIG_PATH, CONFIG_CACHE_PATH, CONFIG_RELOAD_INTERVAL, user_states
+from .geo import reconcile_user_zones
+from .workers import geo_workers
+
+RECONCILE_CHUNK = 1000
+
+_reload_lock = asyncio.Lock()
+
+
+def _config_mtime() -> Optional[float]:
+    try:
+        return os.stat(CONFIG_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def _load_config():
+    return load_config(CONFIG_PATH, CONFIG_CACHE_PATH)
+
+
+async def reload_config() -> bool:
+    async with _reload_lock:
+        try:
+            new_cfg = await asyncio.to_thread(_load_config)
+        except Exception as e:
+            logging.warning("Не удалось перезагрузить конфиг %s, остаётся старый: %s", CONFIG_PATH, e)
+            return False
+
+        context.CONFIG = new_cfg
+        logging.info(
+            "Конфиг перезагружен: %d зон, %d админов",
+            len(new_cfg.zones), len(new_cfg.telegram.admins),
+        )
+
+        absence_scheduler.reset()
+
+        if geo_workers.enabled:
+            changed = await geo_workers.reload(new_cfg)
+        else:
+            user_ids = list(user_states.keys())
+            changed = 0
+            for i in range(0, len(user_ids), RECONCILE_CHUNK):
+                changed += len(reconcile_user_zones(user_ids[i:i + RECONCILE_CHUNK]))
+                await asyncio.sleep(0)
+        if changed:
+            logging.info("После перезагрузки конфига пересчитаны зоны у %d пользователей", changed)
+        return True
+
+
+async def config_watcher():
+    trigger = asyncio.Event()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, trigger.set)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass
+
+    timeout = CONFIG_RELOAD_INTERVAL if CONFIG_RELOAD_INTERVAL > 0 else None
+    last_mtime = _config_mtime()
+    while True:
+        try:
+            try:
+                await asyncio.wait_for(trigger.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            forced = trigger.is_set()
+            trigger.clear()
+
+            mtime = _config_mtime()
+            if forced or (mtime is not None and mtime != last_mtime):
+                last_mtime = mtime
+                await reload_config()
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logging.exception("Ошибка в config_watcher: %s", e)
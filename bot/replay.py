@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Tuple
+
+# стадии меряются теми же гистограммами, что и /metrics, но без HTTP-сервера
+os.environ.setdefault("METRICS_COLLECT", "1")
+
+from aiogram.types import Chat, Location, Message, User  # noqa: E402
+
+from .loadtest import StubBot  # noqa: E402
+from . import context, metrics  # noqa: E402
+from .delivery import delivery  # noqa: E402
+from .digest import digest  # noqa: E402
+from .handlers import on_message, on_edited, location_mailbox  # noqa: E402
+
+
+KINDS = ("start", "update", "end", "single")
+LIVE_PERIOD = 3600
+
+
+class TracePoint(NamedTuple):
+    t: float
+    user_id: int
+    lat: float
+    lon: float
+    kind: str
+
+
+Replayed = Tuple[float, Callable[[Message], Awaitable], Message]
+
+
+def read_trace(path: str) -> List[TracePoint]:
+    points = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            raw = json.loads(line)
+            kind = raw.get("kind", "update")
+            if kind not in KINDS:
+                raise ValueError(f"{path}:{line_no}: неизвестный kind {kind!r}")
+            points.append(TracePoint(float(raw["t"]), int(raw["user"]), float(raw["lat"]), float(raw["lon"]), kind))
+    points.sort(key=lambda p: p.t)
+    return points
+
+
+def write_trace(path: str, points: List[TracePoint]):
+    with open(path, "w", encoding="utf-8") as f:
+        for p in points:
+            f.write(json.dumps({"t": round(p.t, 3), "user": p.user_id, "lat": p.lat, "lon": p.lon, "kind": p.kind}))
+            f.write("\n")
+
+
+def synthetic_trace(users: int, updates_per_user: int, interval: float, seed: int = 1) -> List[TracePoint]:
+    rnd = random.Random(seed)
+    centers = [(z.center_lat, z.center_lng) for z in context.CONFIG.zones] or [(55.75, 37.62)]
+    points = []
+    for uid in range(1, users + 1):
+        lat, lon = rnd.choice(centers)
+        t = rnd.uniform(0, interval)
+        points.append(TracePoint(t, uid, lat, lon, "start"))
+        for _ in range(updates_per_user):
+            t += interval * rnd.uniform(0.5, 1.5)
+            lat += rnd.gauss(0, 0.0003)
+            lon += rnd.gauss(0, 0.0005)
+            points.append(TracePoint(t, uid, lat, lon, "update"))
+        points.append(TracePoint(t + interval, uid, lat, lon, "end"))
+    points.sort(key=lambda p: p.t)
+    return points
+
+
+def build_messages(points: List[TracePoint]) -> List[Replayed]:
+    # Message собираются заранее: валидация pydantic не должна попадать в замер
+    now = datetime.now(timezone.utc)
+    users: Dict[int, User] = {}
+    sessions: Dict[int, int] = {}
+    next_id = 1
+    out: List[Replayed] = []
+    for p in points:
+        user = users.get(p.user_id)
+        if user is None:
+            user = users[p.user_id] = User(id=p.user_id, is_bot=False, first_name=f"user{p.user_id}")
+
+        if p.kind in ("start", "single") or p.user_id not in sessions:
+            sessions[p.user_id] = message_id = next_id
+            next_id += 1
+        else:
+            message_id = sessions[p.user_id]
+
+        live = LIVE_PERIOD if p.kind in ("start", "update") else None
+        edited = p.kind in ("update", "end")
+        msg = Message(
+            message_id=message_id,
+            date=now,
+            chat=Chat(id=p.user_id, type="private"),
+            from_user=user,
+            location=Location(latitude=p.lat, longitude=p.lon, live_period=live),
+            edit_date=int(now.timestamp()) if edited else None,
+        )
+        out.append((p.t, on_edited if edited else on_message, msg))
+    return out
+
+
+async def replay(messages: List[Replayed], *, speed: float, concurrency: int) -> List[float]:
+    sem = asyncio.Semaphore(max(1, concurrency))
+    latencies: List[float] = []
+    tasks = []
+
+    async def handle(handler, msg):
+        started = time.perf_counter()
+        try:
+            await handler(msg)
+        except Exception as e:
+            logging.warning("Обработчик упал на message_id=%s: %s", msg.message_id, e)
+        finally:
+            latencies.append(time.perf_counter() - started)
+            sem.release()
+
+    t0 = time.perf_counter()
+    for t, handler, msg in messages:
+        if speed > 0:
+            delay = t0 + t / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await sem.acquire()
+        tasks.append(asyncio.create_task(handle(handler, msg)))
+    await asyncio.gather(*tasks)
+    return sorted(latencies)
+
+
+def _exact(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+STAGES = (
+    ("location_update", metrics.update_seconds, ()),
+    ("geo_update", metrics.geo_update_seconds, ()),
+    ("geo_batch", metrics.geo_batch_seconds, ()),
+    ("notify_fanout", metrics.fanout_seconds, ()),
+    ("send_message", metrics.telegram_request_seconds, ("send_message",)),
+    ("send_location", metrics.telegram_request_seconds, ("send_location",)),
+)
+
+
+def build_report(updates: int, elapsed: float, latencies: List[float], stub: StubBot) -> Dict:
+    stages = {}
+    for name, hist, labels in STAGES:
+        n = hist.count(*labels)
+        if n:
+            stages[name] = {
+                "count": n,
+                "p50_ms": hist.quantile(0.5, *labels) * 1000,
+                "p99_ms": hist.quantile(0.99, *labels) * 1000,
+            }
+
+    sends: Dict[str, int] = {}
+    for method, *_ in stub.calls:
+        sends[method] = sends.get(method, 0) + 1
+
+    return {
+        "updates": updates,
+        "seconds": elapsed,
+        "rate": updates / elapsed if elapsed else 0.0,
+        "e2e_p50_ms": _exact(latencies, 0.5) * 1000,
+        "e2e_p99_ms": _exact(latencies, 0.99) * 1000,
+        "stages": stages,
+        "events": {key[0]: int(v) for key, v in metrics.events_total.values().items()},
+        "sends": sends,
+        "injected_errors": stub.errors,
+        "send_failures": int(sum(metrics.send_failures_total.values().values())),
+        "mailbox": location_mailbox.stats(),
+    }
+
+
+def print_report(report: Dict):
+    print(
+        f"updates={report['updates']} time={report['seconds']:.2f}s rate={report['rate']:.0f}/s "
+        f"e2e p50={report['e2e_p50_ms']:.3f}ms p99={report['e2e_p99_ms']:.3f}ms"
+    )
+    for name, st in report["stages"].items():
+        print(f"  {name:<16} n={st['count']:<8} p50={st['p50_ms']:.3f}ms p99={st['p99_ms']:.3f}ms")
+    print("events " + " ".join(f"{k}={v}" for k, v in sorted(report["events"].items())))
+    print(
+        "sends " + " ".join(f"{k}={v}" for k, v in sorted(report["sends"].items()))
+        + f" injected_errors={report['injected_errors']} failures={report['send_failures']}"
+    )
+    print("mailbox " + " ".join(f"{k}={v}" for k, v in report["mailbox"].items()))
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    problems = []
+    if report["rate"] < baseline["rate"] * (1 - tolerance):
+        problems.append(f"пропускная способность {report['rate']:.0f}/s < {baseline['rate']:.0f}/s")
+    if report["e2e_p99_ms"] > baseline["e2e_p99_ms"] * (1 + tolerance):
+        problems.append(f"e2e p99 {report['e2e_p99_ms']:.3f}ms > {baseline['e2e_p99_ms']:.3f}ms")
+    for name, st in report["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base and st["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            problems.append(f"{name} p50 {st['p50_ms']:.3f}ms > {base['p50_ms']:.3f}ms")
+
+    # без склейки в очереди набор событий однозначно задаётся трассой и конфигом
+    def exact(r):
+        return not r["mailbox"].get("coalesced") and not r["mailbox"].get("dropped")
+
+    if exact(report) and exact(baseline) and report["events"] != baseline["events"]:
+        problems.append(f"события {report['events']} != {baseline['events']}")
+    return problems
+
+
+async def main() -> int:
+    parser = argparse.ArgumentParser(description="Прогон трассы локаций через on_message/on_edited без Telegram")
+    parser.add_argument("--trace", help="JSONL-трасса: {\"t\", \"user\", \"lat\", \"lon\", \"kind\"}")
+    parser.add_argument("--record", help="сохранить сгенерированную трассу в файл")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates-per-user", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=30.0, help="интервал между точками в трассе, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--speed", type=float, default=0.0, help="ускорение времени трассы (0 — без пауз)")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--send-latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-kind", choices=("forbidden", "network", "retry-after"), default="forbidden")
+    parser.add_argument("--json-out", help="записать отчёт в JSON")
+    parser.add_argument("--baseline", help="JSON-отчёт для сравнения; при регрессии код выхода 1")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+
+    if args.trace:
+        points = read_trace(args.trace)
+    else:
+        points = synthetic_trace(args.users, args.updates_per_user, args.interval, args.seed)
+        if args.record:
+            write_trace(args.record, points)
+    messages = build_messages(points)
+
+    stub = StubBot(args.send_latency_ms / 1000.0, args.error_rate, args.error_kind, args.seed)
+    delivery.bot = stub
+
+    started = time.perf_counter()
+    latencies = await replay(messages, speed=args.speed, concurrency=args.concurrency)
+    elapsed = time.perf_counter() - started
+    digest.flush_all()
+    await delivery.drain()
+
+    report = build_report(len(messages), elapsed, latencies, stub)
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for p in problems:
+            print("РЕГРЕССИЯ: " + p)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Optional, Tuple
+
+from .models import TelegramAdmin, TelegramConfig, TelegramGlobal
+
+
+AdminRoute = Tuple[TelegramAdmin, TelegramGlobal]
+
+
+def effective_admin_flags(admin: TelegramAdmin, global_cfg: TelegramGlobal) -> TelegramGlobal:
+    if not admin.override:
+        return global_cfg
+    return TelegramGlobal(
+        notify_location_start=admin.notify_location_start,
+        notify_location_stop=admin.notify_location_stop,
+        notify_absent_enabled=admin.notify_absent_enabled,
+        notify_absent_minutes=admin.notify_absent_minutes,
+        send_current_location_with_alert=admin.send_current_location_with_alert,
+        digest_window_s=admin.digest_window_s,
+        digest_danger_immediate=admin.digest_danger_immediate,
+    )
+
+
+@dataclass(frozen=True)
+class RoutingTable:
+    accept_any: bool
+    allowed_users: FrozenSet[int]
+    config_names: Dict[int, str]
+    admins: Tuple[AdminRoute, ...]
+    effective: Dict[int, TelegramGlobal]
+    all_zone_admins: Tuple[AdminRoute, ...]
+    zone_admins: Dict[int, Tuple[AdminRoute, ...]]
+
+    def is_allowed(self, user_id: int) -> bool:
+        return self.accept_any or user_id in self.allowed_users
+
+    def config_name(self, user_id: int) -> Optional[str]:
+        return self.config_names.get(user_id)
+
+    def admins_for_zone(self, zone_id: int) -> Tuple[AdminRoute, ...]:
+        return self.zone_admins.get(zone_id, self.all_zone_admins)
+
+
+def build_routing_table(telegram: TelegramConfig) -> RoutingTable:
+    af = telegram.accept_from
+
+    config_names: Dict[int, str] = {}
+    for u in reversed(af.users):
+        if u.name:
+            config_names[u.id] = u.name
+    admin_names: Dict[int, str] = {}
+    for a in reversed(telegram.admins):
+        if a.name:
+            admin_names[a.id] = a.name
+    config_names.update(admin_names)
+
+    admins = tuple(
+        (a, effective_admin_flags(a, telegram.global_cfg))
+        for a in telegram.admins
+    )
+
+    all_zone_idx = [i for i, (a, _) in enumerate(admins) if not a.zones]
+    filtered_idx: Dict[int, list] = {}
+    for i, (a, _) in enumerate(admins):
+        for zid in set(a.zones):
+            filtered_idx.setdefault(zid, []).append(i)
+
+    zone_admins: Dict[int, Tuple[AdminRoute, ...]] = {
+        zid: tuple(admins[i] for i in sorted(all_zone_idx + idx))
+        for zid, idx in filtered_idx.items()
+    }
+
+    return RoutingTable(
+        accept_any=af.mode == "any",
+        allowed_users=frozenset(u.id for u in af.users),
+        config_names=config_names,
+        admins=admins,
+        effective={a.id: eff for a, eff in admins},
+        all_zone_admins=tuple(admins[i] for i in all_zone_idx),
+        zone_admins=zone_admins,
+    )
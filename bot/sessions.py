@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .context import state_store
+from .models import LiveSession
+
+
+SessionKey = Tuple[int, int]
+ExpiredHandler = Callable[[LiveSession], Awaitable[Any]]
+
+# live_period, при котором Telegram не ограничивает трансляцию по времени
+LIVE_PERIOD_FOREVER = 0x7FFFFFFF
+
+
+class LiveSessionTable:
+    # Таблица активных трансляций по (chat_id, message_id). Сроки лежат в колесе таймеров:
+    # ячейка = номер тика дедлайна по модулю числа ячеек, за тик просматривается одна ячейка.
+    # Перенос дедлайна не ищет старую ячейку — устаревшая запись выкидывается при её просмотре
+    def __init__(
+        self,
+        on_expired: ExpiredHandler,
+        *,
+        tick_s: float = 5.0,
+        slots: int = 1024,
+        idle_s: float = 86400.0,
+    ):
+        self._on_expired = on_expired
+        self.tick_s = tick_s
+        self.slots = max(1, slots)
+        self.idle_s = idle_s
+        self._sessions: Dict[SessionKey, LiveSession] = {}
+        self._wheel: List[Set[SessionKey]] = [set() for _ in range(self.slots)]
+        self._tick: Optional[int] = None
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def __contains__(self, key: SessionKey) -> bool:
+        return key in self._sessions
+
+    def get(self, chat_id: int, message_id: int) -> Optional[LiveSession]:
+        return self._sessions.get((chat_id, message_id))
+
+    def _tick_of(self, ts: float) -> int:
+        # дедлайн округляется вверх: сессия не снимается раньше своего срока
+        return -int(-ts // self.tick_s)
+
+    def _deadline(self, started: float, live_period: int, now: float) -> float:
+        if live_period >= LIVE_PERIOD_FOREVER:
+            # бессрочная трансляция снимается, если от неё долго нет обновлений
+            return now + self.idle_s
+        # последняя правка может прийти на самой границе периода — даём ещё тик
+        return started + live_period + self.tick_s
+
+    def _slot_of(self, session: LiveSession) -> int:
+        tick = self._tick_of(session.expires)
+        if self._tick is not None and tick <= self._tick:
+            # срок уже прошёл — попадёт в ближайший проход, а не через оборот колеса
+            tick = self._tick + 1
+        return tick % self.slots
+
+    def _schedule(self, key: SessionKey, session: LiveSession):
+        self._wheel[self._slot_of(session)].add(key)
+
+    def start(
+        self,
+        chat_id: int,
+        message_id: int,
+        user_id: int,
+        user_name: Optional[str],
+        started: float,
+        live_period: int,
+        now: Optional[float] = None,
+    ) -> LiveSession:
+        if now is None:
+            now = time.time()
+        key = (chat_id, message_id)
+        session = LiveSession(
+            chat_id, message_id, user_id, user_name, started, live_period,
+            self._deadline(started, live_period, now),
+        )
+        self._sessions[key] = session
+        self._schedule(key, session)
+        state_store.put_session(session)
+        return session
+
+    def touch(self, chat_id: int, message_id: int, live_period: int, now: Optional[float] = None) -> bool:
+        session = self._sessions.get((chat_id, message_id))
+        if session is None:
+            return False
+        if now is None:
+            now = time.time()
+        if live_period == session.live_period and live_period < LIVE_PERIOD_FOREVER:
+            return True
+
+        # период продлили правкой или трансляция бессрочная — сдвигаем дедлайн
+        old_slot = self._slot_of(session)
+        session.live_period = live_period
+        session.expires = self._deadline(session.started, live_period, now)
+        if self._slot_of(session) != old_slot:
+            self._schedule((chat_id, message_id), session)
+        state_store.put_session(session)
+        return True
+
+    def end(self, chat_id: int, message_id: int) -> Optional[LiveSession]:
+        key = (chat_id, message_id)
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self._wheel[self._slot_of(session)].discard(key)
+            state_store.remove_session(chat_id, message_id)
+        return session
+
+    def restore(self, sessions: Iterable[LiveSession]):
+        for session in sessions:
+            key = (session.chat_id, session.message_id)
+            if key not in self._sessions:
+                self._sessions[key] = session
+                self._schedule(key, session)
+
+    def forget(self, keep: Callable[[LiveSession], bool]) -> int:
+        # сессии, переехавшие к другому инстансу: убираются только из памяти, в хранилище остаются
+        dropped = [key for key, s in self._sessions.items() if not keep(s)]
+        for key in dropped:
+            session = self._sessions.pop(key)
+            self._wheel[self._slot_of(session)].discard(key)
+        return len(dropped)
+
+    def sweep(self, now: float) -> List[LiveSession]:
+        now_tick = int(now // self.tick_s)
+        # первый проход и проход после долгой паузы смотрят колесо целиком: сессии из restore
+        # и поставленные до первого прохода могли уже истечь и лежат в ячейках прошлых тиков
+        first = now_tick - self.slots + 1
+        if self._tick is not None:
+            first = max(first, self._tick + 1)
+        self._tick = now_tick
+
+        expired: List[LiveSession] = []
+        for tick in range(first, now_tick + 1):
+            slot = tick % self.slots
+            bucket = self._wheel[slot]
+            if not bucket:
+                continue
+            for key in list(bucket):
+                session = self._sessions.get(key)
+                if session is None:
+                    bucket.discard(key)
+                    continue
+                expires_tick = self._tick_of(session.expires)
+                if expires_tick <= now_tick:
+                    bucket.discard(key)
+                    del self._sessions[key]
+                    state_store.remove_session(*key)
+                    expired.append(session)
+                elif self._slot_of(session) != slot:
+                    bucket.discard(key)
+        self.expired += len(expired)
+        return expired
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.tick_s)
+                for session in self.sweep(time.time()):
+                    await self._on_expired(session)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.exception("Ошибка при снятии истёкших live-сессий: %s", e)
@@ -0,0 +1,98 @@
+import math
+from typing import Dict, Iterable, List, Tuple
+
+from .models import Zone
+
+
+EARTH_RADIUS_M = 6371000.0
+METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180.0
+
+MIN_CELL_DEG = 0.001
+MAX_CELL_DEG = 1.0
+# зона, покрывающая больше ячеек, проверяется для любой точки
+MAX_CELLS_PER_ZONE = 4096
+
+
+def zone_bbox(zone: Zone, pad_m: float = 0.0) -> Tuple[float, float, float, float]:
+    # pad_m расширяет рамку на столько метров во все стороны (гистерезис удерживает точку в зоне дальше радиуса)
+    if zone.geometry is not None:
+        min_lat, min_lng, max_lat, max_lng = zone.geometry.bbox
+        if not pad_m:
+            return min_lat, min_lng, max_lat, max_lng
+        dlat = pad_m / METERS_PER_DEG_LAT
+        min_lat = max(-90.0, min_lat - dlat)
+        max_lat = min(90.0, max_lat + dlat)
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        dlng = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+        return min_lat, min_lng - dlng, max_lat, max_lng + dlng
+    dlat = (zone.radius_m + pad_m) / METERS_PER_DEG_LAT
+    cos_lat = math.cos(math.radians(zone.center_lat))
+    if cos_lat < 1e-6:
+        dlng = 180.0
+    else:
+        dlng = min(180.0, dlat / cos_lat)
+    return (
+        max(-90.0, zone.center_lat - dlat),
+        zone.center_lng - dlng,
+        min(90.0, zone.center_lat + dlat),
+        zone.center_lng + dlng,
+    )
+
+
+def _extent_deg(zone: Zone) -> float:
+    if zone.geometry is None:
+        return 2.0 * zone.radius_m / METERS_PER_DEG_LAT
+    min_lat, min_lng, max_lat, max_lng = zone.geometry.bbox
+    return max(max_lat - min_lat, max_lng - min_lng)
+
+
+def _pick_cell_deg(zones: List[Zone]) -> float:
+    if not zones:
+        return MAX_CELL_DEG
+    diameters = sorted(_extent_deg(z) for z in zones)
+    median = diameters[len(diameters) // 2]
+    return min(MAX_CELL_DEG, max(MIN_CELL_DEG, median))
+
+
+class ZoneIndex:
+    def __init__(self, zones: Iterable[Zone], pad_m: float = 0.0):
+        self.zones: List[Zone] = list(zones)
+        self.pad_m = pad_m
+        self.cell_deg = _pick_cell_deg(self.zones)
+        self.n_cols = int(math.ceil(360.0 / self.cell_deg))
+        self.cells: Dict[Tuple[int, int], List[Zone]] = {}
+        self.always: List[Zone] = []
+
+        for z in self.zones:
+            self._insert(z)
+
+    def _col(self, lng: float) -> int:
+        return int(math.floor((lng + 180.0) / self.cell_deg)) % self.n_cols
+
+    def _row(self, lat: float) -> int:
+        return int(math.floor((lat + 90.0) / self.cell_deg))
+
+    def cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return self._row(lat), self._col(lng)
+
+    def _insert(self, zone: Zone):
+        min_lat, min_lng, max_lat, max_lng = zone_bbox(zone, self.pad_m)
+        row0, row1 = self._row(min_lat), self._row(max_lat)
+        col0 = int(math.floor((min_lng + 180.0) / self.cell_deg))
+        col1 = int(math.floor((max_lng + 180.0) / self.cell_deg))
+        n_rows = row1 - row0 + 1
+        n_cols = min(self.n_cols, col1 - col0 + 1)
+        if n_rows * n_cols > MAX_CELLS_PER_ZONE:
+            self.always.append(zone)
+            return
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col0 + n_cols):
+                self.cells.setdefault((row, col % self.n_cols), []).append(zone)
+
+    def candidates(self, lat: float, lng: float) -> List[Zone]:
+        bucket = self.cells.get(self.cell_of(lat, lng))
+        if not self.always:
+            return bucket or []
+        if not bucket:
+            return self.always
+        return bucket + self.always
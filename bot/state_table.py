@@ -0,0 +1,205 @@
+from array import array
+from datetime import datetime, timezone
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .models import UserState
+
+
+_EMPTY: Tuple[int, ...] = ()
+_NO_ANCHOR = -1.0
+
+
+class UserStateView:
+    __slots__ = ("_table", "_slot", "user_id")
+
+    def __init__(self, table: "UserStateTable", slot: int, user_id: int):
+        self._table = table
+        self._slot = slot
+        self.user_id = user_id
+
+    @property
+    def last_lat(self) -> float:
+        return self._table._lat[self._slot]
+
+    @property
+    def last_lng(self) -> float:
+        return self._table._lng[self._slot]
+
+    @property
+    def last_ts(self) -> float:
+        return self._table._ts[self._slot]
+
+    @property
+    def last_time(self) -> datetime:
+        return datetime.fromtimestamp(self._table._ts[self._slot], timezone.utc)
+
+    @property
+    def current_zone_ids(self) -> FrozenSet[int]:
+        return frozenset(self._table._zones[self._slot])
+
+    @property
+    def notified_admins(self) -> Set[int]:
+        notified = self._table._notified[self._slot]
+        if notified is None:
+            notified = self._table._notified[self._slot] = set()
+        return notified
+
+    def has_notified(self) -> bool:
+        return bool(self._table._notified[self._slot])
+
+    def to_state(self) -> UserState:
+        return UserState(
+            last_lat=self.last_lat,
+            last_lng=self.last_lng,
+            last_time=self.last_time,
+            current_zone_ids=set(self._table._zones[self._slot]),
+            notified_admins=set(self._table._notified[self._slot] or ()),
+        )
+
+    def __repr__(self) -> str:
+        return f"UserStateView(user_id={self.user_id}, {self.to_state()!r})"
+
+
+class UserStateTable:
+    def __init__(self):
+        self._slots: Dict[int, int] = {}
+        self._free: List[int] = []
+        self._lat = array("d")
+        self._lng = array("d")
+        self._ts = array("d")
+        self._zones: List[Tuple[int, ...]] = []
+        self._notified: List[Optional[Set[int]]] = []
+        # кэш geo: ячейка индекса, точка полного пересчёта и запас до границы
+        self._cell_row = array("q")
+        self._cell_col = array("q")
+        self._anchor_lat = array("d")
+        self._anchor_lng = array("d")
+        self._margin = array("d")
+
+    def _alloc(self, user_id: int) -> int:
+        if self._free:
+            slot = self._free.pop()
+        else:
+            slot = len(self._lat)
+            for arr in (self._lat, self._lng, self._ts, self._anchor_lat, self._anchor_lng):
+                arr.append(0.0)
+            self._margin.append(_NO_ANCHOR)
+            self._cell_row.append(0)
+            self._cell_col.append(0)
+            self._zones.append(_EMPTY)
+            self._notified.append(None)
+        self._slots[user_id] = slot
+        return slot
+
+    def set_position(
+        self,
+        user_id: int,
+        lat: float,
+        lng: float,
+        ts: float,
+        zone_ids: Iterable[int],
+    ) -> UserStateView:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._alloc(user_id)
+        self._lat[slot] = lat
+        self._lng[slot] = lng
+        self._ts[slot] = ts
+        self._zones[slot] = tuple(sorted(zone_ids)) or _EMPTY
+        self._notified[slot] = None
+        return UserStateView(self, slot, user_id)
+
+    def set_zones(self, user_id: int, zone_ids: Iterable[int]):
+        slot = self._slots[user_id]
+        self._zones[slot] = tuple(sorted(zone_ids)) or _EMPTY
+
+    def anchor(self, user_id: int) -> Optional[Tuple[Tuple[int, int], float, float, float]]:
+        slot = self._slots.get(user_id)
+        if slot is None or self._margin[slot] < 0:
+            return None
+        return (
+            (self._cell_row[slot], self._cell_col[slot]),
+            self._anchor_lat[slot],
+            self._anchor_lng[slot],
+            self._margin[slot],
+        )
+
+    def set_anchor(self, user_id: int, cell: Tuple[int, int], lat: float, lng: float, margin: float):
+        slot = self._slots[user_id]
+        self._cell_row[slot], self._cell_col[slot] = cell
+        self._anchor_lat[slot] = lat
+        self._anchor_lng[slot] = lng
+        self._margin[slot] = margin
+
+    def clear_anchor(self, user_id: int):
+        slot = self._slots.get(user_id)
+        if slot is not None:
+            self._margin[slot] = _NO_ANCHOR
+
+    def get(self, user_id: int, default=None) -> Optional[UserStateView]:
+        slot = self._slots.get(user_id)
+        if slot is None:
+            return default
+        return UserStateView(self, slot, user_id)
+
+    def __getitem__(self, user_id: int) -> UserStateView:
+        return UserStateView(self, self._slots[user_id], user_id)
+
+    def __setitem__(self, user_id: int, state: UserState):
+        view = self.set_position(
+            user_id,
+            state.last_lat,
+            state.last_lng,
+            state.last_time.timestamp(),
+            state.current_zone_ids,
+        )
+        # состояние пришло извне geo (хранилище, другой инстанс кластера): кэш запаса относится
+        # к прежним зонам и позиции, с ним geo оставил бы подменённые зоны без пересчёта
+        self._margin[view._slot] = _NO_ANCHOR
+        if state.notified_admins:
+            self._notified[view._slot] = set(state.notified_admins)
+
+    def __delitem__(self, user_id: int):
+        slot = self._slots.pop(user_id)
+        self._zones[slot] = _EMPTY
+        self._notified[slot] = None
+        self._margin[slot] = _NO_ANCHOR
+        self._free.append(slot)
+
+    def pop(self, user_id: int, default=None):
+        view = self.get(user_id)
+        if view is None:
+            return default
+        state = view.to_state()
+        del self[user_id]
+        return state
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._slots
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._slots)
+
+    def __bool__(self) -> bool:
+        return bool(self._slots)
+
+    def keys(self):
+        return self._slots.keys()
+
+    def items(self) -> Iterator[Tuple[int, UserStateView]]:
+        for user_id, slot in self._slots.items():
+            yield user_id, UserStateView(self, slot, user_id)
+
+    def values(self) -> Iterator[UserStateView]:
+        for user_id, slot in self._slots.items():
+            yield UserStateView(self, slot, user_id)
+
+    def update(self, states: Dict[int, UserState]):
+        for user_id, state in states.items():
+            self[user_id] = state
+
+    def clear(self):
+        self.__init__()
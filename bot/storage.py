@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from .models import LiveSession, UserState
+
+
+LoadedState = Tuple[Dict[int, UserState], List[LiveSession]]
+SessionKey = Tuple[int, int]
+# несброшенные изменения SqliteBackend: пользователи, сессии, снятые и добавленные отметки «нет локации»
+Batch = Tuple[Dict[int, UserState], Dict[SessionKey, Optional[LiveSession]], Set[int], Dict[int, Set[int]]]
+
+
+class StateBackend:
+    def load(self) -> LoadedState:
+        return {}, []
+
+    def put_user(self, user_id: int, state: UserState):
+        pass
+
+    def put_session(self, session: LiveSession):
+        pass
+
+    def remove_session(self, chat_id: int, message_id: int):
+        pass
+
+    def add_notified(self, user_id: int, admin_id: int):
+        pass
+
+    def clear_notified(self, user_id: int):
+        pass
+
+    async def flush(self):
+        pass
+
+    async def run(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    pass
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    ts REAL NOT NULL,
+    zones TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    user_name TEXT,
+    started REAL NOT NULL,
+    live_period INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS notified (
+    user_id INTEGER NOT NULL,
+    admin_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, admin_id)
+);
+CREATE TABLE IF NOT EXISTS log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    a INTEGER NOT NULL,
+    b INTEGER,
+    lat REAL,
+    lng REAL,
+    ts REAL,
+    zones TEXT
+);
+"""
+
+_LOG_INSERT = "INSERT INTO log (kind, a, b, lat, lng, ts, zones) VALUES (?, ?, ?, ?, ?, ?, ?)"
+_LOG_LATEST_USERS = """
+SELECT a, lat, lng, ts, zones FROM log
+WHERE seq IN (SELECT MAX(seq) FROM log WHERE kind = 'user' AND seq <= ? GROUP BY a)
+"""
+_LOG_OTHER = "SELECT seq, kind, a, b FROM log WHERE kind != 'user' AND seq <= ? ORDER BY seq"
+# сессий на порядки меньше, чем обновлений локаций, поэтому они пишутся сразу в таблицу, минуя лог
+_SESSION_UPSERT = "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?)"
+_SESSION_DELETE = "DELETE FROM sessions WHERE chat_id = ? AND message_id = ?"
+
+
+def encode_zones(zone_ids: Set[int]) -> str:
+    return ",".join(str(z) for z in sorted(zone_ids))
+
+
+def decode_zones(raw: str) -> Set[int]:
+    return {int(z) for z in raw.split(",") if z}
+
+
+class SqliteBackend(StateBackend):
+    def __init__(self, path: str, *, flush_interval: float = 1.0, checkpoint_rows: int = 100_000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.checkpoint_rows = checkpoint_rows
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._log_rows = self._conn.execute("SELECT COUNT(*) FROM log").fetchone()[0]
+
+        # изменения копятся по ключу, так что буфер не больше числа пользователей/сессий
+        self._dirty_users: Dict[int, UserState] = {}
+        self._dirty_sessions: Dict[SessionKey, Optional[LiveSession]] = {}
+        self._cleared_notified: Set[int] = set()
+        self._added_notified: Dict[int, Set[int]] = {}
+
+    def load(self) -> LoadedState:
+        users: Dict[int, UserState] = {}
+        sessions: List[LiveSession] = []
+        notified: Dict[int, Set[int]] = {}
+
+        with self._db_lock:
+            for user_id, lat, lng, ts, zones in self._conn.execute("SELECT * FROM users"):
+                users[user_id] = make_state(lat, lng, ts, zones)
+            sessions.extend(LiveSession(*row) for row in self._conn.execute("SELECT * FROM sessions"))
+            for user_id, admin_id in self._conn.execute("SELECT user_id, admin_id FROM notified"):
+                notified.setdefault(user_id, set()).add(admin_id)
+
+            last_seq = self._last_seq()
+            for user_id, lat, lng, ts, zones in self._conn.execute(_LOG_LATEST_USERS, (last_seq,)):
+                users[user_id] = make_state(lat, lng, ts, zones)
+            for _, kind, a, b in self._conn.execute(_LOG_OTHER, (last_seq,)):
+                if kind == "ntf+":
+                    notified.setdefault(a, set()).add(b)
+                elif kind == "ntf-":
+                    notified.pop(a, None)
+
+        logging.info(
+            "Состояние восстановлено из %s: %d пользователей, %d live-сессий",
+            self.path, len(users), len(sessions),
+        )
+        for user_id, admins in notified.items():
+            state = users.get(user_id)
+            if state is not None:
+                state.notified_admins = admins
+        return users, sessions
+
+    def put_user(self, user_id: int, state: UserState):
+        self._dirty_users[user_id] = state
+
+    def put_session(self, session: LiveSession):
+        self._dirty_sessions[(session.chat_id, session.message_id)] = session
+
+    def remove_session(self, chat_id: int, message_id: int):
+        self._dirty_sessions[(chat_id, message_id)] = None
+
+    def add_notified(self, user_id: int, admin_id: int):
+        self._added_notified.setdefault(user_id, set()).add(admin_id)
+
+    def clear_notified(self, user_id: int):
+        self._cleared_notified.add(user_id)
+        self._added_notified.pop(user_id, None)
+
+    def _take_batch(self) -> Batch:
+        batch = (self._dirty_users, self._dirty_sessions, self._cleared_notified, self._added_notified)
+        self._dirty_users = {}
+        self._dirty_sessions = {}
+        self._cleared_notified = set()
+        self._added_notified = {}
+        return batch
+
+    def _restore_batch(self, batch: Batch):
+        # пакет не записан: возвращаем его под то, что успело накопиться, — более новое важнее
+        users, sessions, cleared, added = batch
+        users.update(self._dirty_users)
+        sessions.update(self._dirty_sessions)
+        for user_id in self._cleared_notified:
+            added.pop(user_id, None)
+        for user_id, admins in self._added_notified.items():
+            added.setdefault(user_id, set()).update(admins)
+        self._dirty_users = users
+        self._dirty_sessions = sessions
+        self._cleared_notified = cleared | self._cleared_notified
+        self._added_notified = added
+
+    def _encode_batch(self, batch: Batch) -> Tuple[List[tuple], List[tuple], List[SessionKey]]:
+        users, sessions, cleared, added = batch
+        rows: List[tuple] = []
+        for user_id, st in users.items():
+            rows.append((
+                "user", user_id, None, st.last_lat, st.last_lng,
+                st.last_time.timestamp(), encode_zones(st.current_zone_ids),
+            ))
+        for user_id in cleared:
+            rows.append(("ntf-", user_id, None, None, None, None, None))
+        for user_id, admins in added.items():
+            for admin_id in admins:
+                rows.append(("ntf+", user_id, admin_id, None, None, None, None))
+
+        upserts: List[tuple] = []
+        deletes: List[SessionKey] = []
+        for key, s in sessions.items():
+            if s is None:
+                deletes.append(key)
+            else:
+                upserts.append((s.chat_id, s.message_id, s.user_id, s.user_name, s.started, s.live_period, s.expires))
+        return rows, upserts, deletes
+
+    def _last_seq(self) -> int:
+        return self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM log").fetchone()[0]
+
+    def _write(self, rows: List[tuple], upserts: List[tuple], deletes: List[SessionKey]):
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(_LOG_INSERT, rows)
+                self._conn.executemany(_SESSION_DELETE, deletes)
+                self._conn.executemany(_SESSION_UPSERT, upserts)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._log_rows += len(rows)
+            if self._log_rows >= self.checkpoint_rows:
+                # пакет уже в журнале; неудачный checkpoint повторится при следующей записи
+                try:
+                    self._checkpoint()
+                except Exception as e:
+                    logging.warning("Не удалось свернуть журнал состояния %s: %s", self.path, e)
+
+    def _checkpoint(self):
+        cur = self._conn
+        cur.execute("BEGIN")
+        try:
+            last_seq = self._last_seq()
+            cur.execute("INSERT OR REPLACE INTO users " + _LOG_LATEST_USERS, (last_seq,))
+            for _, kind, a, b in cur.execute(_LOG_OTHER, (last_seq,)).fetchall():
+                if kind == "ntf+":
+                    cur.execute("INSERT OR IGNORE INTO notified VALUES (?, ?)", (a, b))
+                elif kind == "ntf-":
+                    cur.execute("DELETE FROM notified WHERE user_id = ?", (a,))
+            cur.execute("DELETE FROM log WHERE seq <= ?", (last_seq,))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self._log_rows = 0
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch = self._take_batch()
+            rows, upserts, deletes = self._encode_batch(batch)
+            if not (rows or upserts or deletes):
+                return
+            try:
+                await asyncio.to_thread(self._write, rows, upserts, deletes)
+            except BaseException:
+                self._restore_batch(batch)
+                raise
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logging.exception("Ошибка записи состояния в %s: %s", self.path, e)
+
+    async def close(self):
+        await self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+def make_state(lat: float, lng: float, ts: float, zones: str) -> UserState:
+    return UserState(
+        last_lat=lat,
+        last_lng=lng,
+        last_time=datetime.fromtimestamp(ts, timezone.utc),
+        current_zone_ids=decode_zones(zones),
+    )
+
+
+def open_state_backend(path: Optional[str], **kwargs) -> StateBackend:
+    if not path:
+        return MemoryBackend()
+    return SqliteBackend(path, **kwargs)
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import signal
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import TelegramObject
+
+from .cluster import ClusterNode, FORWARDED_HEADER, SECRET_HEADER, update_user_id
+from .context import (
+    cluster,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    SHUTDOWN_TIMEOUT,
+)
+from .delivery import delivery
+from .digest import digest
+
+
+class InFlightMiddleware(BaseMiddleware):
+    def __init__(self, keep_samples: int = 10000):
+        self.in_flight = 0
+        self.handled = 0
+        self.durations: Deque[float] = deque(maxlen=keep_samples)
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self.in_flight += 1
+        self._idle.clear()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.durations.append(time.perf_counter() - started)
+            self.handled += 1
+            self.in_flight -= 1
+            if not self.in_flight:
+                self._idle.set()
+
+    def percentile(self, q: float) -> float:
+        if not self.durations:
+            return 0.0
+        ordered = sorted(self.durations)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    async def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+inflight = InFlightMiddleware()
+
+
+def forward_middleware(node: ClusterNode):
+    from aiohttp import web
+
+    @web.middleware
+    async def forward(request, handler):
+        # балансировщик раскидывает обновления как попало: чужого пользователя отдаём владельцу,
+        # а если владелец не ответил — обрабатываем сами, чтобы не потерять обновление
+        if request.method != "POST" or request.path != WEBHOOK_PATH or FORWARDED_HEADER in request.headers:
+            return await handler(request)
+        body = await request.read()
+        user_id = update_user_id(body)
+        if user_id is not None:
+            owner = node.owner_of(user_id)
+            if owner != node.instance_id and await node.forward(
+                owner, WEBHOOK_PATH, body, request.headers.get(SECRET_HEADER),
+            ):
+                return web.Response()
+        return await handler(request)
+
+    return forward
+
+
+def create_app(dp: Dispatcher, bot: Bot, *, secret_token: Optional[str] = WEBHOOK_SECRET):
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+    app = web.Application(middlewares=[forward_middleware(cluster)] if cluster is not None else [])
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, *, register: bool = True):
+    from aiohttp import web
+
+    dp.update.outer_middleware(inflight)
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    if register:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    logging.info("Webhook слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Остановка webhook: дожидаемся %d обработчиков", inflight.in_flight)
+        await site.stop()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        if not await inflight.wait_idle(SHUTDOWN_TIMEOUT):
+            logging.warning("Не все обработчики завершились за %.0f с", SHUTDOWN_TIMEOUT)
+        # недособранные сводки уходят сразу, не дожидаясь конца окна
+        digest.flush_all()
+        await delivery.drain(max(0.0, deadline - time.monotonic()))
+        await runner.cleanup()
+        await bot.session.close()
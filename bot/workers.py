@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, FrozenSet, List, Sequence, Set, Tuple
+
+from . import context, geo
+from .context import GEO_WORKERS, user_states, state_store
+from .models import Config
+from .storage import MemoryBackend
+
+
+# (вошёл, вышел, зоны после обновления, время обновления)
+WorkerResult = Tuple[Set[int], Set[int], FrozenSet[int], float]
+
+
+def _init_worker(index: int, count: int):
+    # процесс получен через fork и унаследовал состояние родителя: оставляем
+    # только свою долю пользователей, сохранение и уведомления — в главном процессе
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    memory = MemoryBackend()
+    context.state_store = memory
+    geo.state_store = memory
+    for user_id in [u for u in user_states.keys() if u % count != index]:
+        del user_states[user_id]
+
+
+def _ping() -> int:
+    return len(user_states)
+
+
+def _process_batch(updates: Sequence[Tuple[int, float, float]]) -> List[WorkerResult]:
+    results = geo.update_user_states_batch(updates)
+    out: List[WorkerResult] = []
+    for (user_id, _, _), (entered, exited) in zip(updates, results):
+        state = user_states[user_id]
+        out.append((entered, exited, state.current_zone_ids, state.last_ts))
+    return out
+
+
+def _reload_worker(cfg: Config) -> List[Tuple[int, FrozenSet[int]]]:
+    context.CONFIG = cfg
+    changed = geo.reconcile_user_zones(list(user_states.keys()))
+    return [(user_id, user_states[user_id].current_zone_ids) for user_id in changed]
+
+
+class GeoWorkerPool:
+    def __init__(self, workers: int):
+        self.workers = max(0, workers)
+        self._executors: List[ProcessPoolExecutor] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._executors)
+
+    def shard_of(self, user_id: int) -> int:
+        return user_id % self.workers
+
+    async def start(self):
+        if self.workers <= 0 or self._executors:
+            return
+
+        mp = multiprocessing.get_context("fork")
+        self._executors = [
+            ProcessPoolExecutor(1, mp_context=mp, initializer=_init_worker, initargs=(i, self.workers))
+            for i in range(self.workers)
+        ]
+        # процессы создаются при первой задаче — запускаем их сразу, пока в родителе нет лишних потоков
+        loop = asyncio.get_running_loop()
+        sizes = await asyncio.gather(*(loop.run_in_executor(ex, _ping) for ex in self._executors))
+        logging.info("Запущено %d geo-воркеров, пользователей по шардам: %s", self.workers, sizes)
+
+    async def process(self, updates: Sequence[Tuple[int, float, float]]) -> List[Tuple[Set[int], Set[int]]]:
+        loop = asyncio.get_running_loop()
+        shards: Dict[int, List[int]] = {}
+        for i, upd in enumerate(updates):
+            shards.setdefault(self.shard_of(upd[0]), []).append(i)
+
+        # задачи уходят в воркеры до первого await: пакеты одного шарда
+        # выполняются в порядке отправки, и порядок обновлений пользователя сохраняется
+        jobs = [
+            self._collect(
+                loop.run_in_executor(self._executors[shard], _process_batch, [updates[i] for i in idx]),
+                updates,
+                idx,
+            )
+            for shard, idx in shards.items()
+        ]
+
+        results: List = [None] * len(updates)
+        for idx, part in zip(shards.values(), await asyncio.gather(*jobs)):
+            for i, result in zip(idx, part):
+                results[i] = result
+        return results
+
+    async def _collect(
+        self,
+        fut: "asyncio.Future[List[WorkerResult]]",
+        updates: Sequence[Tuple[int, float, float]],
+        idx: List[int],
+    ) -> List[Tuple[Set[int], Set[int]]]:
+        part = await fut
+        out = []
+        for i, (entered, exited, zones, ts) in zip(idx, part):
+            user_id, lat, lon = updates[i]
+            # главный процесс держит копию последней позиции для absence и хранилища
+            geo.record_user_position(user_id, lat, lon, ts, zones)
+            out.append((entered, exited))
+        return out
+
+    async def reload(self, cfg: Config) -> int:
+        loop = asyncio.get_running_loop()
+        parts = await asyncio.gather(*(
+            loop.run_in_executor(ex, _reload_worker, cfg) for ex in self._executors
+        ))
+        changed = 0
+        for part in parts:
+            for user_id, zones in part:
+                state = user_states.get(user_id)
+                if state is None:
+                    continue
+                user_states.set_zones(user_id, zones)
+                state_store.put_user(user_id, state)
+                changed += 1
+        return changed
+
+    def close(self):
+        for ex in self._executors:
+            ex.shutdown(wait=False, cancel_futures=True)
+        self._executors = []
+
+
+geo_workers = GeoWorkerPool(GEO_WORKERS)
@@ -0,0 +1,18 @@
+import json
+import os
+import tempfile
+
+# context.py читает конфиг и BOT_TOKEN при импорте, поэтому окружение задаётся до импорта bot
+_fd, _path = tempfile.mkstemp(prefix="geoshare-test-", suffix=".json")
+with os.fdopen(_fd, "w", encoding="utf-8") as _f:
+    json.dump({"zones": [], "telegram": {}}, _f)
+os.environ["CONFIG_PATH"] = _path
+os.environ["CONFIG_CACHE_PATH"] = ""
+os.environ["STATE_DB_PATH"] = ""
+os.environ["CLUSTER_DB_PATH"] = ""
+os.environ.setdefault("BOT_TOKEN", "0:test")
+
+
+def pytest_unconfigure(config):
+    if os.path.exists(_path):
+        os.remove(_path)
@@ -0,0 +1,202 @@
+import math
+import random
+
+import pytest
+
+from bot import context, geo
+from bot.config_loader import parse_config
+from bot.geo import FAST_EPS, FAST_MAX_LAT, haversine_m
+from bot.spatial import METERS_PER_DEG_LAT
+
+EARTH_RADIUS_M = 6371000.0
+SEEDS = range(5)
+
+
+def destination(lat: float, lon: float, bearing: float, distance_m: float):
+    # точка на заданном расстоянии по большому кругу — в той же сфере, что и haversine_m
+    phi1 = math.radians(lat)
+    theta = math.radians(bearing)
+    delta = distance_m / EARTH_RADIUS_M
+    phi2 = math.asin(math.sin(phi1) * math.cos(delta) + math.cos(phi1) * math.sin(delta) * math.cos(theta))
+    dlambda = math.atan2(
+        math.sin(theta) * math.sin(delta) * math.cos(phi1),
+        math.cos(delta) - math.sin(phi1) * math.sin(phi2),
+    )
+    lon2 = (lon + math.degrees(dlambda) + 540.0) % 360.0 - 180.0
+    return math.degrees(phi2), lon2
+
+
+def random_zones(rnd: random.Random, count: int):
+    zones = []
+    for zid in range(1, count + 1):
+        if zid % 10 == 0:
+            # у линии перемены дат: точки вокруг попадают по обе стороны от ±180°
+            lat, lon = rnd.uniform(-FAST_MAX_LAT, FAST_MAX_LAT), rnd.choice((-1, 1)) * rnd.uniform(179.9, 180.0)
+        elif zid % 10 == 1:
+            # приполярные: выше FAST_MAX_LAT быстрая оценка не применяется
+            lat, lon = rnd.choice((-1, 1)) * rnd.uniform(FAST_MAX_LAT - 1.0, 89.0), rnd.uniform(-180.0, 180.0)
+        else:
+            lat, lon = rnd.uniform(-FAST_MAX_LAT, FAST_MAX_LAT), rnd.uniform(-180.0, 180.0)
+        radius = math.exp(rnd.uniform(math.log(10.0), math.log(60_000.0)))
+        zones.append({"id": zid, "center": {"lat": lat, "lng": lon}, "radius_m": radius})
+    return zones
+
+
+def near_boundary(rnd: random.Random, zone) -> float:
+    # относительное отклонение от радиуса: от еле заметного до нескольких FAST_EPS в обе стороны
+    rel = math.exp(rnd.uniform(math.log(1e-6), math.log(20 * FAST_EPS)))
+    return zone.radius_m * (1.0 + rnd.choice((-1, 1)) * rel)
+
+
+def random_points(rnd: random.Random, cfg, count: int):
+    points = []
+    for _ in range(count):
+        zone = rnd.choice(cfg.zones)
+        kind = rnd.random()
+        if kind < 0.6:
+            distance = near_boundary(rnd, zone)
+        elif kind < 0.8:
+            distance = rnd.uniform(0.0, zone.radius_m)
+        else:
+            distance = zone.radius_m * rnd.uniform(1.0, 50.0)
+        points.append(destination(zone.center_lat, zone.center_lng, rnd.uniform(0.0, 360.0), distance))
+    return points
+
+
+def exact_membership(cfg, lat: float, lon: float, prev=frozenset(), hysteresis: float = 0.0):
+    return {
+        z.id for z in cfg.zones
+        if haversine_m(lat, lon, z.center_lat, z.center_lng) <= z.radius_m + (hysteresis if z.id in prev else 0.0)
+    }
+
+
+def make_config(rnd: random.Random, count: int = 200, hysteresis: float = 0.0):
+    return parse_config({"global": {"hysteresis_m": hysteresis}, "zones": random_zones(rnd, count)})
+
+
+@pytest.fixture
+def use_config(monkeypatch):
+    def apply(cfg):
+        monkeypatch.setattr(context, "CONFIG", cfg)
+        return cfg
+
+    context.user_states.clear()
+    yield apply
+    context.user_states.clear()
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_scalar_signed_distance_matches_haversine(seed):
+    rnd = random.Random(seed)
+    cfg = make_config(rnd)
+    for lat, lon in random_points(rnd, cfg, 3000):
+        cos_lat = math.cos(math.radians(lat))
+        for z in cfg.zones:
+            exact = haversine_m(lat, lon, z.center_lat, z.center_lng) - z.radius_m
+            sd = geo.zone_signed_distance(z, lat, lon, 0.0, cos_lat)
+            assert (sd <= 0.0) == (exact <= 0.0), (z, lat, lon, sd, exact)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_scalar_slack_keeps_side_of_boundary(seed):
+    rnd = random.Random(seed)
+    cfg = make_config(rnd)
+    for lat, lon in random_points(rnd, cfg, 1000):
+        for z in cfg.zones:
+            slack = rnd.uniform(0.0, 50.0)
+            exact = haversine_m(lat, lon, z.center_lat, z.center_lng) - z.radius_m
+            sd = geo.zone_signed_distance(z, lat, lon, slack)
+            # оценка может быть меньше по модулю, но не должна переходить порог slack
+            assert (sd <= slack) == (exact <= slack), (z, lat, lon, slack, sd, exact)
+            assert (sd <= 0.0) == (exact <= 0.0)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_batch_membership_matches_haversine(seed):
+    rnd = random.Random(seed)
+    cfg = make_config(rnd)
+    points = random_points(rnd, cfg, 2000)
+    expected = [exact_membership(cfg, lat, lon) for lat, lon in points]
+    assert geo._zones_membership_python(points, cfg.zones) == expected
+    if geo._load_numpy():
+        assert geo._zones_membership_numpy(points, cfg.zones) == expected
+
+
+def walk(rnd: random.Random, cfg, users: int, steps: int):
+    # пользователи бродят вокруг границ: шаг от метров (дрожание GPS) до сотен метров;
+    # треки перемежаются, но точки одного пользователя идут по порядку
+    tracks = []
+    for user_id in range(1, users + 1):
+        zone = rnd.choice(cfg.zones)
+        lat, lon = destination(zone.center_lat, zone.center_lng, rnd.uniform(0.0, 360.0), near_boundary(rnd, zone))
+        track = [(user_id, lat, lon)]
+        for _ in range(steps):
+            step = math.exp(rnd.uniform(math.log(0.5), math.log(500.0)))
+            lat, lon = destination(lat, lon, rnd.uniform(0.0, 360.0), step)
+            track.append((user_id, max(-89.0, min(89.0, lat)), lon))
+        tracks.append(track[::-1])
+    updates = []
+    while tracks:
+        i = rnd.randrange(len(tracks))
+        updates.append(tracks[i].pop())
+        if not tracks[i]:
+            tracks[i] = tracks[-1]
+            tracks.pop()
+    return updates
+
+
+def check_transitions(cfg, updates, apply_updates):
+    reference = {}
+    expected = []
+    for user_id, lat, lon in updates:
+        prev = reference.get(user_id, set())
+        new = exact_membership(cfg, lat, lon, prev, cfg.zone_global.hysteresis_m)
+        reference[user_id] = new
+        expected.append((new - prev, prev - new))
+    assert apply_updates(updates) == expected
+    for user_id, zones in reference.items():
+        assert set(context.user_states[user_id].current_zone_ids) == zones
+
+
+@pytest.mark.parametrize("hysteresis", [0.0, 5.0, 30.0])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_update_user_state_matches_haversine(use_config, seed, hysteresis):
+    rnd = random.Random(seed)
+    cfg = use_config(make_config(rnd, hysteresis=hysteresis))
+    updates = walk(rnd, cfg, 50, 40)
+    check_transitions(cfg, updates, lambda ups: [geo.update_user_state(*u) for u in ups])
+
+
+@pytest.mark.parametrize("hysteresis", [0.0, 5.0, 30.0])
+@pytest.mark.parametrize("seed", SEEDS)
+def test_batch_update_matches_haversine(use_config, seed, hysteresis):
+    pytest.importorskip("numpy")
+    rnd = random.Random(seed)
+    cfg = use_config(make_config(rnd, hysteresis=hysteresis))
+    updates = walk(rnd, cfg, 50, 40)
+
+    def apply_in_batches(ups):
+        out = []
+        for start in range(0, len(ups), 64):
+            out.extend(geo.update_user_states_batch(ups[start:start + 64]))
+        return out
+
+    check_transitions(cfg, updates, apply_in_batches)
+
+
+def test_hysteresis_holds_zone_across_index_cell(use_config):
+    # граница рамки зоны на границе ячейки индекса: точка за радиусом, но в пределах
+    # гистерезиса, лежит уже в соседней ячейке и всё равно должна остаться в зоне
+    radius = 100.0
+    dlat = radius / METERS_PER_DEG_LAT
+    cell = 2 * dlat
+    lat0 = -90.0 + math.ceil(90.5 / cell) * cell - dlat - 1e-9
+    cfg = use_config(parse_config({
+        "global": {"hysteresis_m": 20.0},
+        "zones": [{"id": 1, "center": {"lat": lat0, "lng": 10.0}, "radius_m": radius}],
+    }))
+    outside = lat0 + (radius + 10.0) / METERS_PER_DEG_LAT
+    assert cfg.zone_index.cell_of(outside, 10.0) != cfg.zone_index.cell_of(lat0, 10.0)
+
+    assert geo.update_user_state(1, lat0, 10.0) == ({1}, set())
+    assert geo.update_user_state(1, outside, 10.0) == (set(), set())
@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+from bot.history import DAY_S, MAGIC, RECORD, HistoryWriter, partition_name
+
+
+def read_ms(directory: str, day: int):
+    with open(os.path.join(directory, partition_name(day)), "rb") as f:
+        data = f.read()
+    assert data.startswith(MAGIC)
+    return [r[0] for r in RECORD.iter_unpack(data[len(MAGIC):])]
+
+
+def test_late_record_around_midnight_keeps_partition_order(tmp_path):
+    writer = HistoryWriter(str(tmp_path))
+    day = 20000
+    midnight = (day + 1) * DAY_S
+    writer.record(1, 55.75, 37.62, "update", ts=midnight - 0.125)
+    writer.record(1, 55.75, 37.62, "update", ts=midnight + 0.125)
+    # поздняя точка прошлых суток (или шаг часов назад), пока буфер ещё не сброшен
+    writer.record(2, 55.75, 37.62, "update", ts=midnight - 0.5)
+    asyncio.run(writer.flush())
+
+    ms = read_ms(str(tmp_path), day)
+    assert ms == sorted(ms) == [DAY_S * 1000 - 125, DAY_S * 1000 - 125]
+    assert read_ms(str(tmp_path), day + 1) == [125]
+
+
+def test_old_days_are_forgotten_and_resume_from_disk(tmp_path):
+    writer = HistoryWriter(str(tmp_path))
+    day = 20000
+    writer.record(1, 0.0, 0.0, "update", ts=day * DAY_S + 10.0)
+    asyncio.run(writer.flush())
+    for d in range(1, 5):
+        writer.record(1, 0.0, 0.0, "update", ts=(day + d) * DAY_S + 1.0)
+    assert day not in writer._last_ms and len(writer._last_ms) <= 2
+
+    writer.record(1, 0.0, 0.0, "update", ts=day * DAY_S + 5.0)
+    asyncio.run(writer.flush())
+    assert read_ms(str(tmp_path), day) == [10000, 10000]
@@ -0,0 +1,43 @@
+from bot.models import LiveSession
+from bot.sessions import LiveSessionTable
+
+NOW = 1_000_000.0
+
+
+async def _ignore(session):
+    pass
+
+
+def make_session(message_id: int, expires: float) -> LiveSession:
+    return LiveSession(1, message_id, 1, None, expires - 3600, 3600, expires)
+
+
+def test_first_sweep_returns_restored_expired_session():
+    table = LiveSessionTable(_ignore, tick_s=5.0, slots=1024)
+    expired = make_session(1, NOW - 600)
+    alive = make_session(2, NOW + 600)
+    table.restore([expired, alive])
+
+    assert table.sweep(NOW) == [expired]
+    assert (1, 2) in table and (1, 1) not in table
+
+
+def test_restore_after_sweep_expires_on_next_sweep():
+    table = LiveSessionTable(_ignore, tick_s=5.0, slots=1024)
+    assert table.sweep(NOW) == []
+    expired = make_session(1, NOW - 600)
+    table.restore([expired])
+
+    assert table.sweep(NOW + 5.0) == [expired]
+
+
+def test_session_expires_within_one_tick_of_deadline():
+    table = LiveSessionTable(_ignore, tick_s=5.0, slots=16)
+    table.sweep(NOW)
+    session = table.start(1, 1, 1, None, NOW, 60, now=NOW)
+
+    t = NOW
+    while t < session.expires:
+        assert table.sweep(t) == []
+        t += 5.0
+    assert table.sweep(t + 5.0) == [session]
@@ -0,0 +1,25 @@
+from datetime import datetime, timezone
+
+from bot import context, geo
+from bot.config_loader import parse_config
+from bot.models import UserState
+
+
+def test_external_overwrite_drops_margin_cache(monkeypatch):
+    cfg = parse_config({
+        "zones": [{"id": 1, "type": "danger", "center": {"lat": 55.75, "lng": 37.62}, "radius_m": 300.0}],
+    })
+    monkeypatch.setattr(context, "CONFIG", cfg)
+    users = context.user_states
+    users.clear()
+    try:
+        assert geo.update_user_state(7, 55.75, 37.62) == ({1}, set())
+
+        # так зеркалирует чужое состояние sync_from_cluster / подхват пользователя в кластере
+        users[7] = UserState(10.0, 10.0, datetime.now(timezone.utc), set())
+        assert users.anchor(7) is None
+
+        assert geo.update_user_state(7, 55.75, 37.62) == ({1}, set())
+        assert users[7].current_zone_ids == {1}
+    finally:
+        users.clear()